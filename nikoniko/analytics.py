@@ -0,0 +1,108 @@
+""" Mood analytics of a board, computed on a date x person matrix with NumPy
+"""
+import numpy
+
+# feelings without a score (e.g. free text) are left out of the metrics
+FEELING_SCORES = {'good': 1., 'neutral': 0., 'bad': -1.}
+OUTLIER_STDS = 2
+
+
+def feeling_matrix(rows, start, days):
+    """Build the days x people matrix of feeling scores (NaN where there is
+    no report) from (date, person_id, feeling) rows dated start onwards
+
+    Returns the matrix and the person ids of its columns.
+    """
+    rows = list(rows)
+    if not rows:
+        return numpy.full((days, 0), numpy.nan), []
+    dates, person_ids, feelings = zip(*rows)
+    day_index = numpy.fromiter(
+        (date.toordinal() for date in dates), numpy.int64,
+        len(rows)) - start.toordinal()
+    people, person_index = numpy.unique(person_ids, return_inverse=True)
+    labels, label_index = numpy.unique(feelings, return_inverse=True)
+    scores = numpy.array(
+        [FEELING_SCORES.get(label, numpy.nan) for label in labels])
+    matrix = numpy.full((days, len(people)), numpy.nan)
+    matrix[day_index, person_index] = scores[label_index]
+    return matrix, people.tolist()
+
+
+def daily_mood(matrix):
+    """Mean score of each day, NaN for days without scored reports; also
+    returns the sums and counts it is computed from"""
+    reported = ~numpy.isnan(matrix)
+    sums = numpy.where(reported, matrix, 0).sum(axis=1)
+    counts = reported.sum(axis=1)
+    with numpy.errstate(invalid='ignore', divide='ignore'):
+        return sums / counts, sums, counts
+
+
+def rolling_mood(sums, counts, window):
+    """Mean score of the reports of the window days up to each day"""
+    sum_totals = numpy.concatenate(([0], numpy.cumsum(sums)))
+    count_totals = numpy.concatenate(([0], numpy.cumsum(counts)))
+    starts = numpy.maximum(numpy.arange(1, len(sums) + 1) - window, 0)
+    window_sums = sum_totals[1:] - sum_totals[starts]
+    window_counts = count_totals[1:] - count_totals[starts]
+    with numpy.errstate(invalid='ignore', divide='ignore'):
+        return window_sums / window_counts
+
+
+def bad_streaks(matrix):
+    """Longest and current runs of bad days of each person (column)
+
+    Days without a report neither extend nor break a run, so weekends and
+    holidays don't reset streaks.
+    """
+    if not matrix.shape[1]:
+        return numpy.zeros(0, int), numpy.zeros(0, int)
+    with numpy.errstate(invalid='ignore'):  # NaN is neither
+        bad = matrix < 0
+        not_bad = matrix >= 0
+    bad_so_far = numpy.cumsum(bad, axis=0)
+    at_last_break = numpy.maximum.accumulate(
+        numpy.where(not_bad, bad_so_far, 0), axis=0)
+    runs = bad_so_far - at_last_break
+    return runs.max(axis=0), runs[-1]
+
+
+def mood_metrics(matrix, window):
+    """Compute the daily and rolling mood, the bad day streaks and the
+    deviations from the board's baseline (its mean daily mood over the
+    whole matrix)"""
+    mood, sums, counts = daily_mood(matrix)
+    rolling = rolling_mood(sums, counts, window)
+    longest, current = bad_streaks(matrix)
+    scored = mood[~numpy.isnan(mood)]
+    baseline = scored.mean() if scored.size else numpy.nan
+    spread = scored.std() if scored.size else numpy.nan
+    with numpy.errstate(invalid='ignore'):
+        outliers = numpy.abs(mood - baseline) > OUTLIER_STDS * spread
+        recent = sums[-window:].sum() / counts[-window:].sum() \
+            if counts[-window:].sum() else numpy.nan
+        deviation = (recent - baseline) / spread if spread else numpy.nan
+    return dict(
+        mood=mood,
+        rolling_mood=rolling,
+        longest_bad_streaks=longest,
+        current_bad_streaks=current,
+        baseline=baseline,
+        baseline_std=spread,
+        recent_mood=recent,
+        recent_deviation=deviation,
+        outliers=numpy.flatnonzero(outliers))
+
+
+def plain(value, digits=3):
+    """Turn NumPy results into JSON serializable values, NaN into None"""
+    if isinstance(value, numpy.ndarray):
+        return [plain(item, digits) for item in value.tolist()]
+    if isinstance(value, list):
+        return [plain(item, digits) for item in value]
+    if isinstance(value, (float, numpy.floating)):
+        return None if numpy.isnan(value) else round(float(value), digits)
+    if isinstance(value, numpy.integer):
+        return int(value)
+    return value
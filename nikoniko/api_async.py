@@ -0,0 +1,24 @@
+""" asyncio (ASGI) entry point to run the Nikoniko API
+
+Serves the same endpoints as nikoniko.api, e.g.:
+
+    uvicorn nikoniko.api_async:application
+"""
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from nikoniko.app import create_app
+from nikoniko.asgi import ASGIAdapter, request_scope
+
+WORKER_THREADS = int(os.getenv('ASGI_WORKER_THREADS', '10'))
+MAIL_THREADS = int(os.getenv('ASGI_MAIL_THREADS', '2'))
+
+NIKONIKOAPI, NIKONIKODB = create_app(
+    __name__,
+    scopefunc=request_scope,
+    mail_executor=ThreadPoolExecutor(max_workers=MAIL_THREADS))
+
+application = ASGIAdapter(  # pylint: disable=invalid-name
+    NIKONIKOAPI.api.http.server(),
+    ThreadPoolExecutor(max_workers=WORKER_THREADS),
+    on_finish=NIKONIKOAPI.session.remove)
@@ -0,0 +1,171 @@
+""" Build the pieces every Nikoniko API entry point is made of
+
+Entry points call create_app at import time, which pre-forking servers
+such as uWSGI do once in the master: code, mappers, schemas and routes
+are then shared copy-on-write by the workers, and each worker opens its
+own DB connections after the fork.
+"""
+import logging
+import os
+
+import bcrypt
+import hug
+
+from sqlalchemy.exc import InvalidRequestError
+from sqlalchemy.orm import configure_mappers, scoped_session
+
+from nikoniko.entities import DB
+from nikoniko.entities import User
+from nikoniko.entities import Person
+from nikoniko.entities import Board
+from nikoniko.logs import QueueLogging
+from nikoniko.nikonikoapi import NikonikoAPI
+
+from nikoniko.settings import broker_from_environment
+from nikoniko.settings import cache_from_environment
+from nikoniko.settings import compression_config_from_environment
+from nikoniko.settings import db_connstring_from_environment
+from nikoniko.settings import flights_from_environment
+from nikoniko.settings import logging_config_from_environment
+from nikoniko.settings import mailer_config_from_environment
+from nikoniko.settings import request_logging_config_from_environment
+from nikoniko.settings import profiling_config_from_environment
+from nikoniko.settings import ratelimit_config_from_environment
+from nikoniko.settings import tenancy_config_from_environment
+
+
+def bootstrap_db(session):
+    """ Fill in the DB with initial data """
+    one_person = Person(person_id=1, label='Ann')
+    other_person = Person(person_id=2, label='John')
+    session.add(one_person)
+    session.add(other_person)
+    try:
+        session.commit()
+    except InvalidRequestError as exception:
+        print(exception)
+        session.rollback()
+    one_user = User(
+        user_id=1,
+        name='John Smith',
+        email='john@example.com',
+        person_id=2,
+        password_hash=bcrypt.hashpw(
+            'whocares'.encode(),
+            bcrypt.gensalt()))
+    session.add(one_user)
+    try:
+        session.commit()
+    except InvalidRequestError as exception:
+        print(exception)
+        session.rollback()
+    one_board = Board(board_id=1, label='Global board')
+    one_board.people.append(one_person)
+    one_board.people.append(other_person)
+    session.add(one_board)
+    another_board = Board(board_id=2, label='The A Team')
+    another_board.people.append(one_person)
+    another_board.people.append(other_person)
+    session.add(another_board)
+    and_a_third__board = Board(board_id=3, label='The Harlem Globetrotters')
+    and_a_third__board.people.append(one_person)
+    and_a_third__board.people.append(other_person)
+    session.add(and_a_third__board)
+    try:
+        session.commit()
+    except InvalidRequestError as exception:
+        print(exception)
+        session.rollback()
+
+
+def logger_from_environment(name):
+    """ Set up queued logging and return a logger with the LOGLEVEL level
+
+    At DEBUG level, SQL statements are logged too (through the queue, not
+    SQLAlchemy's echo handler, which writes from the request thread).
+    """
+    queue_logging = QueueLogging(**logging_config_from_environment())
+    queue_logging.start()
+    after_fork(queue_logging.restart_after_fork)
+    log_level = getattr(logging, os.getenv('LOGLEVEL', 'INFO').upper())
+    if not isinstance(log_level, int):
+        raise ValueError('Invalid log level: {}'.format(log_level))
+    logger = logging.getLogger(name)
+    logger.setLevel(log_level)
+    if log_level <= logging.DEBUG:
+        logging.getLogger('sqlalchemy.engine').setLevel(logging.INFO)
+    logger.info('Log level set to %s', log_level)
+    return logger
+
+
+def db_from_environment(logger):
+    """ Connect to the DB, create its tables and bootstrap it if asked to """
+    nikonikodb = DB(db_connstring_from_environment(logger))
+    nikonikodb.create_all()
+    if os.getenv('DO_BOOTSTRAP_DB', 'false').lower() in [
+            'yes', 'y', 'true', 't', '1']:
+        logger.info('Bootstrapping DB')
+        session = nikonikodb.session()
+        bootstrap_db(session)
+        session.close()
+    return nikonikodb
+
+
+def config_from_environment(nikonikodb, logger):
+    """ Compose the NikonikoAPI configuration """
+    return dict(
+        # may purposefully throw exception
+        secret_key=os.environ['JWT_SECRET_KEY'],
+        mailconfig=mailer_config_from_environment(logger),
+        ratelimit=ratelimit_config_from_environment(logger),
+        compression=compression_config_from_environment(logger),
+        broker=broker_from_environment(nikonikodb.engine, logger),
+        cache=cache_from_environment(logger),
+        flights=flights_from_environment(logger),
+        profiling=profiling_config_from_environment(logger),
+        request_logging=request_logging_config_from_environment(logger),
+        logger=logger,
+        **tenancy_config_from_environment(logger))
+
+
+def create_app(name, scopefunc=None, **config):
+    """ Build and set up the NikonikoAPI of the entry point module name
+
+    Sessions are scoped by scopefunc when given, one session per tenant
+    (and thread or request) when serving several tenants. Extra config
+    entries override those from the environment.
+    """
+    logger = logger_from_environment(name)
+    nikonikodb = db_from_environment(logger)
+    config = dict(config_from_environment(nikonikodb, logger), **config)
+    if config.get('tenants'):
+        config['tenants'].provision()
+        session = config['tenants'].session
+    elif scopefunc:
+        session = scoped_session(nikonikodb.session, scopefunc=scopefunc)
+    else:
+        session = nikonikodb.session()
+    nikonikoapi = NikonikoAPI(hug.API(name), session, config)
+    nikonikoapi.setup()
+    configure_mappers()
+    after_fork(lambda: reconnect(nikonikodb, nikonikoapi))
+    return nikonikoapi, nikonikodb
+
+
+def reconnect(nikonikodb, nikonikoapi):
+    """ Drop the DB connections inherited from the parent process, so
+    the workers never share a socket; they reconnect on demand """
+    nikonikodb.engine.dispose()
+    if nikonikoapi.tenants is not None:
+        nikonikoapi.tenants.dispose()
+
+
+def after_fork(function):
+    """ Call function in every worker forked from this process """
+    try:
+        from uwsgidecorators import postfork  # pylint: disable=import-error
+    except ImportError:
+        os.register_at_fork(after_in_child=function)
+    else:
+        # uWSGI forks its workers without running Python's fork hooks
+        postfork(function)
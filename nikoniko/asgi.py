@@ -0,0 +1,204 @@
+""" Serve the (WSGI) hug API from an asyncio event loop through ASGI
+
+The event loop owns the client connections, so idle keep-alive connections
+cost a coroutine each instead of a whole worker. Request handling, which
+talks to the DB through SQLAlchemy, and the sending of ordinary response
+bodies run on a bounded thread pool: a slow body holds a pool thread until
+it is sent. Only asynchronously iterable bodies, such as board event
+streams, are sent from the event loop without holding a thread.
+
+Every request gets its own contextvars context, used as the scope of the
+SQLAlchemy session, so a request keeps the same session even when
+consecutive steps run on different pool threads.
+"""
+import asyncio
+import contextvars
+import io
+import sys
+
+REQUEST = contextvars.ContextVar('nikoniko_request')
+ASYNC_ENVIRON_KEY = 'nikoniko.asgi'
+
+
+def request_scope():
+    """scopefunc for sqlalchemy.orm.scoped_session: one session per request
+    """
+    return REQUEST.get(None)
+
+
+def wsgi_environ(scope, body):
+    """Build a WSGI environ dictionary from an ASGI HTTP scope"""
+    server = scope.get('server') or ('localhost', 80)
+    client = scope.get('client') or ('', 0)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', ''),
+        'PATH_INFO': scope['path'],
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': 'HTTP/{}'.format(scope.get('http_version', '1.1')),
+        'REMOTE_ADDR': client[0],
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': False,
+        'wsgi.run_once': False,
+        'wsgi.file_wrapper': FileWrapper,
+        ASYNC_ENVIRON_KEY: True,
+    }
+    for name, value in scope.get('headers', ()):
+        name = name.decode('latin-1').upper().replace('-', '_')
+        value = value.decode('latin-1')
+        if name not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+            name = 'HTTP_{}'.format(name)
+        if name in environ:
+            value = '{},{}'.format(environ[name], value)
+        environ[name] = value
+    return environ
+
+
+class FileWrapper():
+    """wsgi.file_wrapper keeping hold of the stream it wraps, so the adapter
+    can tell streams to be iterated asynchronously apart"""
+    __slots__ = ('stream', 'block_size')
+
+    def __init__(self, stream, block_size=8192):
+        self.stream = stream
+        self.block_size = block_size
+
+    def __iter__(self):
+        return iter(lambda: self.stream.read(self.block_size), b'')
+
+    def close(self):
+        """Close the wrapped stream"""
+        close = getattr(self.stream, 'close', None)
+        if close:
+            close()
+
+
+async def wait_for_disconnect(receive):
+    """Return once the client has gone away"""
+    while (await receive())['type'] != 'http.disconnect':
+        pass
+
+
+class ASGIAdapter():
+    """ASGI application running a WSGI application on a thread pool"""
+    __slots__ = ('wsgi_app', 'executor', 'on_finish')
+
+    def __init__(self, wsgi_app, executor, on_finish=None):
+        """ on_finish is called, in the request context, after each request
+        """
+        self.wsgi_app = wsgi_app
+        self.executor = executor
+        self.on_finish = on_finish
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self.lifespan(receive, send)
+        elif scope['type'] == 'http':
+            await self.http(scope, receive, send)
+        else:
+            raise ValueError(
+                'Unsupported ASGI scope: {}'.format(scope['type']))
+
+    @staticmethod
+    async def lifespan(receive, send):
+        """Acknowledge server startup and shutdown"""
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def http(self, scope, receive, send):
+        # pylint: disable=too-many-locals
+        """Serve one HTTP request, streaming the body chunk by chunk"""
+        body = b''
+        more_body = True
+        while more_body:
+            message = await receive()
+            body += message.get('body', b'')
+            more_body = message.get('more_body', False)
+
+        context = contextvars.copy_context()
+        context.run(REQUEST.set, object())
+        loop = asyncio.get_event_loop()
+
+        def in_worker(function, *args):
+            return loop.run_in_executor(
+                self.executor, context.run, function, *args)
+
+        started = {}
+
+        def start_response(status, headers, exc_info=None):
+            # pylint: disable=unused-argument
+            started['status'] = int(status.split(' ', 1)[0])
+            started['headers'] = [
+                (name.lower().encode('latin-1'), value.encode('latin-1'))
+                for name, value in headers]
+
+        result = None
+        try:
+            result = await in_worker(
+                self.wsgi_app, wsgi_environ(scope, body), start_response)
+            await send({
+                'type': 'http.response.start',
+                'status': started['status'],
+                'headers': started['headers']})
+            stream = getattr(result, 'stream', None) \
+                if isinstance(result, FileWrapper) else None
+            if hasattr(stream, '__aiter__'):
+                await self.send_async_body(stream, receive, send)
+                return
+            chunks = iter(result)
+            while True:
+                chunk = await in_worker(next, chunks, None)
+                if chunk is None:
+                    break
+                if chunk:
+                    await send({
+                        'type': 'http.response.body',
+                        'body': chunk,
+                        'more_body': True})
+            await send({'type': 'http.response.body', 'body': b''})
+        finally:
+            if hasattr(result, 'close'):
+                await in_worker(result.close)
+            if self.on_finish:
+                await in_worker(self.on_finish)
+
+    @staticmethod
+    async def send_async_body(stream, receive, send):
+        """Send an asynchronously iterable body from the event loop, until
+        it ends or the client disconnects"""
+        chunks = stream.__aiter__()
+        disconnected = asyncio.ensure_future(wait_for_disconnect(receive))
+        try:
+            while True:
+                chunk = asyncio.ensure_future(chunks.__anext__())
+                await asyncio.wait(
+                    (chunk, disconnected),
+                    return_when=asyncio.FIRST_COMPLETED)
+                if disconnected.done():
+                    chunk.cancel()
+                    await asyncio.wait((chunk,))
+                    return
+                try:
+                    data = chunk.result()
+                except StopAsyncIteration:
+                    break
+                await send({
+                    'type': 'http.response.body',
+                    'body': data,
+                    'more_body': True})
+            await send({'type': 'http.response.body', 'body': b''})
+        finally:
+            disconnected.cancel()
+            if hasattr(chunks, 'aclose'):
+                await chunks.aclose()
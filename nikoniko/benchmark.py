@@ -0,0 +1,320 @@
+""" Benchmarks of read paths and of the embedded SQLite mode
+
+``reads``: the people, boards and person endpoints select plain column
+tuples and build their responses from them. This compares their latency
+and the memory they allocate with loading the same data as ORM entities
+and dumping them with the marshmallow schemas, as they used to, on people
+and boards made up for the run. Memory per request is what bounds how many
+workers fit on a node.
+
+``sqlite``: worker processes report feelings on one board of a SQLite file
+DB at once, as uWSGI's would, in embedded mode and with SQLite's defaults;
+this reports the throughput of both and the writes that failed, e.g. with
+"database is locked".
+"""
+import argparse
+import logging
+import multiprocessing
+import os
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+import uuid
+
+from collections import Counter
+from datetime import timedelta
+
+import hug
+
+from falcon import Response
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import scoped_session
+
+from nikoniko.entities import DB, Board, Person, MEMBERSHIP, SQLITE_PRAGMAS
+from nikoniko.entities import PERSON_SCHEMA, PEOPLE_SCHEMA, BOARDS_SCHEMA
+from nikoniko.nikonikoapi import NikonikoAPI
+from nikoniko.queries import lookup
+from nikoniko.soak import FIRST_DAY, seed as seed_board
+
+READS = ('people', 'boards', 'person')
+SQLITE_MODES = (('embedded', SQLITE_PRAGMAS), ('default', ()))
+
+
+def seed(session, people, boards, members):
+    """Create people and boards of members people each; returns the ids of
+    the people and of the boards"""
+    run = uuid.uuid4().hex[:8]
+    persons = [
+        Person(label='bench-{}-{}'.format(run, number))
+        for number in range(people)]
+    teams = [
+        Board(
+            label='bench-{}-{}'.format(run, number),
+            people=[
+                persons[(number * members + offset) % people]
+                for offset in range(min(members, people))])
+        for number in range(boards)]
+    session.add_all(persons + teams)
+    session.commit()
+    return (
+        [person.person_id for person in persons],
+        [board.board_id for board in teams])
+
+
+def cleanup(session, person_ids, board_ids):
+    """Remove what seed created"""
+    session.execute(
+        MEMBERSHIP.delete()  # pylint: disable=no-value-for-parameter
+        .where(MEMBERSHIP.c.board_id.in_(board_ids)))
+    session.query(Board).filter(Board.board_id.in_(board_ids)).delete(
+        synchronize_session=False)
+    session.query(Person).filter(Person.person_id.in_(person_ids)).delete(
+        synchronize_session=False)
+    session.commit()
+
+
+def entity_reads(session, person_id):
+    """The reads, loading ORM entities and dumping them with schemas"""
+    return {
+        'people': lambda: PEOPLE_SCHEMA.dump(
+            session.query(Person).all()).data,
+        'boards': lambda: BOARDS_SCHEMA.dump(
+            session.query(Board).all()).data,
+        'person': lambda: PERSON_SCHEMA.dump(lookup(
+            session, Person, {'person_id': person_id}).one()).data}
+
+
+def projection_reads(api, person_id):
+    """The reads, as the endpoints do them"""
+    # falcon builds responses before calling endpoints, so don't time it
+    response = Response()
+    return {
+        'people': api.people,
+        'boards': api.get_boards,
+        'person': lambda: api.get_person(person_id, response)}
+
+
+def measure(read, session, repeat):
+    """Time repeat runs of read, each in a fresh session as requests get,
+    and trace the memory one more run allocates; returns a report
+    dictionary"""
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        read()
+        timings.append(time.perf_counter() - started)
+        session.remove()
+    tracemalloc.start()
+    try:
+        result = read()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+        session.remove()
+    return dict(
+        result=result,
+        mean=statistics.mean(timings),
+        p50=statistics.median(timings),
+        peak=peak)
+
+
+def benchmark(database, people=2000, boards=50, members=20, repeat=20):
+    """Run every read both ways on made up people and boards, checking they
+    answer the same
+
+    Returns a report dictionary of the measures of each read and path.
+    """
+    # pylint: disable=too-many-arguments
+    session = scoped_session(database.session)
+    api = NikonikoAPI(
+        hug.API('nikoniko-benchmark-{}'.format(uuid.uuid4().hex)),
+        session,
+        dict(secret_key=None, mailconfig=None,
+             logger=logging.getLogger(__name__)))
+    setup_session = database.session()
+    person_ids, board_ids = seed(setup_session, people, boards, members)
+    try:
+        paths = {
+            'entities': entity_reads(session, person_ids[0]),
+            'projection': projection_reads(api, person_ids[0])}
+        measures = {
+            read: {
+                path: measure(reads[read], session, repeat)
+                for path, reads in paths.items()}
+            for read in READS}
+    finally:
+        cleanup(setup_session, person_ids, board_ids)
+        setup_session.close()
+    for read, by_path in measures.items():
+        if by_path['entities'].pop('result') != \
+                by_path['projection'].pop('result'):
+            raise AssertionError('{} answers differ'.format(read))
+    return dict(
+        people=people, boards=boards, members=members, repeat=repeat,
+        measures=measures)
+
+
+def format_report(report):
+    """Render the latencies and memory of both paths of every read"""
+    lines = [
+        '{people} people, {boards} boards of {members}, '
+        '{repeat} runs each'.format(**report)]
+    for read, by_path in report['measures'].items():
+        entities, projection = by_path['entities'], by_path['projection']
+        lines.extend(
+            '{:<7} {:<10} mean {:8.2f}ms  p50 {:8.2f}ms  '
+            'peak {:9.1f}KiB'.format(
+                read, path, measures['mean'] * 1000,
+                measures['p50'] * 1000, measures['peak'] / 1024)
+            for path, measures in by_path.items())
+        lines.append(
+            '{:<7} projection takes {:.0%} of the time and {:.0%} of the '
+            'peak memory'.format(
+                read, projection['mean'] / entities['mean'],
+                projection['peak'] / entities['peak']))
+    return '\n'.join(lines)
+
+
+def write_feelings(  # pylint: disable=too-many-arguments
+        connstring, pragmas, board_id, person_id, start, seconds, results):
+    """Report feelings of a person, a day after another, for some seconds
+    from when start is set; put the latencies of the writes and the
+    failures by message on results (a queue)"""
+    database = DB(connstring, sqlite_pragmas=pragmas)
+    api = NikonikoAPI(
+        hug.API('nikoniko-benchmark-{}'.format(os.getpid())),
+        database.session(),
+        dict(secret_key=None, mailconfig=None,
+             logger=logging.getLogger(__name__)))
+    timings, errors = [], Counter()
+    day = FIRST_DAY
+    start.wait()
+    deadline = time.perf_counter() + seconds
+    while time.perf_counter() < deadline:
+        started = time.perf_counter()
+        try:
+            api.create_reported_feeling(
+                board_id, person_id, 'good', day.isoformat())
+            timings.append(time.perf_counter() - started)
+        except OperationalError as error:
+            api.session.rollback()
+            errors[str(error.orig)] += 1
+        day += timedelta(days=1)
+    api.session.close()
+    results.put((timings, errors))
+
+
+def sqlite_writes(  # pylint: disable=too-many-locals
+        path, pragmas, processes=4, seconds=10):
+    """Run processes writers on a new SQLite file DB at path, tuned with
+    pragmas; returns a report dictionary"""
+    connstring = 'sqlite:///{}'.format(path)
+    database = DB(connstring, sqlite_pragmas=pragmas)
+    database.create_all()
+    board_id, _, people = seed_board(database.session(), processes)
+    database.engine.dispose()
+    # fresh interpreters: no connection or lock is inherited
+    context = multiprocessing.get_context('spawn')
+    start, results = context.Event(), context.Queue()
+    writers = [
+        context.Process(
+            target=write_feelings,
+            args=(connstring, pragmas, board_id, person_id, start, seconds,
+                  results))
+        for person_id, _ in people]
+    for writer in writers:
+        writer.start()
+    start.set()
+    timings, errors = [], Counter()
+    for _ in writers:
+        writer_timings, writer_errors = results.get()
+        timings.extend(writer_timings)
+        errors.update(writer_errors)
+    for writer in writers:
+        writer.join()
+    timings.sort()
+    return dict(
+        processes=processes,
+        seconds=seconds,
+        writes=len(timings),
+        p50=timings[len(timings) // 2] if timings else 0,
+        p99=timings[len(timings) * 99 // 100] if timings else 0,
+        errors=errors)
+
+
+def sqlite_benchmark(directory, processes=4, seconds=10):
+    """Run sqlite_writes in embedded mode and with SQLite's defaults, on
+    DB files in directory; returns a report dictionary of both"""
+    return {
+        mode: sqlite_writes(
+            os.path.join(directory, '{}.db'.format(mode)), pragmas,
+            processes, seconds)
+        for mode, pragmas in SQLITE_MODES}
+
+
+def format_sqlite_report(report):
+    """Render the write throughput and failures of every SQLite mode"""
+    lines = []
+    for mode, writes in report.items():
+        lines.append(
+            '{mode:<8} {writes} writes from {processes} processes in '
+            '{seconds:g}s ({rate:.0f} writes/s, p50 {p50_ms:.1f}ms, '
+            'p99 {p99_ms:.1f}ms), {failed} failed'.format(
+                mode=mode,
+                rate=writes['writes'] / writes['seconds'],
+                p50_ms=writes['p50'] * 1000,
+                p99_ms=writes['p99'] * 1000,
+                failed=sum(writes['errors'].values()),
+                **writes))
+        lines.extend(
+            '    {} {}'.format(count, message)
+            for message, count in writes['errors'].most_common())
+    return '\n'.join(lines)
+
+
+def main(argv=None):
+    """Entry point of the nikoniko-benchmark command"""
+    parser = argparse.ArgumentParser(
+        description='Benchmark read paths or the embedded SQLite mode')
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+    reads = commands.add_parser(
+        'reads', help='compare column projection reads with ORM entities')
+    reads.add_argument(
+        '--db', default='sqlite://',
+        help='DB connection string (defaults to an in-memory SQLite DB)')
+    reads.add_argument('--people', type=int, default=2000)
+    reads.add_argument('--boards', type=int, default=50)
+    reads.add_argument(
+        '--members', type=int, default=20,
+        help='people per board')
+    reads.add_argument(
+        '--repeat', type=int, default=20,
+        help='timed runs of every read')
+    sqlite = commands.add_parser(
+        'sqlite', help='compare concurrent writes to tuned and default '
+        'SQLite file DBs')
+    sqlite.add_argument('--processes', type=int, default=4)
+    sqlite.add_argument('--seconds', type=float, default=10)
+    args = parser.parse_args(argv)
+    logging.basicConfig()
+    if args.command == 'sqlite':
+        if args.processes < 1 or args.seconds <= 0:
+            parser.error('--processes and --seconds must be positive')
+        with tempfile.TemporaryDirectory() as directory:
+            print(format_sqlite_report(sqlite_benchmark(
+                directory, args.processes, args.seconds)))
+        return 0
+    if min(args.people, args.boards, args.repeat) < 1:
+        parser.error('--people, --boards and --repeat must be positive')
+    database = DB(args.db)
+    database.create_all()
+    print(format_report(benchmark(
+        database, args.people, args.boards, args.members, args.repeat)))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
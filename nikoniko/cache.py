@@ -0,0 +1,152 @@
+""" Cache rendered responses, e.g. board payloads, between requests
+
+Cached entries of a board are invalidated all at once by bumping the
+board's generation, which is part of their keys: memcached can't list the
+keys of a board, and stale generations simply age out.
+"""
+import json
+import socket
+import threading
+import time
+
+from collections import OrderedDict
+
+
+class MemoryCache():
+    """LRU cache with a TTL, kept in this process
+
+    Only safe with a single worker process: invalidations made by a worker
+    don't reach the caches of the others.
+    """
+    __slots__ = ('entries', 'lock', 'max_items')
+
+    def __init__(self, max_items: int = 1000):
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.max_items = max_items
+
+    def get(self, key):
+        """Return the value stored for key, None if missing or expired"""
+        with self.lock:
+            value, expires = self.entries.pop(key, (None, 0))
+            if expires < time.monotonic():
+                return None
+            self.entries[key] = (value, expires)
+        return value
+
+    def set(self, key, value, ttl):
+        """Store value for ttl seconds, evicting the least recently used"""
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = (value, time.monotonic() + ttl)
+            while len(self.entries) > self.max_items:
+                self.entries.popitem(last=False)
+
+
+class MemcachedCache():
+    """Cache shared by every worker and node in a memcached (or compatible)
+    server, speaking its text protocol; values are stored as JSON"""
+    __slots__ = ('address', 'timeout', 'connection', 'lock')
+
+    def __init__(self, address=('localhost', 11211), timeout: float = 1):
+        self.address = address
+        self.timeout = timeout
+        self.connection = None
+        self.lock = threading.Lock()
+
+    def command(self, line, data=None):
+        """Send a command and return the lines of its reply up to the
+        terminating one, reconnecting once if the server went away"""
+        with self.lock:
+            for attempt in (1, 2):
+                try:
+                    return self._command(line, data)
+                except (OSError, EOFError):
+                    self.close()
+                    if attempt == 2:
+                        raise
+        return None
+
+    def _command(self, line, data):
+        if self.connection is None:
+            self.connection = socket.create_connection(
+                self.address, self.timeout).makefile('rwb')
+        self.connection.write(line.encode() + b'\r\n')
+        if data is not None:
+            self.connection.write(data + b'\r\n')
+        self.connection.flush()
+        reply = []
+        while True:
+            received = self.connection.readline()
+            if not received:
+                raise EOFError('memcached closed the connection')
+            received = received.rstrip(b'\r\n')
+            if received.startswith(b'VALUE '):
+                size = int(received.split()[3])
+                reply.append(self.connection.read(size + 2)[:size])
+                continue
+            reply.append(received)
+            return reply
+
+    def close(self):
+        """Drop the connection; the next command opens a new one"""
+        if self.connection is not None:
+            try:
+                self.connection.close()
+            except OSError:
+                pass
+            self.connection = None
+
+    def get(self, key):
+        """Return the value stored for key, None if missing or expired"""
+        reply = self.command('get {}'.format(key))
+        if len(reply) < 2:
+            return None
+        return json.loads(reply[0].decode())
+
+    def set(self, key, value, ttl):
+        """Store value for ttl seconds"""
+        data = json.dumps(value).encode()
+        self.command(
+            'set {} 0 {} {}'.format(key, int(ttl), len(data)), data)
+
+
+class ResponseCache():
+    """Responses cached per board and variant (e.g. a date window)"""
+    __slots__ = ('backend', 'ttl')
+
+    def __init__(self, backend, ttl: float = 60):
+        self.backend = backend
+        self.ttl = ttl
+
+    def generation(self, board):
+        """Return the current generation of a board's entries"""
+        key = 'board-generation:{}'.format(board)
+        generation = self.backend.get(key)
+        if generation is None:
+            # a lost generation must not bring back older entries
+            generation = time.time_ns()
+            self.backend.set(key, generation, self.ttl)
+        return generation
+
+    def key(self, board, variant):
+        """Key of a variant of a board's response in its current generation
+
+        Take the key before reading the DB: a response computed while the
+        board changes is then stored under the old, unreachable generation.
+        """
+        return 'board:{}:{}:{}'.format(
+            board, self.generation(board), variant)
+
+    def get(self, key):
+        """Return the cached response, or None"""
+        return self.backend.get(key)
+
+    def set(self, key, value):
+        """Cache a response"""
+        self.backend.set(key, value, self.ttl)
+
+    def invalidate(self, board):
+        """Forget every cached response of the board"""
+        self.backend.set(
+            'board-generation:{}'.format(board), time.time_ns(), self.ttl)
@@ -0,0 +1,99 @@
+""" Change sequences of reported feelings, for delta syncs
+
+Every write of a reported feeling stamps it with the next value of its
+board's change sequence. Clients walk a board's feelings in (change_seq,
+person_id, date) order and keep the position of the last one they got as
+an opaque cursor, so that a sync only returns what changed after it.
+"""
+from datetime import datetime
+
+from sqlalchemy import literal, select
+from sqlalchemy.engine import Connection
+from sqlalchemy.exc import IntegrityError
+
+from nikoniko.entities import Board, ChangeSequence
+
+BOARDS = Board.__table__
+SEQUENCES = ChangeSequence.__table__
+
+
+def next_change(connection, board_id):
+    """Return the next change sequence value of a board, within the
+    transaction of connection (a session or a connection); None if there's
+    no such board"""
+    return claim(connection, board_id, 1)
+
+
+def lock_changes(connection, board_id):
+    """Lock the change sequence row of a board until the end of the
+    transaction of connection, as writes of its reported feelings do, so
+    that writes of what is derived from them (e.g. its snapshot) are
+    serialized with those; tell whether the board exists"""
+    return claim(connection, board_id, 0) is not None
+
+
+def claim(connection, board_id, step):
+    """Add step to the change sequence of a board, creating it if missing,
+    which locks its row; return its value, None if there's no board"""
+    if not isinstance(connection, Connection):
+        # a session: its savepoints would flush it first
+        connection = connection.connection()
+    if not bump(connection, board_id, step):
+        # the first change of a board, unless a concurrent one inserts the
+        # row first: then bump that once it's committed
+        try:
+            with connection.begin_nested():
+                connection.execute(SEQUENCES.insert().from_select(
+                    ['board_id', 'last_change'],
+                    select([BOARDS.c.board_id, literal(step)]).where(
+                        BOARDS.c.board_id == board_id)))
+        except IntegrityError:
+            bump(connection, board_id, step)
+    return connection.execute(
+        select([SEQUENCES.c.last_change])
+        .where(SEQUENCES.c.board_id == board_id)).scalar()
+
+
+def bump(connection, board_id, step):
+    """Add step to the change sequence of a board, locking its row; tell
+    whether it had one"""
+    return connection.execute(
+        SEQUENCES.update()
+        .where(SEQUENCES.c.board_id == board_id)
+        .values(last_change=SEQUENCES.c.last_change + step)).rowcount
+
+
+def bump_changes(connection, source):
+    """Move the change sequences of the boards in the board_id column of
+    source (a table) to their next value, within the transaction of
+    connection; the new values are those of current_change"""
+    board_ids = select([source.c.board_id]).distinct()
+    connection.execute(
+        SEQUENCES.insert()  # pylint: disable=no-value-for-parameter
+        .from_select(
+            ['board_id', 'last_change'],
+            select([source.c.board_id, literal(0)]).distinct().where(
+                ~source.c.board_id.in_(select([SEQUENCES.c.board_id])))))
+    connection.execute(
+        SEQUENCES.update()
+        .where(SEQUENCES.c.board_id.in_(board_ids))
+        .values(last_change=SEQUENCES.c.last_change + 1))
+
+
+def current_change(board_id):
+    """A scalar subquery of the current change sequence value of board_id
+    (a column)"""
+    return select([SEQUENCES.c.last_change]).where(
+        SEQUENCES.c.board_id == board_id).as_scalar()
+
+
+def change_cursor(value):
+    """A cursor returned by a previous sync"""
+    change, person_id, date = value.split('.')
+    return (
+        int(change), int(person_id), datetime.strptime(date, '%Y%m%d').date())
+
+
+def encode_cursor(position):
+    """The cursor of a (change_seq, person_id, date) position"""
+    return '{}.{}.{:%Y%m%d}'.format(*position)
@@ -2,27 +2,77 @@
 import time
 
 from sqlalchemy import Column, Integer, String, Date, DateTime, Binary
+from sqlalchemy import Text
+from sqlalchemy import DDL
 from sqlalchemy import ForeignKey
+from sqlalchemy import Index
 from sqlalchemy import Table
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event, func
+from sqlalchemy.engine.url import make_url
 from sqlalchemy.exc import OperationalError
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relationship
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import QueuePool
 from sqlalchemy_utils import UUIDType
 
 from marshmallow import Schema, fields
 
 
+# embedded mode: a SQLite file DB written to by several worker processes
+SQLITE_PRAGMAS = (
+    # readers don't block the writer, nor it them
+    ('journal_mode', 'WAL'),
+    # durable with WAL up to the last checkpoint, without a sync per commit
+    ('synchronous', 'NORMAL'),
+    # milliseconds to wait for another process' write lock, not fail
+    ('busy_timeout', 5000),
+    # read the DB file through memory mapping rather than copying it
+    ('mmap_size', 256 * 1024 * 1024),
+)
+
+
+def embedded(db_connstring):
+    """ Tell whether a connection string is of a SQLite file DB """
+    url = make_url(db_connstring)
+    return url.get_backend_name() == 'sqlite' and \
+        url.database not in (None, '', ':memory:')
+
+
+def tune_sqlite(engine, pragmas):
+    """ Set the pragmas on every new connection of engine """
+    @event.listens_for(engine, 'connect')
+    def set_pragmas(connection, record):  # pylint: disable=unused-variable
+        # pylint: disable=unused-argument
+        cursor = connection.cursor()
+        for name, value in pragmas:
+            cursor.execute('PRAGMA {}={}'.format(name, value))
+        cursor.close()
+
+
 class DB():  # pylint: disable=too-few-public-methods
-    """ DB / SQLAlchemy """
+    """ DB / SQLAlchemy
+
+    SQLite file DBs run in embedded mode, tuned with sqlite_pragmas (none
+    leaves SQLite's defaults) and with a pool of connections, which keep
+    their page cache between requests.
+    """
     base = declarative_base()
 
-    def __init__(self, db_connstring, echo=False):
+    def __init__(self, db_connstring, echo=False,
+                 sqlite_pragmas=SQLITE_PRAGMAS):
         self.db_connstring = db_connstring
+        tuned = sqlite_pragmas and embedded(db_connstring)
         self.engine = create_engine(
             db_connstring,
-            echo=echo)
+            echo=echo,
+            **(dict(
+                poolclass=QueuePool,
+                # sessions, not threads, own connections
+                connect_args={'check_same_thread': False})
+               if tuned else {}))
+        if tuned:
+            tune_sqlite(self.engine, sqlite_pragmas)
         self.session = sessionmaker(bind=self.engine)
         self.connect()
 
@@ -45,6 +95,23 @@ class DB():  # pylint: disable=too-few-public-methods
         self.base.metadata.create_all(self.engine)
 
 
+# label searches match substrings with trigram indexes on PostgreSQL
+event.listen(
+    DB.base.metadata,
+    'before_create',
+    DDL('CREATE EXTENSION IF NOT EXISTS pg_trgm').execute_if(
+        dialect='postgresql'))
+
+
+def trigram_index(table, column):
+    """ Index the lowercased column for substring searches on PostgreSQL,
+    where the table gets created """
+    event.listen(table, 'after_create', DDL(
+        'CREATE INDEX ix_{0}_{1}_trgm ON {0} '
+        'USING gin (lower({1}) gin_trgm_ops)'.format(
+            table.name, column)).execute_if(dialect='postgresql'))
+
+
 class InvalidatedToken(DB.base):  # pylint: disable=too-few-public-methods
     """ Invalidated Token entity definition """
     __tablename__ = 'invalidatedtokens'
@@ -84,10 +151,45 @@ class ReportedFeeling(DB.base):  # pylint: disable=too-few-public-methods
     board_id = Column(Integer, ForeignKey('boards.board_id'), primary_key=True)
     date = Column(Date, primary_key=True)
     feeling = Column(String(10))
+    # the board's change sequence value of the last write (see ChangeSequence)
+    change_seq = Column(Integer, nullable=False, default=0, server_default='0')
 
     person = relationship('Person', back_populates='reported_feelings')
     board = relationship('Board', back_populates='reported_feelings')
 
+    __table_args__ = (
+        # board reads and exports filter by board and walk it by date
+        Index('ix_reportedfeelings_board_date', board_id, date, person_id),
+        # delta syncs walk a board's changes after a cursor
+        Index(
+            'ix_reportedfeelings_board_change',
+            board_id, change_seq, person_id, date),
+    )
+
+
+class ArchivedFeeling(DB.base):  # pylint: disable=too-few-public-methods
+    """ Reported feeling older than the retention horizon, moved out of
+    reportedfeelings by nikoniko-archive """
+    __tablename__ = 'reportedfeelings_archive'
+    person_id = Column(
+        Integer,
+        ForeignKey('people.person_id'),
+        primary_key=True)
+    board_id = Column(Integer, ForeignKey('boards.board_id'), primary_key=True)
+    date = Column(Date, primary_key=True)
+    feeling = Column(String(10))
+    # kept from reportedfeelings, for delta syncs to reach the archive too
+    change_seq = Column(Integer, nullable=False, default=0, server_default='0')
+
+    __table_args__ = (
+        Index(
+            'ix_reportedfeelings_archive_board_date',
+            board_id, date, person_id),
+        Index(
+            'ix_reportedfeelings_archive_board_change',
+            board_id, change_seq, person_id, date),
+    )
+
 
 class ReportedFeelingSchema(Schema):  # pylint: disable=too-few-public-methods
     """ Reported Feeling schema definition """
@@ -127,6 +229,14 @@ class Person(DB.base):  # pylint: disable=too-few-public-methods
 
     user = relationship('User', back_populates='person', uselist=False)
 
+    __table_args__ = (
+        # label prefix searches
+        Index('ix_people_label_lower', func.lower(label)),
+    )
+
+
+trigram_index(Person.__table__, 'label')
+
 
 class PersonSchema(Schema):  # pylint: disable=too-few-public-methods
     """ Person schema definition """
@@ -158,6 +268,14 @@ class Board(DB.base):  # pylint: disable=too-few-public-methods
         back_populates='boards')
     reported_feelings = relationship('ReportedFeeling')
 
+    __table_args__ = (
+        # label prefix searches
+        Index('ix_boards_label_lower', func.lower(label)),
+    )
+
+
+trigram_index(Board.__table__, 'label')
+
 
 class BoardSchema(Schema):  # pylint: disable=too-few-public-methods
     """ Board schema definition """
@@ -170,6 +288,26 @@ BOARD_SCHEMA = BoardSchema()
 BOARDS_SCHEMA = BoardSchema(many=True)
 
 
+class BoardSnapshot(DB.base):  # pylint: disable=too-few-public-methods
+    """ Board snapshot entity definition: the board response for the recent
+    window starting on window_start, serialized """
+    __tablename__ = 'boardsnapshots'
+    board_id = Column(Integer, ForeignKey('boards.board_id'), primary_key=True)
+    window_start = Column(Date, nullable=False)
+    document = Column(Text, nullable=False)
+    updated = Column(DateTime, nullable=False)
+
+
+class ChangeSequence(DB.base):  # pylint: disable=too-few-public-methods
+    """ Last change sequence value of each board's reported feelings; its
+    row is locked by every write until commit, so values are handed out in
+    commit order """
+    __tablename__ = 'changesequences'
+    board_id = Column(
+        Integer, ForeignKey('boards.board_id'), primary_key=True)
+    last_change = Column(Integer, nullable=False)
+
+
 class BoardInListSchema(Schema):  # pylint: disable=too-few-public-methods
     """ Board in list schema definition """
     board_id = fields.Int(dump_only=True)
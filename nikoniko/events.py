@@ -0,0 +1,195 @@
+""" Publish board changes to live subscribers (server-sent events)
+
+Event streams stay open for as long as the client watches the board, so
+they are only served from an event loop (the nikoniko.api_async entry
+point): waiting for the next event is a coroutine, not a blocked worker.
+"""
+import asyncio
+import json
+import logging
+import select
+import threading
+import time
+
+NULL_LOGGER = logging.getLogger(__name__)
+NULL_LOGGER.addHandler(logging.NullHandler())
+
+NOTIFY_CHANNEL = 'nikoniko_board_events'
+
+
+class Subscription():  # pylint: disable=too-few-public-methods
+    """Events of a board waiting to be sent to one client"""
+    __slots__ = ('loop', 'queue')
+
+    def __init__(self, max_pending):
+        self.loop = asyncio.get_event_loop()
+        self.queue = asyncio.Queue(max_pending)
+
+    def deliver(self, event):
+        """Queue an event from any thread; drop it if the client lags"""
+        self.loop.call_soon_threadsafe(self._put, event)
+
+    def _put(self, event):
+        try:
+            self.queue.put_nowait(event)
+        except asyncio.QueueFull:
+            pass
+
+
+class MemoryBroker():
+    """Deliver board events to the subscribers living in this process"""
+    __slots__ = ('subscribers', 'lock', 'max_pending')
+
+    def __init__(self, max_pending: int = 1000):
+        self.subscribers = {}
+        self.lock = threading.Lock()
+        self.max_pending = max_pending
+
+    def subscribe(self, board_id):
+        """Return a subscription to the events of a board
+
+        Must be called from the event loop the events will be awaited in.
+        """
+        subscription = Subscription(self.max_pending)
+        with self.lock:
+            self.subscribers.setdefault(board_id, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, board_id, subscription):
+        """Stop delivering events of a board to a subscription"""
+        with self.lock:
+            subscriptions = self.subscribers.get(board_id, set())
+            subscriptions.discard(subscription)
+            if not subscriptions:
+                self.subscribers.pop(board_id, None)
+
+    def publish(self, board_id, event, data):
+        """Hand an event to every subscriber of the board
+
+        Subscribers too slow to keep up lose events instead of making the
+        publisher wait.
+        """
+        with self.lock:
+            subscriptions = list(self.subscribers.get(board_id, ()))
+        for subscription in subscriptions:
+            subscription.deliver((event, data))
+
+
+class PostgresBroker(MemoryBroker):
+    """Deliver board events to the subscribers of every node through
+    PostgreSQL LISTEN/NOTIFY
+
+    A daemon thread LISTENs on its own connection and relays notifications
+    to the subscribers of this process. It is started by the first
+    subscription, so it runs in the worker that serves the stream and
+    never in a pre-fork master, and it reconnects when the DB goes away.
+    """
+    __slots__ = ('engine', 'logger', 'listener', 'reconnect_delay')
+
+    def __init__(
+            self,
+            engine,
+            logger=NULL_LOGGER,
+            max_pending: int = 1000,
+            reconnect_delay: float = 1):
+        super().__init__(max_pending)
+        self.engine = engine
+        self.logger = logger
+        self.listener = None
+        self.reconnect_delay = reconnect_delay
+
+    def subscribe(self, board_id):
+        """Return a subscription to the events of a board, starting the
+        listener if this process has none yet"""
+        with self.lock:
+            if self.listener is None or not self.listener.is_alive():
+                self.listener = threading.Thread(
+                    target=self.listen, daemon=True)
+                self.listener.start()
+        return super().subscribe(board_id)
+
+    def publish(self, board_id, event, data):
+        """NOTIFY the event, to be relayed by the listener of each node"""
+        self.engine.execute(
+            'SELECT pg_notify(%s, %s)',
+            NOTIFY_CHANNEL,
+            json.dumps({'board_id': board_id, 'event': event, 'data': data}))
+
+    def listen(self):
+        """Relay notifications to local subscribers, reconnecting forever"""
+        while True:
+            try:
+                self.relay_notifications()
+            except Exception as exception:  # pylint: disable=broad-except
+                self.logger.error(
+                    'Board events listener failed, reconnecting: %s',
+                    exception)
+            time.sleep(self.reconnect_delay)
+
+    def relay_notifications(self):
+        """LISTEN on a new connection and relay until it fails"""
+        connection = self.engine.raw_connection()
+        try:
+            connection.connection.set_isolation_level(0)  # autocommit
+            connection.cursor().execute('LISTEN {}'.format(NOTIFY_CHANNEL))
+            while True:
+                select.select([connection.connection], [], [], 60)
+                connection.connection.poll()
+                while connection.connection.notifies:
+                    notify = connection.connection.notifies.pop(0)
+                    try:
+                        message = json.loads(notify.payload)
+                        MemoryBroker.publish(
+                            self,
+                            message['board_id'],
+                            message['event'],
+                            message['data'])
+                    except (ValueError, KeyError) as exception:
+                        self.logger.error('Bad board event: %s', exception)
+        finally:
+            connection.invalidate()
+
+
+async def sse_chunks(broker, board_id, keepalive=15):
+    """Encode the events of a board as a server-sent events stream
+
+    A comment is sent every keepalive seconds without events, so proxies
+    keep the connection open.
+    """
+    subscription = broker.subscribe(board_id)
+    try:
+        yield 'retry: {}\n\n'.format(int(keepalive * 1000)).encode()
+        while True:
+            try:
+                event, data = await asyncio.wait_for(
+                    subscription.queue.get(), keepalive)
+            except asyncio.TimeoutError:
+                yield b': keepalive\n\n'
+                continue
+            yield 'event: {}\ndata: {}\n\n'.format(
+                event, json.dumps(data)).encode()
+    finally:
+        broker.unsubscribe(board_id, subscription)
+
+
+class EventStream():
+    """Response stream of the server-sent events of a board
+
+    Only iterable asynchronously: the ASGI adapter recognises it and sends
+    it from the event loop. ``read`` exists so falcon passes the stream on
+    to the server untouched, and refuses to block a synchronous worker.
+    """
+    __slots__ = ('broker', 'board_id', 'keepalive')
+
+    def __init__(self, broker, board_id, keepalive=15):
+        self.broker = broker
+        self.board_id = board_id
+        self.keepalive = keepalive
+
+    def __aiter__(self):
+        return sse_chunks(self.broker, self.board_id, self.keepalive)
+
+    def read(self, size=-1):
+        """Event streams can't be read synchronously"""
+        raise RuntimeError(
+            'Board events are only served by nikoniko.api_async')
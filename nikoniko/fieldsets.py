@@ -0,0 +1,108 @@
+""" Sparse fieldsets: let clients ask for only the fields they need
+
+A ``fields`` parameter such as ``label,people.label`` trims the response to
+those fields and, since the ORM is told which columns to load and the
+endpoints skip the queries of relationships nobody asked for, the DB work
+as well.
+
+Endpoints dumping plain columns skip the ORM altogether: they select the
+projection of the requested fields as tuples and zip them into records.
+"""
+import functools
+
+import falcon
+
+from marshmallow import fields as schema_fields
+from sqlalchemy import inspect
+from sqlalchemy.orm import defaultload, load_only
+
+
+def fieldset(value):
+    """Comma separated field names, nested ones dotted (e.g. people.label)"""
+    requested = frozenset(
+        name.strip() for name in value.split(',') if name.strip())
+    if not requested:
+        raise ValueError('No fields')
+    return requested
+
+
+def check_fields(schema_class, requested, prefix=''):
+    """Raise HTTPBadRequest unless every requested field is in the schema"""
+    # pylint: disable=protected-access
+    declared = schema_class._declared_fields
+    for name in requested:
+        field_name, _, subfield = name.partition('.')
+        field = declared.get(field_name)
+        if field is None or (
+                subfield and not isinstance(field, schema_fields.Nested)):
+            raise falcon.HTTPBadRequest(
+                'Invalid fields',
+                'No field {}{}'.format(prefix, name))
+        if subfield:
+            check_fields(
+                field.nested, [subfield], prefix + field_name + '.')
+
+
+@functools.lru_cache(maxsize=256)
+def sparse_schema(schema_class, requested, many=False):
+    """Return a (cached) schema dumping only the requested fields"""
+    check_fields(schema_class, requested)
+    return schema_class(only=tuple(sorted(requested)), many=many)
+
+
+def dump(schema, obj, requested=None):
+    """Dump obj with schema, or only its requested fields"""
+    if requested is None:
+        return schema.dump(obj).data
+    return sparse_schema(type(schema), requested, schema.many).dump(obj).data
+
+
+def wants(requested, name):
+    """Tell whether a field, or any field nested in it, was requested"""
+    return requested is None or name in requested or any(
+        field.startswith(name + '.') for field in requested)
+
+
+def nested(requested, name):
+    """Return the fields requested inside a nested field, None for all"""
+    if requested is None or name in requested:
+        return None
+    prefix = name + '.'
+    return frozenset(
+        field[len(prefix):] for field in requested
+        if field.startswith(prefix))
+
+
+def columns(model, requested, *always, relationship=None):
+    """Query options loading only the requested columns of model (plus its
+    primary key and the always needed ones), of the entities reached through
+    relationship if given; none to load them all"""
+    if requested is None:
+        return []
+    names = set(always)
+    for attribute in inspect(model).column_attrs:
+        if attribute.key in requested or any(
+                column.primary_key for column in attribute.columns):
+            names.add(attribute.key)
+    if relationship is not None:
+        return [defaultload(relationship).load_only(*sorted(names))]
+    return [load_only(*sorted(names))]
+
+
+@functools.lru_cache(maxsize=256)
+def projection(schema_class, model, requested=None):
+    """Return the names of the fields of schema_class that are columns of
+    model, only the requested ones (checked) if any, in schema order"""
+    if requested is not None:
+        check_fields(schema_class, requested)
+    names = {attribute.key for attribute in inspect(model).column_attrs}
+    # pylint: disable=protected-access
+    return tuple(
+        name for name in schema_class._declared_fields
+        if name in names and (requested is None or name in requested))
+
+
+def records(names, rows):
+    """Return the response dictionaries of rows, keyed by names; values
+    after the named ones are left out"""
+    return [dict(zip(names, row)) for row in rows]
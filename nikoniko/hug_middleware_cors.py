@@ -45,7 +45,7 @@ class CORSMiddleware():
             self,
             request,
             response,
-            resource):  # pylint: disable=unused-argument
+            resource, req_succeeded=True):  # pylint: disable=unused-argument
         """Add CORS headers to the response"""
         response.set_header(
             'Access-Control-Allow-Origin',
@@ -0,0 +1,80 @@
+""" Add a middleware to gzip responses for clients accepting it """
+import zlib
+
+from nikoniko.streaming import IterStream
+
+GZIP_WBITS = 16 + zlib.MAX_WBITS
+
+
+def accepts_gzip(accept_encoding):
+    """Tell whether an Accept-Encoding header value allows gzip"""
+    for coding in (accept_encoding or '').split(','):
+        name, _, params = coding.partition(';')
+        if name.strip().lower() not in ('gzip', '*'):
+            continue
+        quality = params.strip()
+        if quality.startswith('q='):
+            try:
+                return float(quality[2:]) > 0
+            except ValueError:
+                return False
+        return True
+    return False
+
+
+def gzip_chunks(stream, level, chunk_size=64 * 1024):
+    """Compress a file-like stream, yielding gzip chunks as they are ready"""
+    compressor = zlib.compressobj(level, zlib.DEFLATED, GZIP_WBITS)
+    try:
+        while True:
+            data = stream.read(chunk_size)
+            if not data:
+                break
+            compressed = compressor.compress(data)
+            if compressed:
+                yield compressed
+        yield compressor.flush()
+    finally:
+        close = getattr(stream, 'close', None)
+        if close:
+            close()
+
+
+class GzipMiddleware():  # pylint: disable=too-few-public-methods
+    """A middleware gzipping response bodies over a size threshold
+
+    Bodies below min_size are sent as they are, as compressing them would
+    cost more than it saves. Streamed responses are always compressed, on
+    the fly, except event streams, whose events must not wait in the
+    compressor. The default level favours speed over ratio; repetitive JSON
+    shrinks well even at level 1.
+    """
+    __slots__ = ('min_size', 'level')
+
+    def __init__(self, min_size: int = 1024, level: int = 1):
+        """ Initialize the middleware """
+        self.min_size = min_size
+        self.level = level
+
+    def process_response(
+            self,
+            request,
+            response,
+            resource, req_succeeded=True):  # pylint: disable=unused-argument
+        """Compress the response body if the client accepts gzip"""
+        if response.get_header('Content-Encoding') or \
+                response.content_type == 'text/event-stream' or \
+                not accepts_gzip(request.get_header('Accept-Encoding')):
+            return
+        if response.stream is not None:
+            response.stream = IterStream(
+                gzip_chunks(response.stream, self.level))
+        elif response.data and len(response.data) >= self.min_size:
+            compressor = zlib.compressobj(
+                self.level, zlib.DEFLATED, GZIP_WBITS)
+            response.data = \
+                compressor.compress(response.data) + compressor.flush()
+        else:
+            return
+        response.set_header('Content-Encoding', 'gzip')
+        response.append_header('Vary', 'Accept-Encoding')
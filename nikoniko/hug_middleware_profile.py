@@ -0,0 +1,144 @@
+""" Add a middleware to profile requests on demand
+
+Profiles are cProfile dumps that snakeviz or pstats can load, with the SQL
+statements the request ran and their timings in a .sql.json file beside.
+"""
+import contextvars
+import cProfile
+import hashlib
+import hmac
+import json
+import os
+import random
+import re
+import threading
+import time
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+PROFILE_HEADER = 'X-Nikoniko-Profile'
+
+QUERIES = contextvars.ContextVar('nikoniko_profile_queries', default=None)
+
+
+def profile_token(secret, ttl=600):
+    """Return a X-Nikoniko-Profile header value valid for ttl seconds"""
+    expires = str(int(time.time() + ttl))
+    return '{}:{}'.format(expires, hmac.new(
+        secret.encode(), expires.encode(), hashlib.sha256).hexdigest())
+
+
+def valid_token(secret, token):
+    """Tell whether a X-Nikoniko-Profile header value is signed by secret
+    and not expired"""
+    expires, _, signature = (token or '').partition(':')
+    if not secret or not expires.isdigit() or int(expires) < time.time():
+        return False
+    return hmac.compare_digest(signature, hmac.new(
+        secret.encode(), expires.encode(), hashlib.sha256).hexdigest())
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def start_query(conn, cursor, statement, parameters, context, executemany):
+    # pylint: disable=unused-argument,too-many-arguments
+    """Time the statements of profiled requests"""
+    if QUERIES.get() is not None:
+        conn.info.setdefault('nikoniko_profile', []).append(
+            time.perf_counter())
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def end_query(conn, cursor, statement, parameters, context, executemany):
+    # pylint: disable=unused-argument,too-many-arguments
+    """Record the statements of profiled requests, without parameters as
+    they may hold personal data"""
+    queries = QUERIES.get()
+    if queries is not None and conn.info.get('nikoniko_profile'):
+        started = conn.info['nikoniko_profile'].pop()
+        queries.append({
+            'statement': statement,
+            'seconds': time.perf_counter() - started})
+
+
+class ProfileMiddleware():
+    """A middleware running some requests under cProfile
+
+    Profiled requests are those carrying a valid X-Nikoniko-Profile header
+    (see profile_token) and a sample_rate fraction of the others. One
+    request is profiled at a time, and only the keep most recent profiles
+    are kept in directory.
+    """
+    __slots__ = ('directory', 'secret', 'sample_rate', 'keep', 'lock')
+
+    def __init__(
+            self,
+            directory,
+            secret=None,
+            sample_rate: float = 0,
+            keep: int = 100):
+        """ Initialize the middleware; keep must be at least 1 """
+        self.directory = directory
+        self.secret = secret
+        self.sample_rate = sample_rate
+        self.keep = keep
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def process_request(self, request, response):
+        # pylint: disable=unused-argument
+        """Start profiling if the request asks for it or is sampled"""
+        if not valid_token(
+                self.secret, request.get_header(PROFILE_HEADER)) and \
+                random.random() >= self.sample_rate:
+            return
+        if not self.lock.acquire(blocking=False):
+            return
+        profiler = cProfile.Profile()
+        request.context['profile'] = (
+            profiler, QUERIES.set([]), time.time())
+        profiler.enable()
+
+    def process_response(
+            self,
+            request,
+            response,
+            resource, req_succeeded=True):  # pylint: disable=unused-argument
+        """Stop profiling and write the profile out"""
+        profile = request.context.pop('profile', None)
+        if profile is None:
+            return
+        profiler, queries_token, started = profile
+        try:
+            profiler.disable()
+            queries = QUERIES.get()
+            QUERIES.reset(queries_token)
+            name = os.path.join(self.directory, '{}.{:03d}-{}-{}'.format(
+                time.strftime('%Y%m%dT%H%M%S', time.gmtime(started)),
+                int(started * 1000) % 1000,
+                request.method,
+                re.sub(r'[^A-Za-z0-9]+', '_', request.path).strip('_')))
+            profiler.dump_stats(name + '.prof')
+            with open(name + '.sql.json', 'w', encoding='utf-8') as sql:
+                json.dump({
+                    'method': request.method,
+                    'path': request.path,
+                    'status': response.status,
+                    'seconds': time.time() - started,
+                    'queries': queries}, sql, indent=2)
+            self.rotate()
+        finally:
+            self.lock.release()
+
+    def rotate(self):
+        """Remove the oldest profiles beyond the keep most recent"""
+        profiles = sorted(
+            entry for entry in os.listdir(self.directory)
+            if entry.endswith('.prof'))
+        for profile in profiles[:-self.keep]:
+            for suffix in ('.prof', '.sql.json'):
+                try:
+                    os.remove(os.path.join(
+                        self.directory, profile[:-len('.prof')] + suffix))
+                except FileNotFoundError:
+                    pass
@@ -0,0 +1,148 @@
+""" Add a middleware to rate limit expensive unauthenticated endpoints """
+import io
+import json
+import math
+import struct
+import threading
+import time
+
+from urllib.parse import parse_qs
+
+import falcon
+
+MAX_PEEKED_BODY = 64 * 1024
+
+
+class MemoryBackend():  # pylint: disable=too-few-public-methods
+    """Token buckets kept in this process, evicting the least recently used
+    """
+    __slots__ = ('buckets', 'lock', 'max_keys')
+
+    def __init__(self, max_keys: int = 100000):
+        self.buckets = {}
+        self.lock = threading.Lock()
+        self.max_keys = max_keys
+
+    def take(self, key, rate, capacity, now):
+        """Take a token from a bucket; return seconds to wait, 0 if allowed
+        """
+        with self.lock:
+            tokens, last = self.buckets.pop(key, (capacity, now))
+            tokens, wait = take_token(tokens, last, rate, capacity, now)
+            self.buckets[key] = (tokens, now)
+            if len(self.buckets) > self.max_keys:
+                del self.buckets[next(iter(self.buckets))]
+        return wait
+
+
+class UWSGICacheBackend():  # pylint: disable=too-few-public-methods
+    """Token buckets shared by all the workers through a uWSGI cache
+
+    Needs a cache declared in the uWSGI configuration, e.g.
+    ``cache2 = name=ratelimit,items=10000``.
+    """
+    __slots__ = ('uwsgi', 'cache', 'expires')
+    BUCKET = struct.Struct('dd')
+
+    def __init__(self, cache: str = 'ratelimit', expires: int = 3600):
+        import uwsgi  # pylint: disable=import-error
+        self.uwsgi = uwsgi
+        self.cache = cache
+        self.expires = expires
+
+    def take(self, key, rate, capacity, now):
+        """Take a token from a bucket; return seconds to wait, 0 if allowed
+        """
+        self.uwsgi.lock()
+        try:
+            stored = self.uwsgi.cache_get(key, self.cache)
+            tokens, last = self.BUCKET.unpack(stored) if stored \
+                else (capacity, now)
+            tokens, wait = take_token(tokens, last, rate, capacity, now)
+            self.uwsgi.cache_update(
+                key, self.BUCKET.pack(tokens, now), self.expires, self.cache)
+        finally:
+            self.uwsgi.unlock()
+        return wait
+
+
+def take_token(tokens, last, rate, capacity, now):
+    """Refill a bucket up to now and try to take one token from it
+
+    Returns the tokens left and the seconds to wait for the next token, 0
+    when a token was taken.
+    """
+    tokens = min(capacity, tokens + (now - last) * rate)
+    if tokens >= 1:
+        return tokens - 1, 0
+    return tokens, math.ceil((1 - tokens) / rate)
+
+
+class RateLimitMiddleware():
+    """A middleware limiting calls per client IP and per email
+
+    Requests to the limited paths are rejected with 429 Too Many Requests
+    before the endpoint (and so any password hashing, DB access or email
+    sending) runs. The email is looked up in the query string and in JSON
+    or form encoded bodies.
+    """
+    __slots__ = ('backend', 'paths', 'ip_rate', 'ip_burst',
+                 'email_rate', 'email_burst')
+
+    def __init__(  # pylint: disable=too-many-arguments
+            self,
+            backend=None,
+            paths: tuple = ('/login', '/passwordResetCode'),
+            ip_per_minute: float = 30,
+            ip_burst: int = 10,
+            email_per_minute: float = 5,
+            email_burst: int = 5):
+        """ Initialize the middleware """
+        self.backend = backend if backend is not None else MemoryBackend()
+        self.paths = paths
+        self.ip_rate = ip_per_minute / 60
+        self.ip_burst = ip_burst
+        self.email_rate = email_per_minute / 60
+        self.email_burst = email_burst
+
+    @staticmethod
+    def email(request):
+        """Find the email a request is about, without consuming its body"""
+        email = request.get_param('email')
+        length = request.content_length
+        if email or not length or length > MAX_PEEKED_BODY:
+            return email
+        body = request.bounded_stream.read(length)
+        # put the body back for the endpoint: falcon 2 wraps wsgi.input
+        # again if its cached bounded stream is dropped, falcon 1 (and
+        # hug with it) reads request.stream
+        request.env['wsgi.input'] = request.stream = io.BytesIO(body)
+        request._bounded_stream = None  # pylint: disable=protected-access
+        try:
+            if 'json' in (request.content_type or ''):
+                email = json.loads(body.decode()).get('email')
+            else:
+                email = parse_qs(body.decode()).get('email', [None])[0]
+        except (ValueError, AttributeError):
+            return None
+        return email if isinstance(email, str) else None
+
+    def process_request(self, request, response):
+        # pylint: disable=unused-argument
+        """Reject the request if its IP or email ran out of tokens"""
+        if request.method != 'POST' or request.path not in self.paths:
+            return
+        now = time.time()
+        wait = self.backend.take(
+            '{}|ip|{}'.format(request.path, request.remote_addr),
+            self.ip_rate, self.ip_burst, now)
+        email = self.email(request)
+        if not wait and email:
+            wait = self.backend.take(
+                '{}|email|{}'.format(request.path, email.strip().lower()),
+                self.email_rate, self.email_burst, now)
+        if wait:
+            raise falcon.HTTPTooManyRequests(
+                'Too many requests',
+                'Try again in {} seconds'.format(wait),
+                retry_after=wait)
@@ -0,0 +1,67 @@
+""" Add a middleware giving each request an id and a structured log record
+"""
+import logging
+import random
+import re
+import time
+import uuid
+
+from nikoniko.logs import REQUEST
+
+ACCESS_LOGGER = logging.getLogger('nikoniko.access')
+REQUEST_ID = re.compile(r'^[A-Za-z0-9._-]{1,64}$')
+
+
+class RequestLogMiddleware():
+    """A middleware tagging the log records of each request with its id
+
+    The id is taken from an X-Request-ID header set by a proxy, or made up,
+    and sent back. Only a debug_sample_rate fraction of the requests keep
+    their debug records. With log_requests, every request also gets an
+    INFO record with its method, path, status and duration as fields.
+    """
+    __slots__ = ('debug_sample_rate', 'log_requests')
+
+    def __init__(
+            self,
+            debug_sample_rate: float = 1,
+            log_requests: bool = False):
+        """ Initialize the middleware """
+        self.debug_sample_rate = debug_sample_rate
+        self.log_requests = log_requests
+        if log_requests and not ACCESS_LOGGER.isEnabledFor(logging.INFO):
+            ACCESS_LOGGER.setLevel(logging.INFO)
+
+    def process_request(self, request, response):
+        """Make the request current for logging"""
+        request_id = request.get_header('X-Request-ID')
+        if not request_id or not REQUEST_ID.match(request_id):
+            request_id = uuid.uuid4().hex
+        response.set_header('X-Request-ID', request_id)
+        request.context['log_request'] = (
+            REQUEST.set({
+                'request_id': request_id,
+                'debug': random.random() < self.debug_sample_rate}),
+            time.perf_counter())
+
+    def process_response(
+            self,
+            request,
+            response,
+            resource, req_succeeded=True):  # pylint: disable=unused-argument
+        """Log the request if asked to, and forget it"""
+        token, started = request.context.pop('log_request', (None, None))
+        if token is None:
+            return
+        if self.log_requests:
+            duration = time.perf_counter() - started
+            ACCESS_LOGGER.info(
+                '%s %s %s %.1fms',
+                request.method, request.path, response.status,
+                duration * 1000,
+                extra={'fields': {
+                    'method': request.method,
+                    'path': request.path,
+                    'status': int(response.status.split()[0]),
+                    'duration_ms': round(duration * 1000, 3)}})
+        REQUEST.reset(token)
@@ -0,0 +1,74 @@
+""" Add a middleware to serve each request from the DB of its tenant """
+import falcon
+import jwt
+
+from nikoniko.tenancy import TENANT, UnknownTenant
+
+
+class TenantMiddleware():
+    """A middleware resolving the tenant of each request
+
+    The tenant is the ``tenant`` claim of the token or, for requests
+    without one such as logins, the subdomain of the Host header under
+    base_domain. A token is only valid on its own tenant's host.
+    """
+    __slots__ = ('router', 'secret_key', 'base_domain')
+
+    def __init__(self, router, secret_key, base_domain=None):
+        """ Initialize the middleware """
+        self.router = router
+        self.secret_key = secret_key
+        self.base_domain = base_domain
+
+    def host_tenant(self, request):
+        """Return the subdomain of the request host, if any"""
+        if not self.base_domain:
+            return None
+        host = request.host.lower()
+        suffix = '.' + self.base_domain.lower()
+        return host[:-len(suffix)] if host.endswith(suffix) else None
+
+    def token_tenant(self, request):
+        """Return the tenant claim of a valid token, if any; invalid tokens
+        are left for authentication to reject"""
+        token = request.get_header('Authorization') or \
+            request.get_param('token')
+        if not token:
+            return None
+        try:
+            claims = jwt.decode(token, self.secret_key, algorithm='HS256')
+        except jwt.InvalidTokenError:
+            return None
+        return claims.get('tenant')
+
+    def process_request(self, request, response):
+        # pylint: disable=unused-argument
+        """Find the tenant and make it current for the request"""
+        if request.method == 'OPTIONS':
+            return
+        host_tenant = self.host_tenant(request)
+        tenant = self.token_tenant(request) or host_tenant
+        if host_tenant and tenant != host_tenant:
+            raise falcon.HTTPForbidden(
+                'Wrong tenant', 'The token belongs to another tenant')
+        try:
+            self.router.check(tenant)
+        except UnknownTenant as exception:
+            raise falcon.HTTPNotFound(
+                title='Unknown tenant',
+                description='No tenant {}'.format(tenant)) from exception
+        request.context['tenant_token'] = TENANT.set(tenant)
+
+    def process_response(
+            self,
+            request,
+            response,
+            resource, req_succeeded=True):  # pylint: disable=unused-argument
+        """Release the tenant session, unless a streamed body still needs
+        it, and forget the tenant"""
+        token = request.context.pop('tenant_token', None)
+        if token is None:
+            return
+        if response.stream is None:
+            self.router.session.remove()
+        TENANT.reset(token)
@@ -0,0 +1,246 @@
+""" Command line bulk importer for historical reported feelings
+
+Reads CSV files with the same columns the board export produces
+(board_id, person_id, date, feeling), validates them, stages the rows in a
+temporary table (COPY on PostgreSQL, multi-row INSERTs elsewhere) and merges
+them into ``reportedfeelings`` and ``membership`` in a single transaction.
+"""
+import argparse
+import csv
+import io
+import logging
+import sys
+import time
+
+from datetime import datetime
+
+from sqlalchemy import Column, Integer, String, Date
+from sqlalchemy import MetaData, Table
+from sqlalchemy import and_, exists, func, select
+from sqlalchemy.dialects import postgresql
+
+from nikoniko.entities import DB, Board, Person, ReportedFeeling, MEMBERSHIP
+from nikoniko.changes import bump_changes, current_change
+from nikoniko.entities import ArchivedFeeling, BoardSnapshot
+from nikoniko.settings import db_connstring_from_environment
+
+COLUMNS = ('board_id', 'person_id', 'date', 'feeling')
+FEELING_MAX_LENGTH = ReportedFeeling.__table__.c.feeling.type.length
+INSERT_BATCH_ROWS = 500
+
+STAGING = Table(
+    'reportedfeelings_import',
+    MetaData(),
+    # rows are unique once parsed; the key indexes the merge lookups
+    Column('board_id', Integer, primary_key=True),
+    Column('person_id', Integer, primary_key=True),
+    Column('date', Date, primary_key=True),
+    Column('feeling', String(FEELING_MAX_LENGTH)),
+    prefixes=['TEMPORARY'])
+
+
+class InvalidInput(Exception):
+    """ Raised when the input can't be imported; carries every problem """
+    def __init__(self, problems):
+        super().__init__('\n'.join(problems))
+        self.problems = problems
+
+
+def parse_rows(csvfile, board_ids, person_ids):
+    """Validate CSV input and return the rows to import, keyed by row id
+
+    Later lines win over earlier ones for the same board, person and date,
+    as they would had they been POSTed one after the other.
+    """
+    reader = csv.DictReader(csvfile)
+    missing = set(COLUMNS) - set(reader.fieldnames or ())
+    if missing:
+        raise InvalidInput(
+            ['Missing columns: {}'.format(', '.join(sorted(missing)))])
+    rows = {}
+    problems = []
+    for line, record in enumerate(reader, start=2):
+        try:
+            board_id = int(record['board_id'])
+            person_id = int(record['person_id'])
+            date = datetime.strptime(record['date'], '%Y-%m-%d').date()
+        except (TypeError, ValueError) as exception:
+            problems.append('line {}: {}'.format(line, exception))
+            continue
+        feeling = record['feeling'] or ''
+        if not feeling or len(feeling) > FEELING_MAX_LENGTH:
+            problems.append('line {}: invalid feeling [{}]'.format(
+                line, feeling))
+        elif board_id not in board_ids:
+            problems.append('line {}: unknown board {}'.format(
+                line, board_id))
+        elif person_id not in person_ids:
+            problems.append('line {}: unknown person {}'.format(
+                line, person_id))
+        else:
+            rows[(board_id, person_id, date)] = feeling
+    if problems:
+        raise InvalidInput(problems)
+    return rows
+
+
+def stage_rows(connection, rows):
+    """Load the validated rows into the temporary staging table"""
+    STAGING.create(connection)
+    if connection.dialect.name == 'postgresql':
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        for (board_id, person_id, date), feeling in rows.items():
+            writer.writerow((board_id, person_id, date.isoformat(), feeling))
+        buffer.seek(0)
+        cursor = connection.connection.cursor()
+        cursor.copy_expert(
+            'COPY {} ({}) FROM STDIN WITH CSV'.format(
+                STAGING.name, ', '.join(COLUMNS)),
+            buffer)
+        return
+    insert = STAGING.insert()  # pylint: disable=no-value-for-parameter
+    batch = []
+    for (board_id, person_id, date), feeling in rows.items():
+        batch.append(dict(
+            board_id=board_id, person_id=person_id, date=date,
+            feeling=feeling))
+        if len(batch) >= INSERT_BATCH_ROWS:
+            connection.execute(insert.values(batch))
+            batch = []
+    if batch:
+        connection.execute(insert.values(batch))
+
+
+def merge_staged(connection):
+    """Merge the staging table into membership and reportedfeelings
+
+    PostgreSQL upserts with INSERT ... ON CONFLICT; elsewhere rows are
+    updated then inserted, each lookup going through the staging key.
+    Returns how many memberships were added and how many feelings were
+    updated and inserted.
+    """
+    feelings = ReportedFeeling.__table__
+    same_key = and_(
+        feelings.c.board_id == STAGING.c.board_id,
+        feelings.c.person_id == STAGING.c.person_id,
+        feelings.c.date == STAGING.c.date)
+    new_memberships = (
+        select([STAGING.c.person_id, STAGING.c.board_id])
+        .distinct()
+        .where(~exists().where(and_(
+            MEMBERSHIP.c.person_id == STAGING.c.person_id,
+            MEMBERSHIP.c.board_id == STAGING.c.board_id))))
+    memberships = connection.execute(
+        MEMBERSHIP.insert()  # pylint: disable=no-value-for-parameter
+        .from_select(['person_id', 'board_id'], new_memberships)).rowcount
+    updated = connection.execute(
+        select([func.count()]).select_from(
+            STAGING.join(feelings, same_key))).scalar()
+    # every row of a board imported is one change of it
+    bump_changes(connection, STAGING)
+    staged = [STAGING.c[column] for column in COLUMNS] + [
+        current_change(STAGING.c.board_id)]
+    if connection.dialect.name == 'postgresql':
+        connection.execute('ANALYZE {}'.format(STAGING.name))
+        upsert = postgresql.insert(feelings).from_select(
+            list(COLUMNS) + ['change_seq'], select(staged))
+        connection.execute(upsert.on_conflict_do_update(
+            index_elements=[feelings.c.person_id, feelings.c.board_id,
+                            feelings.c.date],
+            set_={'feeling': upsert.excluded.feeling,
+                  'change_seq': upsert.excluded.change_seq}))
+        inserted = connection.execute(
+            select([func.count()]).select_from(STAGING)).scalar() - updated
+    else:
+        connection.execute(
+            feelings.update()
+            .values(feeling=select([STAGING.c.feeling])
+                    .where(same_key).as_scalar(),
+                    change_seq=current_change(feelings.c.board_id))
+            .where(exists().where(same_key)))
+        inserted = connection.execute(feelings.insert().from_select(
+            list(COLUMNS) + ['change_seq'],
+            select(staged).where(~exists().where(same_key)))).rowcount
+    # imported feelings replace archived ones
+    archive = ArchivedFeeling.__table__
+    connection.execute(archive.delete().where(exists().where(and_(
+        archive.c.board_id == STAGING.c.board_id,
+        archive.c.person_id == STAGING.c.person_id,
+        archive.c.date == STAGING.c.date))))
+    # the API rebuilds the snapshots of the imported boards when next read
+    connection.execute(BoardSnapshot.__table__.delete().where(
+        BoardSnapshot.board_id.in_(select([STAGING.c.board_id]).distinct())))
+    STAGING.drop(connection)
+    return memberships, updated, inserted
+
+
+def import_feelings(engine, csvfiles):
+    """Import CSV files of reported feelings into the DB in one transaction
+
+    Returns a report dictionary with row counts and timings.
+    """
+    started = time.perf_counter()
+    with engine.begin() as connection:
+        board_ids = {board_id for (board_id,) in connection.execute(
+            select([Board.board_id]))}
+        person_ids = {person_id for (person_id,) in connection.execute(
+            select([Person.person_id]))}
+        rows = {}
+        for csvfile in csvfiles:
+            rows.update(parse_rows(csvfile, board_ids, person_ids))
+        parsed = time.perf_counter()
+        stage_rows(connection, rows)
+        staged = time.perf_counter()
+        memberships, updated, inserted = merge_staged(connection)
+    finished = time.perf_counter()
+    return dict(
+        rows=len(rows),
+        memberships=memberships,
+        updated=updated,
+        inserted=inserted,
+        parse_seconds=parsed - started,
+        stage_seconds=staged - parsed,
+        merge_seconds=finished - staged,
+        total_seconds=finished - started)
+
+
+def format_report(report):
+    """Render the throughput report of an import"""
+    rate = report['rows'] / report['total_seconds'] \
+        if report['total_seconds'] else 0
+    return (
+        'Imported {rows} rows ({inserted} new, {updated} updated, '
+        '{memberships} memberships added)\n'
+        'parse {parse_seconds:.3f}s, stage {stage_seconds:.3f}s, '
+        'merge {merge_seconds:.3f}s, total {total_seconds:.3f}s '
+        '({rate:.0f} rows/s)').format(rate=rate, **report)
+
+
+def main(argv=None):
+    """Entry point of the nikoniko-import command"""
+    parser = argparse.ArgumentParser(
+        description='Bulk import reported feelings from CSV files')
+    parser.add_argument(
+        'csvfiles', nargs='+', type=argparse.FileType('r'),
+        help='CSV files with board_id, person_id, date and feeling columns')
+    parser.add_argument(
+        '--db', default=None,
+        help='DB connection string (defaults to the DB_* environment)')
+    args = parser.parse_args(argv)
+    logging.basicConfig()
+    database = DB(args.db or db_connstring_from_environment())
+    database.create_all()
+    try:
+        report = import_feelings(database.engine, args.csvfiles)
+    except InvalidInput as exception:
+        print('Nothing imported:', file=sys.stderr)
+        for problem in exception.problems:
+            print(problem, file=sys.stderr)
+        return 1
+    print(format_report(report))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
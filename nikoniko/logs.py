@@ -0,0 +1,85 @@
+""" Log through a queue, so that handlers format and write log records in a
+thread of their own instead of the request threads
+
+Records carry the id of the request they were logged for and, to keep
+debug logging affordable in production, the debug records of only a
+sample of the requests are kept.
+"""
+import atexit
+import contextvars
+import json
+import logging
+import queue
+
+from logging.handlers import QueueHandler, QueueListener
+
+TEXT_FORMAT = \
+    '%(asctime)s %(levelname)s %(name)s [%(request_id)s] %(message)s'
+
+# SQL statements are logged at INFO, but cost as much as debug logging
+DEBUG_LOGGERS = ('sqlalchemy.engine',)
+
+REQUEST = contextvars.ContextVar('nikoniko_log_request', default=None)
+
+
+class RequestFilter(logging.Filter):  # pylint: disable=too-few-public-methods
+    """Tag records with their request id, dropping the debug records of
+    requests not sampled for debug logging"""
+
+    def filter(self, record):
+        request = REQUEST.get()
+        record.request_id = request['request_id'] if request else '-'
+        if not request or request['debug']:
+            return True
+        return record.levelno >= logging.INFO and \
+            not record.name.startswith(DEBUG_LOGGERS)
+
+
+class JSONFormatter(logging.Formatter):
+    """Format records as one JSON object per line, including the fields of
+    structured records (logged with extra={'fields': {...}})"""
+
+    def format(self, record):
+        entry = {
+            'time': self.formatTime(record),
+            'level': record.levelname,
+            'logger': record.name,
+            'request_id': getattr(record, 'request_id', '-'),
+            'message': record.getMessage()}
+        entry.update(getattr(record, 'fields', {}))
+        return json.dumps(entry, default=str)
+
+
+class QueueLogging():
+    """Route every log record through a queue to a stream handler run by a
+    listener thread"""
+    __slots__ = ('queue_handler', 'listener')
+
+    def __init__(self, json_format=False):
+        log_queue = queue.SimpleQueue()
+        handler = logging.StreamHandler()
+        handler.setFormatter(
+            JSONFormatter() if json_format else
+            logging.Formatter(TEXT_FORMAT))
+        self.queue_handler = QueueHandler(log_queue)
+        self.queue_handler.addFilter(RequestFilter())
+        self.listener = QueueListener(log_queue, handler)
+
+    def start(self):
+        """Make the queue the only handler of the root logger"""
+        logging.getLogger().handlers[:] = [self.queue_handler]
+        self.listener.start()
+        atexit.register(self.stop)
+
+    def stop(self):
+        """Write out the queued records and stop the listener"""
+        if self.listener._thread:  # pylint: disable=protected-access
+            self.listener.stop()
+
+    def restart_after_fork(self):
+        """Start a listener in a forked child, where the parent's listener
+        thread doesn't exist, on a fresh queue"""
+        log_queue = queue.SimpleQueue()
+        self.queue_handler.queue = self.listener.queue = log_queue
+        self.listener._thread = None  # pylint: disable=protected-access
+        self.listener.start()
@@ -1,37 +1,76 @@
 """
 Provide an API to manage happiness logs (nikoniko) for teams
 """
+# pylint: disable=too-many-lines
+import io
+import json
 import logging
 import uuid
 
-from datetime import datetime, timedelta
+from datetime import date as calendar_date, datetime, timedelta
 from smtplib import SMTP_SSL, SMTPException
 
 import hug
 import jwt
 import bcrypt
 
+from sqlalchemy import and_, exists, func, literal, select
 from sqlalchemy.orm.exc import NoResultFound
-from sqlalchemy.exc import InvalidRequestError, StatementError
+from sqlalchemy.exc import InvalidRequestError
+from sqlalchemy.exc import StatementError
+from falcon import HTTP_400
 from falcon import HTTP_409
 from falcon import HTTP_404
 from falcon import HTTP_401
 from falcon import HTTP_403
 from falcon import HTTP_204
+from falcon import HTTP_501
 
 from nikoniko.entities import User, USER_SCHEMA
 from nikoniko.entities import USERPROFILE_SCHEMA
-from nikoniko.entities import Person, PERSON_SCHEMA, PEOPLE_SCHEMA
-from nikoniko.entities import Board, BOARD_SCHEMA, BOARDS_SCHEMA
+from nikoniko.entities import Person, PersonSchema, PersonInBoardSchema
+from nikoniko.entities import PEOPLE_SCHEMA
+from nikoniko.entities import Board, BoardSchema, BoardInListSchema
+from nikoniko.entities import BOARD_SCHEMA
+from nikoniko.entities import MEMBERSHIP
+from nikoniko.entities import BoardSnapshot
+from nikoniko.entities import ArchivedFeeling
 from nikoniko.entities import ReportedFeeling, REPORTEDFEELING_SCHEMA
+from nikoniko.entities import REPORTEDFEELINGS_SCHEMA
 from nikoniko.entities import InvalidatedToken
 from nikoniko.entities import PasswordResetCode
 
+from nikoniko.analytics import feeling_matrix, mood_metrics, plain
+from nikoniko.asgi import ASYNC_ENVIRON_KEY
+from nikoniko.changes import change_cursor, encode_cursor, lock_changes
+from nikoniko.changes import next_change
+from nikoniko.events import MemoryBroker, EventStream
+from nikoniko.fieldsets import fieldset, columns, dump, nested, wants
+from nikoniko.fieldsets import projection, records
 from nikoniko.hug_middleware_cors import CORSMiddleware
+from nikoniko.hug_middleware_gzip import GzipMiddleware
+from nikoniko.hug_middleware_profile import ProfileMiddleware
+from nikoniko.hug_middleware_ratelimit import RateLimitMiddleware
+from nikoniko.hug_middleware_requestlog import RequestLogMiddleware
+from nikoniko.hug_middleware_tenant import TenantMiddleware
+from nikoniko.queries import lookup, lookup_columns
+from nikoniko.retention import changes_select, feelings_select, last_archived
+from nikoniko.retention import merge_feelings, ordered_feelings_selects
+from nikoniko.retention import reaches_archive
+from nikoniko.retention import unarchive
+from nikoniko.search import MAX_SEARCH_RESULTS, label_search, search_term
+from nikoniko.streaming import IterStream, EXPORT_FORMATS, EXPORT_CHUNK_ROWS
+from nikoniko.tenancy import board_channel, current_tenant
 
 NULL_LOGGER = logging.getLogger(__name__)
 NULL_LOGGER.addHandler(logging.NullHandler())
 
+MAX_BATCH_IDS = 500
+MAX_CHANGES = 1000
+SNAPSHOT_DAYS = 28
+MAX_ANALYTICS_DAYS = 3 * 366
+MAX_BATCH_DAYS = 366
+
 
 def return_unauthorised(response, email, exception=None):
     """Update the response to mean unauthorised access"""
@@ -53,8 +92,43 @@ def check_password(user, password):
     return bcrypt.checkpw(password.encode(), user.password_hash)
 
 
+def iso_date(value):
+    """A date as YYYY-MM-DD"""
+    return datetime.strptime(value, '%Y-%m-%d').date()
+
+
+def snapshot_window():
+    """Return the first and last days of the board snapshots' window: the
+    last 4 weeks, today included"""
+    today = calendar_date.today()
+    return today - timedelta(days=SNAPSHOT_DAYS - 1), today
+
+
+def id_list(value):
+    """Comma separated ids, at most 500"""
+    if isinstance(value, list):  # the parameter was repeated
+        value = ','.join(value)
+    ids = sorted({int(item) for item in value.split(',') if item.strip()})
+    if not ids or len(ids) > MAX_BATCH_IDS:
+        raise ValueError('Between 1 and {} ids'.format(MAX_BATCH_IDS))
+    return ids
+
+
+@hug.authentication.authenticator
+def token_or_query_parameter(request, response, verify_user, **kwargs):
+    # pylint: disable=unused-argument
+    """Token verification from the Authorization header or, for clients
+    that can't set headers such as browsers' EventSource, a token query
+    parameter"""
+    token = request.get_header('Authorization') or request.get_param('token')
+    if token:
+        return verify_user(token) or False
+    return None
+
+
 class NikonikoAPI:
     """Wrapper around hug API for initialization, testing, etc."""
+    # pylint: disable=too-many-public-methods,too-many-instance-attributes
     def token_verify(self, token):
         """hug authentication token verification function"""
         self.logger.debug('Token: %s', token)
@@ -65,8 +139,7 @@ class NikonikoAPI:
         except jwt.DecodeError:
             return False
         try:
-            self.session.query(
-                InvalidatedToken).filter_by(token=token).one()
+            lookup(self.session, InvalidatedToken, {'token': token}).one()
             return False
         except NoResultFound:
             return decoded_token
@@ -74,20 +147,21 @@ class NikonikoAPI:
     def login(self, email: hug.types.text, password: hug.types.text, response):
         """Authenticates and returns a token"""
         try:
-            user = self.session.query(User).filter_by(email=email).one()
+            user = lookup(self.session, User, {'email': email}).one()
             if check_password(user, password):
                 created = datetime.now()
+                claims = {
+                    'user': user.user_id,
+                    'created': created.isoformat(),
+                    'exp': (created + timedelta(days=1)).timestamp()
+                }
+                if current_tenant():
+                    claims['tenant'] = current_tenant()
                 return {
                     'user': user.user_id,
                     'person': user.person_id,
                     'token': jwt.encode(
-                        {
-                            'user': user.user_id,
-                            'created': created.isoformat(),
-                            'exp':
-                                (created +
-                                 timedelta(days=1)).timestamp()
-                        },
+                        claims,
                         self.secret_key,
                         algorithm='HS256'
                     )}
@@ -98,7 +172,7 @@ class NikonikoAPI:
     def password_reset_code(self, email: hug.types.text):
         """ create a password reset code and send it to the user if exists """
         try:
-            user = self.session.query(User).filter_by(email=email).one()
+            user = lookup(self.session, User, {'email': email}).one()
             code = uuid.uuid4()
             code_object = PasswordResetCode(
                 user_id=user.user_id,
@@ -113,7 +187,18 @@ class NikonikoAPI:
 
     def email_password_reset_code(self, email, code):
         """ Emails a uuid code to an email """
-        self.sendmail(email, code.__str__())
+        if self.mail_executor:
+            self.mail_executor.submit(
+                self.sendmail, email, code.__str__()).add_done_callback(
+                    self.log_mail_failure)
+        else:
+            self.sendmail(email, code.__str__())
+
+    def log_mail_failure(self, future):
+        """ Log what made a mail sent in the background fail, if anything """
+        exception = future.exception()
+        if exception:
+            self.logger.error('Mail not sent: %r', exception)
 
     def sendmail(self, receiver, message):
         """ send an email to a receiver """
@@ -191,38 +276,45 @@ class NikonikoAPI:
         return 'Password updated'
 
     def get_user(self, user_id: hug.types.number, response,
-                 authenticated_user: hug.directives.user):
-        """Returns a user"""
+                 authenticated_user: hug.directives.user,
+                 fields: fieldset = None):
+        """Returns a user, or only the requested fields of it"""
         self.logger.debug(
             'Authenticated user reported: %s', authenticated_user)
         try:
-            res = self.session.query(User).filter_by(user_id=user_id).one()
-            boards = self.session.query(
-                Board).join(
-                    Person.boards).filter(
-                        Person.person_id == res.person_id).all()
-            res.boards = boards
+            res = lookup(
+                self.session, User, {'user_id': user_id},
+                fields, ('person_id',)).one()
+            if wants(fields, 'boards'):
+                boards = self.session.query(
+                    Board).options(
+                        *columns(Board, nested(fields, 'boards'))).join(
+                            Person.boards).filter(
+                                Person.person_id == res.person_id).all()
+                res.boards = boards
         except NoResultFound as exception:
             self.logger.debug('User not found: %s', exception)
             response.status = HTTP_404
             return None
-        return USER_SCHEMA.dump(res).data
+        return dump(USER_SCHEMA, res, fields)
 
     def get_user_profile(
             self,
             user_id: hug.types.number,
             response,
-            authenticated_user: hug.directives.user):
-        """Returns a user profile"""
+            authenticated_user: hug.directives.user,
+            fields: fieldset = None):
+        """Returns a user profile, or only the requested fields of it"""
         self.logger.debug(
             'Authenticated user reported: %s', authenticated_user)
         try:
-            res = self.session.query(User).filter_by(user_id=user_id).one()
+            res = lookup(
+                self.session, User, {'user_id': user_id}, fields).one()
         except NoResultFound as exception:
             self.logger.error('User not found: %s', exception)
             response.status = HTTP_404
             return None
-        return USERPROFILE_SCHEMA.dump(res).data
+        return dump(USERPROFILE_SCHEMA, res, fields)
 
     def patch_user_profile(  # pylint: disable=too-many-arguments
             self,
@@ -272,58 +364,475 @@ class NikonikoAPI:
             timestamp_invalidated=datetime.now())
         self.session.add(invalidated_token)
 
-    def get_person(self, person_id: hug.types.number, response):
-        """Returns a person"""
+    def get_person(
+            self,
+            person_id: hug.types.number,
+            response,
+            fields: fieldset = None):
+        """Returns a person, or only the requested fields of it"""
+        names = projection(PersonSchema, Person, fields)
         try:
-            res = self.session.query(
-                Person).filter_by(person_id=person_id).one()
+            res = lookup_columns(
+                self.session, Person, names, {'person_id': person_id}).one()
         except NoResultFound:
             response.status = HTTP_404
             return None
-        return PERSON_SCHEMA.dump(res).data
+        return dict(zip(names, res))
 
-    def people(self):
-        """Returns all the people"""
-        res = self.session.query(Person).all()
-        return PEOPLE_SCHEMA.dump(res).data
+    def people(self, fields: fieldset = None):
+        """Returns all the people, or only the requested fields of them"""
+        names = projection(PersonSchema, Person, fields)
+        return records(names, self.session.query(
+            *(getattr(Person, name) for name in names)))
 
-    def board(self, board_id: hug.types.number, response):
-        """Returns a board"""
+    def search_people(
+            self,
+            q: search_term,  # pylint: disable=invalid-name
+            limit: hug.types.in_range(1, MAX_SEARCH_RESULTS + 1) = 20,
+            fields: fieldset = None):
+        """Returns at most limit people whose label matches q, or only the
+        requested fields of them"""
+        names = projection(PersonSchema, Person, fields)
+        return records(names, self.search(Person, names, q).limit(limit))
+
+    def search(self, model, names, term):
+        """Return a query of the names columns of the model rows whose label
+        matches a search term"""
+        return label_search(
+            self.session.query(*(getattr(model, name) for name in names)),
+            model.label, term, self.session.get_bind().dialect.name)
+
+    def people_batch(self, ids: id_list, fields: fieldset = None):
+        """Returns the people with the given ids, in one query, and the ids
+        not found"""
+        res = self.session.query(Person).options(
+            *columns(Person, fields)).filter(
+                Person.person_id.in_(ids)).order_by(Person.person_id).all()
+        found = {person.person_id for person in res}
+        return {
+            'people': dump(PEOPLE_SCHEMA, res, fields),
+            'missing': [
+                person_id for person_id in ids if person_id not in found]}
+
+    def board(
+            self,
+            board_id: hug.types.number,
+            response,
+            from_date: iso_date = None,
+            to_date: iso_date = None,
+            fields: fieldset = None):
+        """Returns a board with its reported feelings, optionally only those
+        between from_date and to_date (inclusive) and the requested fields
+        """
+        window_start, today = snapshot_window()
+        if from_date == window_start and to_date in (None, today) and \
+                fields is None:
+            return self.board_snapshot(board_id, response)
+        variant = '{}:{}:{}'.format(
+            from_date or '', to_date or '', ','.join(sorted(fields or ())))
+        cache_key = self.cache.key(board_channel(board_id), variant) \
+            if self.cache else None
+        if cache_key:
+            cached = self.cache.get(cache_key)
+            if cached is not None:
+                return cached
+        result = self.coalesced(
+            board_id, variant,
+            lambda: self.board_payload(board_id, from_date, to_date, fields))
+        if result is None:
+            response.status = HTTP_404
+            return None
+        if cache_key:
+            self.cache.set(cache_key, result)
+        return result
+
+    def board_payload(self, board_id, from_date, to_date, fields=None):
+        """Query and serialize a board, None if it doesn't exist"""
+        people_fields = nested(fields, 'people')
         try:
-            res = self.session.query(Board).filter_by(board_id=board_id).one()
-            for person in res.people:
-                reportedfeelings = self.session.query(
-                    ReportedFeeling).filter(
-                        ReportedFeeling.board_id == board_id).filter(
-                            ReportedFeeling.person_id ==
-                            person.person_id).all()
-                person.reportedfeelings = reportedfeelings
+            res = self.session.query(Board).options(
+                *columns(Board, fields),
+                *columns(Person, people_fields, relationship=Board.people)
+            ).filter_by(board_id=board_id).one()
         except NoResultFound:
+            return None
+        if wants(people_fields, 'reportedfeelings'):
+            by_person = {person.person_id: [] for person in res.people}
+            for feeling in self.session.execute(feelings_select(
+                    board_id, from_date, to_date,
+                    archive=self.reaches_archive(board_id, from_date))):
+                if feeling.person_id in by_person:
+                    by_person[feeling.person_id].append(feeling)
+            for person in res.people:
+                person.reportedfeelings = by_person[person.person_id]
+        return dump(BOARD_SCHEMA, res, fields)
+
+    def board_snapshot(self, board_id, response):
+        """Returns the stored response for the recent window of a board,
+        building it first if missing or of a past window"""
+        document = self.coalesced(
+            board_id, 'snapshot', lambda: self.snapshot_document(board_id))
+        if document is None:
+            response.status = HTTP_404
+            return None
+        # already JSON: hug passes file-like results through untouched
+        return io.BytesIO(document.encode())
+
+    def snapshot_document(self, board_id):
+        """Return the JSON document of the snapshot of a board, building it
+        first if missing or of a past window; None if there's no board"""
+        window_start, _ = snapshot_window()
+        snapshot = self.session.query(BoardSnapshot).get(board_id)
+        if snapshot is None or snapshot.window_start != window_start:
+            snapshot = self.refresh_board_snapshot(board_id)
+            if snapshot is None:
+                self.session.rollback()
+                return None
+            self.session.commit()
+        return snapshot.document
+
+    def coalesced(self, board_id, variant, compute):
+        """Return what compute returns for a variant of a board's response,
+        sharing it with the identical reads in flight if coalescing"""
+        if self.flights is None:
+            return compute()
+        return self.flights.run((board_channel(board_id), variant), compute)
+
+    def refresh_board_snapshot(self, board_id):
+        """Rebuilds the snapshot of the recent window of a board within the
+        current transaction; call it before committing changes to its
+        reported feelings or members. Returns None if there's no board
+
+        It holds the lock of the board's change sequence, so that snapshot
+        writes, reads' rebuilds included, wait for each other and for
+        writes of feelings, and build from what those committed.
+        """
+        if not lock_changes(self.session, board_id):
+            return None
+        window_start, today = snapshot_window()
+        document = self.board_payload(board_id, window_start, today)
+        if document is None:
+            return None
+        return self.session.merge(BoardSnapshot(
+            board_id=board_id,
+            window_start=window_start,
+            document=json.dumps(document),
+            updated=datetime.now()))
+
+    def reaches_archive(self, board_id, from_date):
+        """Tell whether reads of the reported feelings of a board from
+        from_date on (from the beginning if None) must include archived ones
+        """
+        return reaches_archive(
+            from_date, self.session.execute(last_archived(board_id)).scalar())
+
+    def invalidate_board(self, board_id):
+        """Drops the cached responses of a board; call it after committing
+        changes to its reported feelings or members, and makes later reads
+        of it start afresh rather than share those in flight"""
+        if self.cache:
+            self.cache.invalidate(board_channel(board_id))
+        if self.flights:
+            self.flights.forget(board_channel(board_id))
+
+    def add_board_members(
+            self,
+            board_id: hug.types.number,
+            ids: id_list,
+            response):
+        """Adds the people with the given ids to a board, in one statement
+        and transaction; returns how many were added (the others being
+        members already) and the ids of no one"""
+        if not self.session.query(
+                Board.board_id).filter_by(board_id=board_id).count():
+            response.status = HTTP_404
+            return None
+        found = {person_id for (person_id,) in self.session.query(
+            Person.person_id).filter(Person.person_id.in_(ids))}
+        new_members = select([Person.person_id, literal(board_id)]).where(
+            Person.person_id.in_(ids)).where(~exists().where(and_(
+                MEMBERSHIP.c.person_id == Person.person_id,
+                MEMBERSHIP.c.board_id == board_id)))
+        added = self.session.execute(
+            MEMBERSHIP.insert()  # pylint: disable=no-value-for-parameter
+            .from_select(['person_id', 'board_id'], new_members)).rowcount
+        self.commit_members(board_id, added)
+        return {
+            'added': added,
+            'missing': [
+                person_id for person_id in ids if person_id not in found]}
+
+    def remove_board_members(
+            self,
+            board_id: hug.types.number,
+            ids: id_list,
+            response):
+        """Removes the people with the given ids from a board, in one
+        statement and transaction, keeping their reported feelings; returns
+        how many were removed"""
+        if not self.session.query(
+                Board.board_id).filter_by(board_id=board_id).count():
+            response.status = HTTP_404
+            return None
+        removed = self.session.execute(
+            MEMBERSHIP.delete()  # pylint: disable=no-value-for-parameter
+            .where(and_(
+                MEMBERSHIP.c.board_id == board_id,
+                MEMBERSHIP.c.person_id.in_(ids)))).rowcount
+        self.commit_members(board_id, removed)
+        return {'removed': removed}
+
+    def commit_members(self, board_id, changed):
+        """Commits a batch of membership changes of a board, refreshing its
+        snapshot and dropping its cached responses once for the batch"""
+        if changed:
+            # the ORM doesn't see rows changed through the table
+            self.session.expire_all()
+            self.refresh_board_snapshot(board_id)
+        self.session.commit()
+        if changed:
+            self.invalidate_board(board_id)
+
+    def export_board(
+            self,
+            board_id: hug.types.number,
+            response,
+            output_format: hug.types.one_of(('ndjson', 'csv')) = 'ndjson'):
+        """Streams all the reported feelings of a board as NDJSON or CSV"""
+        if not self.session.query(
+                Board.board_id).filter_by(board_id=board_id).count():
+            response.status = HTTP_404
+            return None
+        content_type, encode = EXPORT_FORMATS[output_format]
+        column_names = ('board_id', 'person_id', 'date', 'feeling')
+        # each table streams in its index order, merged here
+        results = [
+            self.session.execute(query.execution_options(
+                stream_results=True, max_row_buffer=EXPORT_CHUNK_ROWS))
+            for query in ordered_feelings_selects(
+                board_id, self.reaches_archive(board_id, None),
+                column_names)]
+        response.content_type = content_type
+        return IterStream(
+            encode(merge_feelings(results, column_names), column_names),
+            results)
+
+    def board_analytics(  # pylint: disable=too-many-arguments
+            self,
+            board_id: hug.types.number,
+            response,
+            from_date: iso_date = None,
+            to_date: iso_date = None,
+            window: hug.types.in_range(1, 366) = 7):
+        """Returns mood metrics of a board between two dates (by default the
+        last 90 days): the daily and rolling (over window days) mood, the
+        streaks of bad days of each person and the days, and recent mood,
+        deviating from the board's baseline"""
+        to_date = to_date or calendar_date.today()
+        from_date = from_date or to_date - timedelta(days=89)
+        days = (to_date - from_date).days + 1
+        if not 0 < days <= MAX_ANALYTICS_DAYS:
+            response.status = HTTP_400
+            return 'from_date must be up to {} days before to_date'.format(
+                MAX_ANALYTICS_DAYS - 1)
+        if not self.session.query(
+                Board.board_id).filter_by(board_id=board_id).count():
             response.status = HTTP_404
             return None
-        return BOARD_SCHEMA.dump(res).data
+        matrix, person_ids = feeling_matrix(
+            self.session.execute(feelings_select(
+                board_id, from_date, to_date,
+                archive=self.reaches_archive(board_id, from_date),
+                columns=('date', 'person_id', 'feeling'))),
+            from_date,
+            days)
+        metrics = mood_metrics(matrix, window)
+        return {
+            'board_id': board_id,
+            'from_date': from_date.isoformat(),
+            'to_date': to_date.isoformat(),
+            'window': window,
+            'mood': plain(metrics['mood']),
+            'rolling_mood': plain(metrics['rolling_mood']),
+            'streaks': [
+                {'person_id': person_id,
+                 'longest_bad_streak': plain(longest),
+                 'current_bad_streak': plain(current)}
+                for person_id, longest, current in zip(
+                    person_ids,
+                    metrics['longest_bad_streaks'],
+                    metrics['current_bad_streaks'])],
+            'baseline': {
+                'mood': plain(metrics['baseline']),
+                'std': plain(metrics['baseline_std']),
+                'recent_mood': plain(metrics['recent_mood']),
+                'recent_deviation': plain(metrics['recent_deviation'])},
+            'outliers': [
+                (from_date + timedelta(days=int(day))).isoformat()
+                for day in metrics['outliers']]}
 
-    def get_boards(self):
-        """Returns all boards"""
-        res = self.session.query(Board).all()
-        return BOARDS_SCHEMA.dump(res).data
+    def board_events(
+            self,
+            board_id: hug.types.number,
+            request,
+            response):
+        """Streams the reported feelings of a board as they are created or
+        updated, as server-sent events"""
+        if not request.env.get(ASYNC_ENVIRON_KEY):
+            response.status = HTTP_501
+            return 'Board events are only served by nikoniko.api_async'
+        if not self.session.query(
+                Board.board_id).filter_by(board_id=board_id).count():
+            response.status = HTTP_404
+            return None
+        response.content_type = 'text/event-stream'
+        response.set_header('Cache-Control', 'no-cache')
+        response.set_header('X-Accel-Buffering', 'no')
+        return EventStream(
+            self.broker, board_channel(board_id), self.sse_keepalive)
+
+    def get_boards(self, fields: fieldset = None):
+        """Returns all boards, or only the requested fields of them"""
+        names = projection(BoardSchema, Board, fields)
+        # board_id last, to group members by even when not requested
+        boards = self.session.query(
+            *[getattr(Board, name) for name in names], Board.board_id).all()
+        if not wants(fields, 'people'):
+            return records(names, boards)
+        person_names = projection(
+            PersonInBoardSchema, Person, nested(fields, 'people'))
+        members = {}
+        for row in self.session.query(
+                *[getattr(Person, name) for name in person_names],
+                MEMBERSHIP.c.board_id).join(MEMBERSHIP).order_by(
+                    MEMBERSHIP.c.board_id, Person.person_id):
+            members.setdefault(row[-1], []).append(
+                dict(zip(person_names, row)))
+        return [
+            dict(zip(names, board), people=members.get(board[-1], []))
+            for board in boards]
+
+    def search_boards(
+            self,
+            q: search_term,  # pylint: disable=invalid-name
+            limit: hug.types.in_range(1, MAX_SEARCH_RESULTS + 1) = 20,
+            fields: fieldset = None):
+        """Returns at most limit boards whose label matches q, or only the
+        requested fields of them"""
+        names = projection(BoardInListSchema, Board, fields)
+        return records(names, self.search(Board, names, q).limit(limit))
+
+    def boards_overview(self, date: iso_date = None):
+        """Returns every board with its member count, the number of
+        feelings reported on a date (today by default) and the feeling
+        reported most that day, all from one query"""
+        date = date or calendar_date.today()
+        members = self.session.query(
+            MEMBERSHIP.c.board_id,
+            func.count().label('members')).group_by(
+                MEMBERSHIP.c.board_id).subquery()
+        reports = self.session.query(
+            ReportedFeeling.board_id,
+            ReportedFeeling.feeling,
+            func.count().label('reports')).filter(
+                ReportedFeeling.date == date).group_by(
+                    ReportedFeeling.board_id,
+                    ReportedFeeling.feeling).subquery()
+        rows = self.session.query(
+            Board.board_id, Board.label, members.c.members,
+            reports.c.feeling, reports.c.reports).outerjoin(
+                members, members.c.board_id == Board.board_id).outerjoin(
+                    reports, reports.c.board_id == Board.board_id).order_by(
+                        Board.board_id)
+        overview = {}
+        feelings = {}
+        for board_id, label, member_count, feeling, count in rows:
+            board = overview.setdefault(board_id, {
+                'board_id': board_id,
+                'label': label,
+                'members': member_count or 0,
+                'reports': 0,
+                'dominant_feeling': None})
+            if feeling is not None:
+                board['reports'] += count
+                feelings.setdefault(board_id, []).append((-count, feeling))
+        for board_id, counts in feelings.items():
+            # ties go to the feeling first in alphabetical order
+            overview[board_id]['dominant_feeling'] = min(counts)[1]
+        return {'date': date.isoformat(), 'boards': list(overview.values())}
 
     def get_reported_feeling(
             self,
             board_id: hug.types.number,
             person_id: hug.types.number,
             date: hug.types.text,
-            response):
-        """Returns a specific reported feeling for a board, person and date"""
+            response,
+            fields: fieldset = None):
+        """Returns a specific reported feeling for a board, person and date,
+        or only the requested fields of it"""
         try:
-            res = self.session.query(ReportedFeeling).filter_by(
-                board_id=board_id,
-                person_id=person_id,
-                date=date).one()
-        except NoResultFound:
+            day = datetime.strptime(date, "%Y-%m-%d").date()
+        except ValueError:
+            response.status = HTTP_404
+            return None
+        key = {'board_id': board_id, 'person_id': person_id, 'date': day}
+        res = lookup(
+            self.session, ReportedFeeling, key, fields).one_or_none()
+        if res is None and self.reaches_archive(board_id, day):
+            res = lookup(
+                self.session, ArchivedFeeling, key, fields).one_or_none()
+        if res is None:
+            response.status = HTTP_404
+            return None
+        return dump(REPORTEDFEELING_SCHEMA, res, fields)
+
+    def get_reported_feelings(  # pylint: disable=too-many-arguments
+            self,
+            board_id: hug.types.number,
+            from_date: iso_date,
+            to_date: iso_date,
+            response,
+            person_ids: id_list = None,
+            fields: fieldset = None):
+        """Returns the reported feelings of a board between two dates
+        (inclusive, at most a year apart), of every person or of the given
+        ones, in one range query"""
+        if not timedelta(0) <= to_date - from_date < timedelta(
+                days=MAX_BATCH_DAYS):
+            response.status = HTTP_400
+            return 'from_date must be up to {} days before to_date'.format(
+                MAX_BATCH_DAYS - 1)
+        res = self.session.execute(feelings_select(
+            board_id, from_date, to_date, person_ids,
+            archive=self.reaches_archive(board_id, from_date))).fetchall()
+        return dump(REPORTEDFEELINGS_SCHEMA, res, fields)
+
+    def reported_feeling_changes(
+            self,
+            board_id: hug.types.number,
+            response,
+            cursor: change_cursor = None,
+            limit: hug.types.in_range(1, MAX_CHANGES + 1) = MAX_CHANGES):
+        """Returns the reported feelings of a board written after the
+        position of cursor (all of them without a cursor), up to limit of
+        them, with the cursor to ask for the next ones and whether there
+        are more already"""
+        res = self.session.execute(changes_select(
+            board_id, cursor, limit + 1,
+            archive=self.reaches_archive(board_id, None))).fetchall()
+        if not res and not self.session.query(
+                Board.board_id).filter_by(board_id=board_id).count():
             response.status = HTTP_404
             return None
-        return REPORTEDFEELING_SCHEMA.dump(res).data
+        changes = res[:limit]
+        if changes:
+            cursor = (
+                changes[-1].change_seq, changes[-1].person_id,
+                changes[-1].date)
+        return {
+            'changes': REPORTEDFEELINGS_SCHEMA.dump(changes).data,
+            'cursor': encode_cursor(cursor) if cursor else None,
+            'more': len(res) > limit}
 
     def create_reported_feeling(
             self,
@@ -332,23 +841,32 @@ class NikonikoAPI:
             feeling: hug.types.text,
             date: hug.types.text):
         """Creates a new reported_feeling"""
+        day = datetime.strptime(date, "%Y-%m-%d").date()
         try:
-            reported_feeling = self.session.query(ReportedFeeling).filter_by(
-                board_id=board_id,
-                person_id=person_id,
-                date=date).one()
+            reported_feeling = lookup(
+                self.session,
+                ReportedFeeling,
+                {'board_id': board_id, 'person_id': person_id, 'date': day}
+            ).one()
             reported_feeling.feeling = feeling
         except NoResultFound:
             reported_feeling = ReportedFeeling(
                 person_id=person_id,
                 board_id=board_id,
-                date=datetime.strptime(
-                    date,
-                    "%Y-%m-%d").date(),
+                date=day,
                 feeling=feeling)
             self.session.add(reported_feeling)
+            if self.reaches_archive(board_id, day):
+                unarchive(self.session, board_id, person_id, day)
+        reported_feeling.change_seq = next_change(self.session, board_id)
+        if day >= snapshot_window()[0]:
+            self.refresh_board_snapshot(board_id)
         self.session.commit()
-        return REPORTEDFEELING_SCHEMA.dump(reported_feeling).data
+        self.invalidate_board(board_id)
+        result = REPORTEDFEELING_SCHEMA.dump(reported_feeling).data
+        self.broker.publish(
+            board_channel(board_id), 'reportedfeeling', result)
+        return result
 
     def __init__(
             self,
@@ -359,17 +877,60 @@ class NikonikoAPI:
         self.session = session
         self.secret_key = config['secret_key']
         self.mailconfig = config['mailconfig']
+        self.mail_executor = config.get('mail_executor')
+        self.ratelimit = config.get('ratelimit', {})
+        self.compression = config.get('compression', {})
+        self.broker = config.get('broker') or MemoryBroker()
+        self.sse_keepalive = config.get('sse_keepalive', 15)
+        self.tenants = config.get('tenants')
+        self.cache = config.get('cache')
+        self.flights = config.get('flights')
+        self.profiling = config.get('profiling')
+        self.request_logging = config.get('request_logging')
+        self.tenant_domain = config.get('tenant_domain')
         self.logger = config['logger']
 
     def setup(self):
-        """Set up endpoints and CORS middleware"""
+        """Set up endpoints and request logging, profiling, CORS, tenancy,
+        rate limiting and compression middleware"""
+        self.setup_request_logging()
+        self.setup_profiling()
         self.setup_cors()
+        self.setup_tenancy()
+        self.setup_ratelimit()
+        self.setup_compression()
         self.setup_endpoints()
 
+    def setup_request_logging(self):
+        """Add request id and debug sampling middleware if configured"""
+        if self.request_logging is not None:
+            self.api.http.add_middleware(
+                RequestLogMiddleware(**self.request_logging))
+
+    def setup_profiling(self):
+        """Add request profiling middleware if asked for; first, so that it
+        sees the time spent in every other middleware"""
+        if self.profiling:
+            self.api.http.add_middleware(ProfileMiddleware(**self.profiling))
+
     def setup_cors(self):
         """Add CORS middleware"""
         self.api.http.add_middleware(CORSMiddleware(self.api))
 
+    def setup_tenancy(self):
+        """Add tenant resolution middleware when serving several tenants"""
+        if self.tenants is not None:
+            self.api.http.add_middleware(TenantMiddleware(
+                self.tenants, self.secret_key, self.tenant_domain))
+
+    def setup_ratelimit(self):
+        """Add rate limiting middleware for the unauthenticated endpoints"""
+        self.api.http.add_middleware(RateLimitMiddleware(**self.ratelimit))
+
+    def setup_compression(self):
+        """Add response compression middleware"""
+        self.api.http.add_middleware(GzipMiddleware(**self.compression))
+
     def setup_endpoints(self):
         """Assign methods to endpoints"""
         hug.post('/login', api=self.api)(self.login)
@@ -380,6 +941,9 @@ class NikonikoAPI:
         token_key_authentication = \
             hug.authentication.token(  # pylint: disable=no-value-for-parameter
                 self.token_verify)
+        token_or_query_authentication = \
+            token_or_query_parameter(  # pylint: disable=no-value-for-parameter
+                self.token_verify)
         hug.put(
             '/password/{user_id}',
             api=self.api,
@@ -404,10 +968,46 @@ class NikonikoAPI:
             '/people',
             api=self.api,
             requires=token_key_authentication)(self.people)
+        hug.get(
+            '/people/batch',
+            api=self.api,
+            requires=token_key_authentication)(self.people_batch)
+        hug.get(
+            '/people/search',
+            api=self.api,
+            requires=token_key_authentication)(self.search_people)
         hug.get(
             '/boards/{board_id}',
             api=self.api,
             requires=token_key_authentication)(self.board)
+        hug.post(
+            '/boards/{board_id}/people',
+            api=self.api,
+            requires=token_key_authentication)(self.add_board_members)
+        hug.delete(
+            '/boards/{board_id}/people',
+            api=self.api,
+            requires=token_key_authentication)(self.remove_board_members)
+        hug.get(
+            '/boards/{board_id}/export',
+            api=self.api,
+            requires=token_key_authentication)(self.export_board)
+        hug.get(
+            '/boards/{board_id}/analytics',
+            api=self.api,
+            requires=token_key_authentication)(self.board_analytics)
+        hug.get(
+            '/boards/{board_id}/events',
+            api=self.api,
+            requires=token_or_query_authentication)(self.board_events)
+        hug.get(
+            '/boards/overview',
+            api=self.api,
+            requires=token_key_authentication)(self.boards_overview)
+        hug.get(
+            '/boards/search',
+            api=self.api,
+            requires=token_key_authentication)(self.search_boards)
         hug.get(
             '/boards',
             api=self.api,
@@ -417,6 +1017,14 @@ class NikonikoAPI:
              '/people/{person_id}/dates/{date}'),
             api=self.api,
             requires=token_key_authentication)(self.get_reported_feeling)
+        hug.get(
+            '/reportedfeelings/boards/{board_id}',
+            api=self.api,
+            requires=token_key_authentication)(self.get_reported_feelings)
+        hug.get(
+            '/reportedfeelings/boards/{board_id}/changes',
+            api=self.api,
+            requires=token_key_authentication)(self.reported_feeling_changes)
         hug.post(
             ('/reportedfeelings/boards/{board_id}'
              '/people/{person_id}/dates/{date}'),
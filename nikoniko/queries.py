@@ -0,0 +1,56 @@
+""" Baked queries for the lookups every request does
+
+A baked query is built and compiled into SQL the first time it runs, and
+taken from a cache afterwards, so requests only bind its parameters (see
+sqlalchemy.ext.baked).
+"""
+from sqlalchemy import bindparam
+from sqlalchemy.ext import baked
+from sqlalchemy.orm import scoped_session
+
+from nikoniko.fieldsets import columns
+
+BAKERY = baked.bakery(size=500)
+
+
+def lookup(session, model, keys, fields=None, always=()):
+    """Return a query for the model instances whose keys columns equal the
+    values of keys, a dictionary, loading only the requested fields (plus
+    the always needed ones) of them
+
+    Queries are cached by model, key names and fields; the values of keys
+    are bound as parameters.
+    """
+    query = BAKERY(lambda session: session.query(model), model)
+    if fields is not None:
+        query.add_criteria(
+            lambda query: query.options(*columns(model, fields, *always)),
+            model, fields, always)
+    return keyed(query, session, model, keys)
+
+
+def lookup_columns(session, model, names, keys):
+    """Return a query for the names columns, as tuples, of the model rows
+    whose keys columns equal the values of keys, a dictionary
+
+    Queries are cached by model, column names and key names.
+    """
+    query = BAKERY(
+        lambda session: session.query(
+            *(getattr(model, name) for name in names)),
+        model, names)
+    return keyed(query, session, model, keys)
+
+
+def keyed(query, session, model, keys):
+    """Filter a baked query of model by the keys columns and run it on
+    session with their values bound"""
+    names = tuple(sorted(keys))
+    query.add_criteria(
+        lambda query: query.filter(*(
+            getattr(model, name) == bindparam(name) for name in names)),
+        model, names)
+    if isinstance(session, scoped_session):
+        # baked queries run on the session itself, not on a registry
+        session = session()
+    return query(session).params(**keys)
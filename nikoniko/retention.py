@@ -0,0 +1,185 @@
+""" Tiered retention of reported feelings
+
+Reported feelings older than a horizon (RETENTION_DAYS before today) are
+moved by nikoniko-archive from ``reportedfeelings`` to
+``reportedfeelings_archive``, keeping the hot table and its indexes the
+size of the horizon. Reads of ranges starting on or before the last day
+archived of a board select from both tables, so clients don't notice where
+a feeling lives, whatever horizon the archiving used.
+"""
+import argparse
+import heapq
+import logging
+import sys
+import time
+
+from datetime import date, timedelta
+
+from sqlalchemy import and_, exists, func, select, tuple_, union_all
+
+from nikoniko.entities import DB, ArchivedFeeling, ReportedFeeling
+from nikoniko.settings import db_connstring_from_environment
+from nikoniko.settings import retention_days_from_environment
+
+FEELING_COLUMNS = ('board_id', 'person_id', 'date', 'feeling')
+CHANGE_COLUMNS = FEELING_COLUMNS + ('change_seq',)
+# well beyond the recent window board snapshots and overviews serve
+MIN_RETENTION_DAYS = 90
+
+HOT = ReportedFeeling.__table__
+ARCHIVE = ArchivedFeeling.__table__
+
+
+def horizon(retention_days, today=None):
+    """The first day kept in the hot table, None without retention"""
+    if not retention_days:
+        return None
+    return (today or date.today()) - timedelta(days=retention_days)
+
+
+def last_archived(board_id):
+    """A scalar select of the last day of the archived feelings of a board,
+    NULL if none"""
+    return select([func.max(ARCHIVE.c.date)]).where(
+        ARCHIVE.c.board_id == board_id)
+
+
+def reaches_archive(from_date, last_archived_day):
+    """Tell whether feelings from from_date on (from the beginning if None)
+    may be archived, given the last day archived (None if none)"""
+    return last_archived_day is not None and (
+        from_date is None or from_date <= last_archived_day)
+
+
+def feelings_select(  # pylint: disable=too-many-arguments
+        board_id, from_date=None, to_date=None, person_ids=None,
+        archive=True, columns=FEELING_COLUMNS):
+    """A select of the columns of the reported feelings of a board between
+    two dates (inclusive, either optional), of the given people only if
+    any, ordered by date and person; archived ones included if archive"""
+    def part(table):
+        query = select([table.c[column] for column in columns]).where(
+            table.c.board_id == board_id)
+        if from_date:
+            query = query.where(table.c.date >= from_date)
+        if to_date:
+            query = query.where(table.c.date <= to_date)
+        if person_ids:
+            query = query.where(table.c.person_id.in_(person_ids))
+        return query
+    if not archive:
+        return part(HOT).order_by(HOT.c.date, HOT.c.person_id)
+    both = union_all(part(HOT), part(ARCHIVE)).alias('feelings')
+    return select([both]).order_by(both.c.date, both.c.person_id)
+
+
+def ordered_feelings_selects(board_id, archive=True, columns=FEELING_COLUMNS):
+    """Selects of the columns (date and person_id among them) of all the
+    reported feelings of a board, one per table, the archive's only if
+    archive, each ordered by date and person for merge_feelings"""
+    return [
+        select([table.c[column] for column in columns])
+        .where(table.c.board_id == board_id)
+        .order_by(table.c.date, table.c.person_id)
+        for table in ((HOT, ARCHIVE) if archive else (HOT,))]
+
+
+def merge_feelings(parts, columns=FEELING_COLUMNS):
+    """The rows of parts, each ordered by date and person, in that order;
+    unlike sorting their union in the DB it walks every part's index and
+    holds a row of each at a time"""
+    if len(parts) == 1:
+        return iter(parts[0])
+    day, person = columns.index('date'), columns.index('person_id')
+    return heapq.merge(*parts, key=lambda row: (row[day], row[person]))
+
+
+def changes_select(board_id, after=None, limit=None, archive=True):
+    """A select of the reported feelings of a board, archived ones included
+    if archive, in (change_seq, person_id, date) order after the position
+    after if given, at most limit of them"""
+    def part(table):
+        order = (table.c.change_seq, table.c.person_id, table.c.date)
+        query = select([table.c[column] for column in CHANGE_COLUMNS]).where(
+            table.c.board_id == board_id)
+        if after:
+            query = query.where(tuple_(*order) > tuple_(*after))
+        return query.order_by(*order).limit(limit)
+    if not archive:
+        return part(HOT)
+    # each table walks its own index; only the heads of both get sorted
+    both = union_all(
+        select([part(HOT).alias('hot')]),
+        select([part(ARCHIVE).alias('archived')])).alias('changes')
+    return select([both]).order_by(
+        both.c.change_seq, both.c.person_id, both.c.date).limit(limit)
+
+
+def same_key(table, other):
+    """Join condition of two tables of feelings on their keys"""
+    return and_(
+        table.c.board_id == other.c.board_id,
+        table.c.person_id == other.c.person_id,
+        table.c.date == other.c.date)
+
+
+def unarchive(connection, board_id, person_id, day):
+    """Drop the archived feeling of a board, person and day, which a write
+    of it to the hot table replaces"""
+    connection.execute(ARCHIVE.delete().where(and_(
+        ARCHIVE.c.board_id == board_id,
+        ARCHIVE.c.person_id == person_id,
+        ARCHIVE.c.date == day)))
+
+
+def archive_feelings(engine, before):
+    """Move the reported feelings dated before a day to the archive, in one
+    transaction; returns a report dictionary"""
+    started = time.perf_counter()
+    old = HOT.c.date < before
+    with engine.begin() as connection:
+        # archived feelings written again since are replaced
+        connection.execute(ARCHIVE.delete().where(
+            exists().where(and_(same_key(ARCHIVE, HOT), old))))
+        moved = connection.execute(
+            ARCHIVE.insert()  # pylint: disable=no-value-for-parameter
+            .from_select(
+                list(CHANGE_COLUMNS),
+                select([HOT.c[column] for column in CHANGE_COLUMNS])
+                .where(old))).rowcount
+        connection.execute(HOT.delete().where(old))
+    return dict(
+        before=before,
+        moved=moved,
+        total_seconds=time.perf_counter() - started)
+
+
+def format_report(report):
+    """Render the report of an archiving run"""
+    return 'Archived {moved} reported feelings dated before {before} in ' \
+        '{total_seconds:.3f}s'.format(**report)
+
+
+def main(argv=None):
+    """Entry point of the nikoniko-archive command"""
+    parser = argparse.ArgumentParser(
+        description='Move old reported feelings to the archive table')
+    parser.add_argument(
+        '--days', type=int, default=retention_days_from_environment(),
+        help='keep that many days in the hot table (RETENTION_DAYS)')
+    parser.add_argument(
+        '--db', default=None,
+        help='DB connection string (defaults to the DB_* environment)')
+    args = parser.parse_args(argv)
+    if args.days is None or args.days < MIN_RETENTION_DAYS:
+        parser.error('--days must be at least {}'.format(MIN_RETENTION_DAYS))
+    logging.basicConfig()
+    database = DB(args.db or db_connstring_from_environment())
+    database.create_all()
+    print(format_report(archive_feelings(
+        database.engine, horizon(args.days))))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,57 @@
+""" Search people and boards by label
+
+Labels are matched case-insensitively: by substring where a trigram index
+serves it (PostgreSQL with pg_trgm, for terms of 3 characters or more) and
+by prefix elsewhere, as a range over the lowercased label index.
+"""
+import sys
+
+from sqlalchemy import and_, case, func
+
+MAX_SEARCH_RESULTS = 50
+MIN_TRIGRAM_LENGTH = 3
+SURROGATES = (0xD800, 0xDFFF)
+
+
+def search_term(value):
+    """Text to search for, 1 to 50 characters"""
+    term = value.strip().lower()
+    if not 0 < len(term) <= 50:
+        raise ValueError('Between 1 and 50 characters')
+    return term
+
+
+def successor(prefix):
+    """The first string after every string starting with prefix, None if
+    there's none"""
+    stem = prefix.rstrip(chr(sys.maxunicode))
+    if not stem:
+        return None
+    following = ord(stem[-1]) + 1
+    if SURROGATES[0] <= following <= SURROGATES[1]:
+        # they can't be encoded, the next code point that can is after them
+        following = SURROGATES[1] + 1
+    return stem[:-1] + chr(following)
+
+
+def prefix_range(column, prefix):
+    """Criterion of the lowercased column starting with prefix, as a range
+    an index of lower(column) serves"""
+    lowered = func.lower(column)
+    upper = successor(prefix)
+    if upper is None:
+        return lowered >= prefix
+    return and_(lowered >= prefix, lowered < upper)
+
+
+def label_search(query, column, term, dialect_name):
+    """Filter and order query to the rows whose label column matches term,
+    prefix matches first"""
+    lowered = func.lower(column)
+    if dialect_name == 'postgresql' and len(term) >= MIN_TRIGRAM_LENGTH:
+        return query.filter(
+            lowered.contains(term, autoescape=True)).order_by(
+                case([(lowered.startswith(term, autoescape=True), 0)],
+                     else_=1),
+                lowered, column)
+    return query.filter(prefix_range(column, term)).order_by(lowered, column)
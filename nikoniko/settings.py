@@ -0,0 +1,171 @@
+""" Configuration of the Nikoniko API taken from the environment """
+import logging
+import os
+import re
+
+from nikoniko.cache import MemcachedCache, MemoryCache, ResponseCache
+from nikoniko.events import MemoryBroker, PostgresBroker
+from nikoniko.hug_middleware_ratelimit import MemoryBackend
+from nikoniko.hug_middleware_ratelimit import UWSGICacheBackend
+from nikoniko.singleflight import SingleFlight
+from nikoniko.tenancy import TenantRouter
+
+
+def db_connstring_from_environment(logger=logging.getLogger(__name__)):
+    """ compose the connection string based on environment vars values """
+    db_driver = os.getenv('DB_DRIVER', 'postgresql')
+    if db_driver == 'sqlite':
+        # embedded mode: DB_DBNAME is the path of the DB file
+        db_connstring = 'sqlite:///{}'.format(
+            os.getenv('DB_DBNAME', 'nikoniko.db'))
+        logger.debug('db_connstring: [%s]', db_connstring)
+        return db_connstring
+    db_host = os.getenv('DB_HOST', 'localhost')
+    db_port = os.getenv('DB_PORT', '5432')
+    db_dbname = os.getenv('DB_DBNAME', 'nikoniko')
+    db_username = os.getenv('DB_USERNAME', os.getenv('USER', None))
+    db_password = os.getenv('DB_PASSWORD', None)
+    db_connstring = '{}://{}{}{}{}:{}/{}'.format(
+        db_driver,
+        db_username if db_username else '',
+        ':{}'.format(db_password) if db_password else '',
+        '@' if db_username else '',
+        db_host,
+        db_port,
+        db_dbname)
+    logger.debug(
+        'db_connstring: [%s]',
+        re.sub(
+            r'(:.+?):.*?@',
+            r'\1:XXXXXXX@',
+            db_connstring))
+    return db_connstring
+
+
+def mailer_config_from_environment(logger=logging.getLogger(__name__)):
+    """ Calculate and return mailer configuration based on environment """
+    mailer_config = dict(
+        server=os.getenv('MAILER_HOST', 'localhost'),
+        port=os.getenv('MAILER_PORT', '25'),
+        user=os.getenv('MAILER_USER', 'coral@example.com'),
+        password=os.getenv('MAILER_PASSWORD', 'mailerpassword'),
+        sender=os.getenv('MAILER_SENDER', 'noreply@nikonikoboards.com'))
+    logger.debug('MAILER: [%s]', mailer_config)
+    return mailer_config
+
+
+def ratelimit_config_from_environment(logger=logging.getLogger(__name__)):
+    """ Calculate and return rate limiting configuration from environment """
+    backend = os.getenv('RATELIMIT_BACKEND', 'memory')
+    ratelimit_config = dict(
+        backend=(UWSGICacheBackend(os.getenv('RATELIMIT_CACHE', 'ratelimit'))
+                 if backend == 'uwsgi' else MemoryBackend()),
+        ip_per_minute=float(os.getenv('RATELIMIT_IP_PER_MINUTE', '30')),
+        ip_burst=int(os.getenv('RATELIMIT_IP_BURST', '10')),
+        email_per_minute=float(os.getenv('RATELIMIT_EMAIL_PER_MINUTE', '5')),
+        email_burst=int(os.getenv('RATELIMIT_EMAIL_BURST', '5')))
+    logger.debug('RATELIMIT: [%s]', ratelimit_config)
+    return ratelimit_config
+
+
+def compression_config_from_environment(logger=logging.getLogger(__name__)):
+    """ Calculate and return response compression configuration """
+    compression_config = dict(
+        min_size=int(os.getenv('COMPRESSION_MIN_SIZE', '1024')),
+        level=int(os.getenv('COMPRESSION_LEVEL', '1')))
+    logger.debug('COMPRESSION: [%s]', compression_config)
+    return compression_config
+
+
+def broker_from_environment(engine, logger=logging.getLogger(__name__)):
+    """ Create the board events broker chosen in the environment """
+    broker = os.getenv('EVENTS_BROKER', 'memory')
+    logger.debug('EVENTS_BROKER: [%s]', broker)
+    if broker == 'postgres':
+        return PostgresBroker(engine, logger)
+    return MemoryBroker()
+
+
+def tenancy_config_from_environment(logger=logging.getLogger(__name__)):
+    """ Create the tenant router if TENANT_DB_CONNSTRING asks for one, to
+    serve the TENANTS (required then) """
+    connstring_template = os.getenv('TENANT_DB_CONNSTRING')
+    if not connstring_template:
+        return {}
+    tenants = [
+        tenant.strip()
+        for tenant in os.getenv('TENANTS', '').split(',') if tenant.strip()]
+    tenancy_config = dict(
+        tenants=TenantRouter(
+            connstring_template,
+            tenants=tenants,
+            idle_seconds=float(os.getenv('TENANT_IDLE_SECONDS', '300')),
+            max_tenants=int(os.getenv('TENANT_MAX_OPEN', '100')),
+            logger=logger),
+        tenant_domain=os.getenv('TENANT_DOMAIN'))
+    logger.debug('TENANTS: [%s]', tenants)
+    return tenancy_config
+
+
+def cache_from_environment(logger=logging.getLogger(__name__)):
+    """ Create the board response cache chosen in the environment """
+    backend = os.getenv('BOARD_CACHE', 'none')
+    logger.debug('BOARD_CACHE: [%s]', backend)
+    if backend == 'memory':
+        backend = MemoryCache(int(os.getenv('BOARD_CACHE_SIZE', '1000')))
+    elif backend == 'memcached':
+        host, _, port = os.getenv(
+            'BOARD_CACHE_SERVER', 'localhost:11211').rpartition(':')
+        backend = MemcachedCache((host, int(port)))
+    else:
+        return None
+    return ResponseCache(backend, float(os.getenv('BOARD_CACHE_TTL', '60')))
+
+
+def flights_from_environment(logger=logging.getLogger(__name__)):
+    """ Create the coalescer of concurrent identical board reads, None if
+    COALESCE_READS turns it off """
+    coalesce = os.getenv('COALESCE_READS', 'true').lower() in [
+        'yes', 'y', 'true', 't', '1']
+    timeout = float(os.getenv('COALESCE_TIMEOUT', '30'))
+    logger.debug('COALESCE_READS: [%s] (%ss)', coalesce, timeout)
+    return SingleFlight(timeout) if coalesce else None
+
+
+def profiling_config_from_environment(logger=logging.getLogger(__name__)):
+    """ Calculate and return request profiling configuration, None unless
+    PROFILE_DIR is set """
+    directory = os.getenv('PROFILE_DIR')
+    if not directory:
+        return None
+    profiling_config = dict(
+        directory=directory,
+        secret=os.getenv('PROFILE_SECRET'),
+        sample_rate=float(os.getenv('PROFILE_SAMPLE_RATE', '0')),
+        keep=int(os.getenv('PROFILE_KEEP', '100')))
+    logger.debug('PROFILE: [%s]', dict(profiling_config, secret='XXXXXXX'))
+    return profiling_config
+
+
+def logging_config_from_environment():
+    """ Calculate and return log output configuration """
+    return dict(json_format=os.getenv('LOG_FORMAT', 'text') == 'json')
+
+
+def request_logging_config_from_environment(
+        logger=logging.getLogger(__name__)):
+    """ Calculate and return per-request logging configuration """
+    request_logging_config = dict(
+        debug_sample_rate=float(os.getenv('LOG_DEBUG_SAMPLE_RATE', '1')),
+        log_requests=os.getenv('LOG_REQUESTS', 'false').lower() in [
+            'yes', 'y', 'true', 't', '1'])
+    logger.debug('REQUEST_LOGGING: [%s]', request_logging_config)
+    return request_logging_config
+
+
+def retention_days_from_environment(logger=logging.getLogger(__name__)):
+    """ Return the days reported feelings stay in the hot table before
+    nikoniko-archive moves them to the archive, None if unset """
+    days = os.getenv('RETENTION_DAYS')
+    logger.debug('RETENTION_DAYS: [%s]', days)
+    return int(days) if days else None
@@ -0,0 +1,67 @@
+""" Coalesce identical concurrent reads into one computation
+
+When a team opens its board at once, the worker's threads would each run
+the same queries and serialization. With single flight the first request
+for a key computes the response while the others for that key wait and
+share it; nothing is kept once it's done, so it's no cache.
+
+Keys are tuples whose first item is a group, e.g. a board, and a write to
+the group makes later reads start a new flight rather than join one that
+may have started before the write.
+"""
+import threading
+
+
+class Flight():  # pylint: disable=too-few-public-methods
+    """A computation in flight and, once done, its outcome"""
+    __slots__ = ('done', 'result', 'error')
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight():
+    """Run one computation per key at a time, sharing its outcome with the
+    callers of the key that came while it was in flight"""
+    __slots__ = ('flights', 'lock', 'timeout')
+
+    def __init__(self, timeout: float = 30):
+        self.flights = {}
+        self.lock = threading.Lock()
+        self.timeout = timeout
+
+    def run(self, key, compute):
+        """Return what compute returns, or raise what it raises, joining the
+        flight of key if there's one; callers that waited timeout seconds
+        compute on their own"""
+        with self.lock:
+            flight = self.flights.get(key)
+            leading = flight is None
+            if leading:
+                flight = self.flights[key] = Flight()
+        if not leading:
+            if not flight.done.wait(self.timeout):
+                return compute()
+            if flight.error is not None:
+                raise flight.error
+            return flight.result
+        try:
+            flight.result = compute()
+        except BaseException as error:
+            flight.error = error
+            raise
+        finally:
+            with self.lock:
+                if self.flights.get(key) is flight:
+                    del self.flights[key]
+            flight.done.set()
+        return flight.result
+
+    def forget(self, group):
+        """Make later calls of the keys of group start new flights, leaving
+        those in flight to the callers already waiting"""
+        with self.lock:
+            for key in [key for key in self.flights if key[0] == group]:
+                del self.flights[key]
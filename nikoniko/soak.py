@@ -0,0 +1,315 @@
+""" Soak test NikonikoAPI with concurrent mixed traffic from many threads
+
+Every thread plays a person of a board made up for the run: it reports
+feelings, reads them back and reads its person, the people and the board,
+checking every answer against what it wrote. Errors and wrong answers are
+what a session or a DB connection used by several threads at once looks
+like, so a clean run of the session mode a worker uses, against
+PostgreSQL over SSL, is the gate for running threaded workers
+(uWSGI's enable-threads).
+
+Session modes are ``shared``, one session for every thread as the
+synchronous entry points use, and ``thread``, a session per thread.
+"""
+import argparse
+import itertools
+import logging
+import random
+import sys
+import threading
+import time
+import uuid
+
+from collections import Counter
+from datetime import date, timedelta
+
+import hug
+
+from falcon import Response
+from sqlalchemy.orm import scoped_session
+
+from nikoniko.entities import DB, Board, Person, ReportedFeeling, MEMBERSHIP
+from nikoniko.entities import BoardSnapshot, ChangeSequence
+from nikoniko.nikonikoapi import NikonikoAPI
+from nikoniko.settings import db_connstring_from_environment
+
+SESSION_MODES = ('shared', 'thread')
+FEELINGS = ('good', 'neutral', 'bad')
+# feelings are reported before any snapshot window, so that the threads
+# don't all refresh the same board snapshot row
+FIRST_DAY = date(2000, 1, 1)
+DAYS = 366
+MAX_ERROR_SAMPLES = 10
+
+
+class Mismatch(Exception):
+    """ Raised when the API answers something other than what was written """
+
+
+def seed(session, threads):
+    """Create a board with one person per thread; returns their ids"""
+    run = uuid.uuid4().hex[:8]
+    board = Board(label='soak-{}'.format(run))
+    people = [
+        Person(label='soak-{}-{}'.format(run, number))
+        for number in range(threads)]
+    board.people.extend(people)
+    session.add(board)
+    session.commit()
+    return board.board_id, board.label, [
+        (person.person_id, person.label) for person in people]
+
+
+def cleanup(session, board_id, person_ids):
+    """Remove what seed and the run created"""
+    session.query(ReportedFeeling).filter_by(board_id=board_id).delete()
+    session.query(BoardSnapshot).filter_by(board_id=board_id).delete()
+    session.query(ChangeSequence).filter_by(board_id=board_id).delete()
+    session.execute(
+        MEMBERSHIP.delete()  # pylint: disable=no-value-for-parameter
+        .where(MEMBERSHIP.c.board_id == board_id))
+    session.query(Board).filter_by(board_id=board_id).delete()
+    session.query(Person).filter(Person.person_id.in_(person_ids)).delete(
+        synchronize_session=False)
+    session.commit()
+
+
+def expect(actual, expected, what):
+    """Raise Mismatch unless actual is expected"""
+    if actual != expected:
+        raise Mismatch('{}: expected {!r}, got {!r}'.format(
+            what, expected, actual))
+
+
+class Player():
+    """The traffic of one thread, as one person of the soak board"""
+    __slots__ = ('api', 'board', 'person', 'written', 'random')
+
+    def __init__(self, api, board, person, seed_value):
+        self.api = api
+        self.board = board
+        self.person = person
+        self.written = {}
+        self.random = random.Random(seed_value)
+
+    def report(self):
+        """Report a feeling on some day"""
+        day = (FIRST_DAY + timedelta(
+            days=self.random.randrange(DAYS))).isoformat()
+        feeling = self.random.choice(FEELINGS)
+        result = self.api.create_reported_feeling(
+            self.board[0], self.person[0], feeling, day)
+        expect(
+            (result['person_id'], result['date'], result['feeling']),
+            (self.person[0], day, feeling),
+            'reported feeling')
+        self.written[day] = feeling
+
+    def read_feeling(self):
+        """Read back a feeling reported before"""
+        if not self.written:
+            self.report()
+            return
+        day = self.random.choice(list(self.written))
+        result = self.api.get_reported_feeling(
+            self.board[0], self.person[0], day, Response())
+        expect(
+            result and (result['person_id'], result['feeling']),
+            (self.person[0], self.written[day]),
+            'feeling of {}'.format(day))
+
+    def read_person(self):
+        """Read the person the thread plays"""
+        result = self.api.get_person(self.person[0], Response())
+        expect(
+            result and (result['person_id'], result['label']),
+            self.person,
+            'person')
+
+    def read_people(self):
+        """Read the people in a batch including the player"""
+        result = self.api.people_batch([self.person[0]])
+        expect(
+            [(person['person_id'], person['label'])
+             for person in result['people']],
+            [self.person],
+            'people batch')
+
+    def read_board(self):
+        """Read the board over one day"""
+        day = FIRST_DAY + timedelta(days=self.random.randrange(DAYS))
+        result = self.api.board(self.board[0], Response(), day, day)
+        expect(
+            result and (result['board_id'], result['label']),
+            self.board,
+            'board')
+
+    def operations(self):
+        """The mix of operations, writes being a fifth of them"""
+        return (
+            self.report, self.read_feeling, self.read_feeling,
+            self.read_person, self.read_people, self.read_board,
+            self.read_feeling, self.read_board, self.read_person,
+            self.report)
+
+
+def play(player, session, deadline, requests, results):
+    """Run requests operations (or until deadline) and add the outcome to
+    results, a dictionary shared by the threads"""
+    latencies = []
+    errors = Counter()
+    samples = []
+    operations = player.operations()
+    for count in itertools.count():
+        if count >= requests or time.monotonic() >= deadline:
+            break
+        operation = player.random.choice(operations)
+        started = time.perf_counter()
+        try:
+            operation()
+        except Exception as exception:  # pylint: disable=broad-except
+            kind = 'mismatch' if isinstance(exception, Mismatch) \
+                else type(exception).__name__
+            errors[kind] += 1
+            samples.append('{}: {}'.format(
+                kind, str(exception).split('\n', 1)[0]))
+            try:
+                session.rollback()
+            except Exception:  # pylint: disable=broad-except
+                errors['failed rollback'] += 1
+        latencies.append(time.perf_counter() - started)
+    if isinstance(session, scoped_session):
+        # closed in the thread that used it
+        session.remove()
+    with results['lock']:
+        results['latencies'].extend(latencies)
+        results['errors'].update(errors)
+        results['samples'].extend(samples[:MAX_ERROR_SAMPLES])
+
+
+def uses_ssl(database):
+    """Tell whether the connections to a PostgreSQL DB use SSL, None for
+    other DBs"""
+    if database.engine.dialect.name != 'postgresql':
+        return None
+    return bool(database.engine.execute(
+        'SELECT ssl FROM pg_stat_ssl WHERE pid = pg_backend_pid()').scalar())
+
+
+def run_players(players, session, seconds, requests):
+    """Run each player in a thread of its own; returns the results of
+    play and the seconds the run took"""
+    results = dict(
+        lock=threading.Lock(), latencies=[], errors=Counter(), samples=[])
+    deadline = time.monotonic() + seconds
+    workers = [
+        threading.Thread(target=play, args=(
+            player, session, deadline, requests or sys.maxsize, results))
+        for player in players]
+    started = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return results, time.perf_counter() - started
+
+
+def soak(  # pylint: disable=too-many-locals
+        database, threads=8, seconds=30, requests=None, mode='thread'):
+    """Run threads players against a NikonikoAPI sharing its session
+    between the threads or not (mode), for some seconds or up to requests
+    operations per thread
+
+    Returns a report dictionary.
+    """
+    if mode == 'shared':
+        session = database.session()
+    else:
+        session = scoped_session(database.session)
+    api = NikonikoAPI(
+        hug.API('nikoniko-soak-{}'.format(uuid.uuid4().hex)),
+        session,
+        dict(secret_key=None, mailconfig=None,
+             logger=logging.getLogger(__name__)))
+    setup_session = database.session()
+    board_id, label, people = seed(setup_session, threads)
+    results, elapsed = run_players(
+        [Player(api, (board_id, label), person, number)
+         for number, person in enumerate(people)],
+        session, seconds, requests)
+    for step, finish in (
+            ('close', session.close),
+            ('cleanup', lambda: cleanup(
+                setup_session, board_id,
+                [person_id for person_id, _ in people])),
+            ('close', setup_session.close)):
+        try:
+            finish()
+        except Exception as exception:  # pylint: disable=broad-except
+            # a corrupted shared session may fail to let go of the run
+            results['errors']['failed ' + step] += 1
+            results['samples'].append('failed {}: {}'.format(
+                step, str(exception).split('\n', 1)[0]))
+    latencies = sorted(results['latencies'])
+    return dict(
+        mode=mode,
+        threads=threads,
+        ssl=uses_ssl(database),
+        requests=len(latencies),
+        seconds=elapsed,
+        errors=results['errors'],
+        samples=results['samples'],
+        p50=latencies[len(latencies) // 2] if latencies else 0,
+        p99=latencies[len(latencies) * 99 // 100] if latencies else 0)
+
+
+def format_report(report):
+    """Render the throughput and errors of a soak run"""
+    rate = report['requests'] / report['seconds'] \
+        if report['seconds'] else 0
+    lines = [
+        '{requests} requests from {threads} threads, {mode} session, '
+        'SSL {ssl_state}, in {seconds:.1f}s ({rate:.0f} requests/s, '
+        'p50 {p50_ms:.1f}ms, p99 {p99_ms:.1f}ms)'.format(
+            rate=rate,
+            ssl_state={True: 'on', False: 'off'}.get(report['ssl'], 'n/a'),
+            p50_ms=report['p50'] * 1000,
+            p99_ms=report['p99'] * 1000,
+            **report)]
+    lines.extend(
+        '{} {}'.format(count, kind)
+        for kind, count in report['errors'].most_common())
+    lines.extend(report['samples'][:MAX_ERROR_SAMPLES])
+    return '\n'.join(lines)
+
+
+def main(argv=None):
+    """Entry point of the nikoniko-soak command; fails if any request
+    failed or was answered wrong"""
+    parser = argparse.ArgumentParser(
+        description='Soak test the API with concurrent mixed traffic')
+    parser.add_argument(
+        '--db', default=None,
+        help='DB connection string (defaults to the DB_* environment)')
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument(
+        '--seconds', type=float, default=30,
+        help='how long to run for')
+    parser.add_argument(
+        '--requests', type=int, default=None,
+        help='stop each thread after that many requests')
+    parser.add_argument(
+        '--session', choices=SESSION_MODES, default='thread',
+        help='share one DB session between threads, or one per thread')
+    args = parser.parse_args(argv)
+    logging.basicConfig()
+    database = DB(args.db or db_connstring_from_environment())
+    database.create_all()
+    report = soak(
+        database, args.threads, args.seconds, args.requests, args.session)
+    print(format_report(report))
+    return 1 if report['errors'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,93 @@
+""" Helpers to stream large result sets out of the Nikoniko API """
+import csv
+import io
+import json
+
+EXPORT_CHUNK_ROWS = 1000
+
+
+class IterStream():
+    """Read-only file-like object over an iterator of byte chunks
+
+    hug hands anything with a ``read`` method straight to falcon as the
+    response stream, so wrapping a generator in this class lets an endpoint
+    send its body while it is still being produced. Closing it closes the
+    results given as well, e.g. the server-side cursors the chunks come
+    from, which closing their generator leaves open.
+    """
+    __slots__ = ('chunks', 'buffer', 'results')
+
+    def __init__(self, chunks, results=()):
+        self.chunks = iter(chunks)
+        self.buffer = b''
+        self.results = tuple(results)
+
+    def read(self, size=-1):
+        """Return up to size bytes, or everything left if size is negative
+
+        Like a socket, it returns as soon as some data is available rather
+        than waiting for size bytes; b'' means the end of the stream.
+        Without a size it drains the whole iterator, so never call it that
+        way on an endless stream such as server-sent events.
+        """
+        while size < 0 or not self.buffer:
+            try:
+                self.buffer += next(self.chunks)
+            except StopIteration:
+                break
+        if size < 0:
+            size = len(self.buffer)
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+    def close(self):
+        """Stop the underlying iterator and close the results"""
+        close = getattr(self.chunks, 'close', None)
+        if close:
+            close()
+        for result in self.results:
+            result.close()
+
+
+def _plain(value):
+    """Turn a column value into something json/csv can write"""
+    if hasattr(value, 'isoformat'):
+        return value.isoformat()
+    return value
+
+
+def ndjson_chunks(rows, columns, chunk_rows=EXPORT_CHUNK_ROWS):
+    """Encode rows as newline-delimited JSON, chunk_rows lines at a time"""
+    lines = []
+    for row in rows:
+        lines.append(json.dumps(
+            {column: _plain(value) for column, value in zip(columns, row)}))
+        if len(lines) >= chunk_rows:
+            yield ('\n'.join(lines) + '\n').encode()
+            lines = []
+    if lines:
+        yield ('\n'.join(lines) + '\n').encode()
+
+
+def csv_chunks(rows, columns, chunk_rows=EXPORT_CHUNK_ROWS):
+    """Encode rows as CSV with a header line, chunk_rows lines at a time"""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(columns)
+    pending = 0
+    for row in rows:
+        writer.writerow([_plain(value) for value in row])
+        pending += 1
+        if pending >= chunk_rows:
+            yield buffer.getvalue().encode()
+            buffer.seek(0)
+            buffer.truncate()
+            pending = 0
+    if buffer.tell():
+        yield buffer.getvalue().encode()
+
+
+EXPORT_FORMATS = {
+    'ndjson': ('application/x-ndjson', ndjson_chunks),
+    'csv': ('text/csv', csv_chunks),
+}
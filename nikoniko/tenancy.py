@@ -0,0 +1,142 @@
+""" Route DB sessions to the database (or schema) of the current tenant
+
+Each tenant gets its own engine, and so its own connection pool, built
+from a connection string template such as
+``postgresql://nikoniko@dbhost/nikoniko_{tenant}`` (a database per tenant)
+or ``postgresql://nikoniko@dbhost/nikoniko?options=-csearch_path%3D{tenant}``
+(a schema per tenant). Engines are created on first use and disposed of
+once idle, so only active tenants hold connections.
+
+Only the tenants of an explicit list are served, and their tables are
+created by provisioning them (on start), never while serving a request.
+"""
+import contextvars
+import logging
+import re
+import threading
+import time
+
+from collections import OrderedDict
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import scoped_session, sessionmaker
+
+from nikoniko.asgi import request_scope
+from nikoniko.entities import DB
+
+NULL_LOGGER = logging.getLogger(__name__)
+NULL_LOGGER.addHandler(logging.NullHandler())
+
+TENANT = contextvars.ContextVar('nikoniko_tenant')
+TENANT_NAME = re.compile(r'^[a-z0-9_]{1,63}$')
+
+
+class UnknownTenant(Exception):
+    """ Raised for tenants that are malformed or not allowed """
+
+
+def current_tenant():
+    """Return the tenant of the request being served, if any"""
+    return TENANT.get(None)
+
+
+def board_channel(board_id):
+    """Name the events channel of a board, which is per tenant since every
+    tenant numbers its boards from 1"""
+    tenant = current_tenant()
+    return '{}:{}'.format(tenant, board_id) if tenant else board_id
+
+
+class TenantRouter():
+    """Lazily created, idle-evicted engines, one per tenant"""
+    # pylint: disable=too-many-instance-attributes,too-many-arguments
+
+    def __init__(
+            self,
+            connstring_template,
+            tenants=None,
+            idle_seconds: float = 300,
+            max_tenants: int = 100,
+            echo=False,
+            logger=NULL_LOGGER):
+        if not tenants:
+            raise ValueError('No tenants to serve')
+        self.connstring_template = connstring_template
+        self.tenants = set(tenants)
+        self.idle_seconds = idle_seconds
+        self.max_tenants = max_tenants
+        self.echo = echo
+        self.logger = logger
+        self.engines = OrderedDict()
+        self.lock = threading.Lock()
+        self.session = scoped_session(
+            self.create_session, scopefunc=self.scope)
+
+    @staticmethod
+    def scope():
+        """scopefunc for the tenant sessions: one per request under ASGI,
+        one per tenant and thread otherwise"""
+        return request_scope() or (current_tenant(), threading.get_ident())
+
+    def check(self, tenant):
+        """Raise UnknownTenant unless tenant may be served"""
+        if not tenant or not TENANT_NAME.match(tenant) or \
+                tenant not in self.tenants:
+            raise UnknownTenant(tenant)
+
+    def create_engine(self, tenant):
+        """Return a new engine for the DB of a tenant"""
+        return create_engine(
+            self.connstring_template.format(tenant=tenant), echo=self.echo)
+
+    def provision(self, tenants=None):
+        """Create the missing tables of tenants, every served one by
+        default; run it on deploy or start, not while serving requests"""
+        for tenant in sorted(tenants or self.tenants):
+            self.check(tenant)
+            self.logger.info('Provisioning DB of tenant %s', tenant)
+            engine = self.create_engine(tenant)
+            try:
+                DB.base.metadata.create_all(engine)
+            finally:
+                engine.dispose()
+
+    def engine(self, tenant):
+        """Return the engine of a tenant, opening it the first time"""
+        self.check(tenant)
+        now = time.monotonic()
+        with self.lock:
+            engine, _ = self.engines.pop(tenant, (None, None))
+            self.evict_idle(now)
+            if engine is None:
+                # it connects on demand, once the lock is released
+                self.logger.info('Opening DB of tenant %s', tenant)
+                engine = self.create_engine(tenant)
+            self.engines[tenant] = (engine, now)
+        return engine
+
+    def evict_idle(self, now):
+        """Dispose of the pools of tenants idle for too long, or of the
+        least recently used ones when there are too many"""
+        for tenant, (engine, last_used) in list(self.engines.items()):
+            idle = now - last_used > self.idle_seconds
+            if not idle and len(self.engines) < self.max_tenants:
+                break
+            # NullPool (file SQLite) keeps no connections to count
+            checkedout = getattr(engine.pool, 'checkedout', None)
+            if checkedout and checkedout():
+                continue
+            self.logger.info('Closing DB of idle tenant %s', tenant)
+            engine.dispose()
+            del self.engines[tenant]
+
+    def dispose(self):
+        """Forget every engine, e.g. the ones inherited through a fork"""
+        with self.lock:
+            for engine, _ in self.engines.values():
+                engine.dispose()
+            self.engines.clear()
+
+    def create_session(self):
+        """Session factory bound to the engine of the current tenant"""
+        return sessionmaker(bind=self.engine(current_tenant()))()
@@ -21,4 +21,8 @@ else
     local-ssl-proxy --source 8443 --target 8080 --cert conf/etc/nginx/localhost.crt --key conf/etc/nginx/localhost.key & proxypid=$!
 fi
 
-uwsgi --pythonpath "${VIRTUAL_ENV}/lib/python3.6/site-packages" --logformat '%(addr) - %(user) [%(ltime)] "%(method) %(uri) %(proto)" %(status) %(size) "%(referer)" "%(uagent)"' --enable-threads $SOCKET_OPTS --module nikoniko.api --callable __hug_wsgi__
+if [ "$ASYNC" = "y" -o "$ASYNC" = "1" -o "$ASYNC" = "t" ] ; then
+    uvicorn --host 127.0.0.1 --port 8080 nikoniko.api_async:application
+else
+    uwsgi --pythonpath "${VIRTUAL_ENV}/lib/python3.6/site-packages" --logformat '%(addr) - %(user) [%(ltime)] "%(method) %(uri) %(proto)" %(status) %(size) "%(referer)" "%(uagent)"' --enable-threads $SOCKET_OPTS --module nikoniko.api --callable __hug_wsgi__
+fi
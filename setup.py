@@ -19,7 +19,13 @@ setup(
     author_email='jsangradorp@gmail.com',
     url='https://github.com/jsangradorp/nikonikoapi',
     license=license,
-    install_requires=['bcrypt', 'hug', 'sqlalchemy', 'marshmallow', 'pyjwt', 'psycopg2', 'sqlalchemy_utils'],
-    packages=find_packages(exclude=('tests', 'docs'))
+    install_requires=['bcrypt', 'hug', 'sqlalchemy', 'marshmallow', 'pyjwt', 'psycopg2', 'sqlalchemy_utils', 'numpy'],
+    packages=find_packages(exclude=('tests', 'docs')),
+    entry_points={
+        'console_scripts': [
+            'nikoniko-import=nikoniko.importer:main',
+            'nikoniko-soak=nikoniko.soak:main',
+            'nikoniko-archive=nikoniko.retention:main',
+            'nikoniko-benchmark=nikoniko.benchmark:main']}
 )
 
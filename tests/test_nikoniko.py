@@ -1,8 +1,17 @@
 ''' Test the nikoniko package '''
+import asyncio
+import io
+import json
 import logging
 import datetime
+import gzip
 import os
-from unittest.mock import patch
+import pstats
+import socketserver
+import threading
+import time
+from concurrent.futures import Executor, Future
+from unittest.mock import patch, Mock
 from smtplib import SMTPException
 
 import pytest
@@ -11,17 +20,47 @@ import bcrypt
 import hug
 import jwt
 
+from falcon import HTTP_400
 from falcon import HTTP_401
 from falcon import HTTP_404
 from falcon import HTTP_409
+from falcon import HTTP_501
+from falcon import HTTPForbidden
+from falcon import HTTPNotFound
+from falcon import HTTPTooManyRequests
 from falcon import Request
+from falcon import Response
 from falcon.testing import StartResponseMock, create_environ
+from sqlalchemy import event
 from sqlalchemy.exc import InvalidRequestError, OperationalError
 
-from nikoniko.entities import DB, Person, \
+from nikoniko.entities import DB, SQLITE_PRAGMAS, Person, \
         Board, ReportedFeeling, User, MEMBERSHIP
+from nikoniko.app import create_app
+from nikoniko.asgi import ASGIAdapter
+from nikoniko.benchmark import benchmark, sqlite_benchmark
+from nikoniko.cache import MemcachedCache, MemoryCache, ResponseCache
+from nikoniko.changes import change_cursor
+from nikoniko.entities import ArchivedFeeling
+from nikoniko.entities import BoardSnapshot, ChangeSequence
 from nikoniko.entities import InvalidatedToken
+from nikoniko.fieldsets import fieldset
+from nikoniko.hug_middleware_gzip import GzipMiddleware
+from nikoniko.hug_middleware_profile import ProfileMiddleware, profile_token
+from nikoniko.hug_middleware_ratelimit import MemoryBackend
+from nikoniko.hug_middleware_ratelimit import RateLimitMiddleware
+from nikoniko.hug_middleware_requestlog import RequestLogMiddleware
+from nikoniko.hug_middleware_tenant import TenantMiddleware
+from nikoniko.logs import QueueLogging
+from nikoniko.importer import import_feelings, InvalidInput
 from nikoniko.nikonikoapi import NikonikoAPI, check_password
+from nikoniko.nikonikoapi import snapshot_window
+from nikoniko.retention import archive_feelings, horizon
+from nikoniko.retention import main as archive_main
+from nikoniko.settings import db_connstring_from_environment
+from nikoniko.singleflight import SingleFlight
+from nikoniko.soak import soak
+from nikoniko.tenancy import TENANT, TenantRouter, current_tenant
 
 TESTLOGGER = logging.getLogger(__name__)
 TESTDB = DB('sqlite:///:memory:', echo=False)
@@ -59,12 +98,44 @@ NIKONIKOAPI = NikonikoAPI(
 NIKONIKOAPI.setup()
 
 
+class InlineExecutor(Executor):
+    ''' Run submitted calls right away: the in-memory DB is single thread '''
+    def submit(self, fn, *args, **kwargs):  # pylint: disable=arguments-differ
+        future = Future()
+        try:
+            future.set_result(fn(*args, **kwargs))
+        except Exception as exception:  # pylint: disable=broad-except
+            future.set_exception(exception)
+        return future
+
+
+class MemcachedStandIn(socketserver.StreamRequestHandler):
+    ''' Just enough of the memcached text protocol for the board cache '''
+    values = {}
+
+    def handle(self):
+        for line in self.rfile:
+            command, key, *args = line.decode().split()
+            if command == 'get':
+                if key in self.values:
+                    value = self.values[key]
+                    self.wfile.write('VALUE {} 0 {}\r\n'.format(
+                        key, len(value)).encode() + value + b'\r\n')
+                self.wfile.write(b'END\r\n')
+            elif command == 'set':
+                self.values[key] = self.rfile.read(int(args[2]) + 2)[:-2]
+                self.wfile.write(b'STORED\r\n')
+
+
 def delete_db_tables():
     ''' Delete all DB tables '''
     TESTENGINE.execute(
         MEMBERSHIP.delete())  # pylint: disable=no-value-for-parameter
     TESTENGINE.execute(User.__table__.delete())
     TESTENGINE.execute(ReportedFeeling.__table__.delete())
+    TESTENGINE.execute(BoardSnapshot.__table__.delete())
+    TESTENGINE.execute(ChangeSequence.__table__.delete())
+    TESTENGINE.execute(ArchivedFeeling.__table__.delete())
     TESTENGINE.execute(Person.__table__.delete())
     TESTENGINE.execute(Board.__table__.delete())
     TESTENGINE.execute(InvalidatedToken.__table__.delete())
@@ -584,3 +655,1033 @@ class TestAPI():  # pylint: disable=no-self-use
             .call_count == 2)
         assert (
             api.logger.error.call_count == 1)
+
+    def test_export_board(self, api, reportedfeeling1, board1):
+        # Given
+        response = StartResponseMock()
+        # When
+        result = api.export_board(board1.board_id, response)
+        # Then
+        assert response.content_type == 'application/x-ndjson'
+        assert result.read() == (
+            b'{"board_id": 1, "person_id": 1, "date": "2017-11-27", '
+            b'"feeling": "a-feeling"}\n')
+        # When
+        result = api.export_board(board1.board_id, response, 'csv')
+        # Then
+        assert response.content_type == 'text/csv'
+        assert result.read(8) == b'board_id'
+        assert result.read() == (
+            b',person_id,date,feeling\r\n1,1,2017-11-27,a-feeling\r\n')
+        # When
+        result = api.export_board(-1, response)
+        # Then
+        assert response.status == HTTP_404
+        assert result is None
+
+    def test_import_feelings(self, reportedfeeling1, board1, board2, person2):
+        # Given
+        csvfile = io.StringIO(
+            'board_id,person_id,date,feeling\n'
+            '1,1,2017-11-27,updated\n'
+            '1,1,2017-11-28,first\n'
+            '1,1,2017-11-28,good\n'
+            '2,2,2017-11-28,bad\n')
+        # When
+        report = import_feelings(TESTENGINE, [csvfile])
+        # Then
+        assert report['rows'] == 3
+        assert report['inserted'] == 2
+        assert report['updated'] == 1
+        assert report['memberships'] == 1
+        assert sorted(TESTENGINE.execute(
+            ReportedFeeling.__table__.select()).fetchall()) == [
+                (1, 1, datetime.date(2017, 11, 27), 'updated', 1),
+                (1, 1, datetime.date(2017, 11, 28), 'good', 1),
+                (2, 2, datetime.date(2017, 11, 28), 'bad', 1)]
+        assert (2, 2) in TESTENGINE.execute(MEMBERSHIP.select()).fetchall()
+        # When
+        csvfile = io.StringIO(
+            'board_id,person_id,date,feeling\n'
+            '1,1,2017-11-29,good\n'
+            '9,1,2017-11-29,good\n'
+            '1,1,not-a-date,good\n')
+        # Then
+        with pytest.raises(InvalidInput) as excinfo:
+            import_feelings(TESTENGINE, [csvfile])
+        assert len(excinfo.value.problems) == 2
+        assert TESTENGINE.execute(
+            ReportedFeeling.__table__.count()).scalar() == 3
+
+    def test_asgi_adapter(self, person1):
+        # Given
+        on_finish = Mock()
+        application = ASGIAdapter(
+            TESTAPI.http.server(),
+            InlineExecutor(),
+            on_finish=on_finish)
+        received = [{'type': 'http.request', 'body': b''}]
+        sent = []
+
+        async def receive():
+            return received.pop(0)
+
+        async def send(message):
+            sent.append(message)
+        # When
+        asyncio.run(application(
+            {
+                'type': 'http',
+                'method': 'GET',
+                'path': '/people',
+                'headers': [(b'authorization', TOKEN.encode())]
+            },
+            receive,
+            send))
+        # Then
+        assert sent[0]['status'] == 200
+        assert json.loads(b''.join(
+            message.get('body', b'') for message in sent[1:])) == [
+                {'person_id': person1.person_id, 'label': person1.label}]
+        assert on_finish.call_count == 1
+
+    def test_password_reset_code_mail_executor(self, api, user1, mocker):
+        # Given
+        api.mail_executor = InlineExecutor()
+        mocker.patch.object(api, 'sendmail')
+        api.sendmail.side_effect = ConnectionRefusedError()
+        mocker.spy(api.logger, 'error')
+        # When
+        api.password_reset_code(user1.email)
+        # Then
+        assert api.sendmail.call_count == 1  # pylint: disable=no-member
+        assert api.logger.error.call_count == 1
+
+    def test_ratelimit_memory_backend(self):
+        # Given
+        backend = MemoryBackend(max_keys=2)
+        # When / Then
+        assert backend.take('a', 1, 2, 0) == 0
+        assert backend.take('a', 1, 2, 0) == 0
+        assert backend.take('a', 1, 2, 0) == 1
+        assert backend.take('a', 1, 2, 1) == 0
+        # When
+        backend.take('b', 1, 2, 1)
+        backend.take('c', 1, 2, 1)
+        # Then
+        assert set(backend.buckets) == {'b', 'c'}
+
+    def test_ratelimit_middleware(self):
+        # Given
+        middleware = RateLimitMiddleware(
+            ip_per_minute=60, ip_burst=3, email_per_minute=60, email_burst=1)
+
+        def request(email, path='/login'):
+            return Request(create_environ(
+                path=path,
+                method='POST',
+                body='{{"email": "{}", "password": "x"}}'.format(email),
+                headers={'Content-Type': 'application/json'}))
+        # When
+        first = request('bob@example.com')
+        middleware.process_request(first, None)
+        # Then
+        assert first.stream.read() == (
+            b'{"email": "bob@example.com", "password": "x"}')
+        with pytest.raises(HTTPTooManyRequests):
+            middleware.process_request(request('Bob@example.com'), None)
+        middleware.process_request(request('alice@example.com'), None)
+        middleware.process_request(request('x', path='/people'), None)
+        with pytest.raises(HTTPTooManyRequests):
+            middleware.process_request(request('carol@example.com'), None)
+
+    def test_gzip_middleware(self):
+        # Given
+        middleware = GzipMiddleware(min_size=10)
+        accepting = Request(create_environ(
+            headers={'Accept-Encoding': 'deflate, gzip;q=0.5'}))
+        refusing = Request(create_environ(
+            headers={'Accept-Encoding': 'gzip;q=0'}))
+        body = b'{"feeling": "good"}' * 10
+
+        def response(data=None, stream=None):
+            result = Response()
+            result.data = data
+            result.stream = stream
+            return result
+        # When
+        compressed = response(body)
+        middleware.process_response(accepting, compressed, None)
+        # Then
+        assert compressed.get_header('Content-Encoding') == 'gzip'
+        assert gzip.decompress(compressed.data) == body
+        # When
+        small = response(b'{}')
+        middleware.process_response(accepting, small, None)
+        refused = response(body)
+        middleware.process_response(refusing, refused, None)
+        # Then
+        assert small.data == b'{}'
+        assert refused.data == body
+        assert refused.get_header('Content-Encoding') is None
+        # When
+        streamed = response(stream=io.BytesIO(body))
+        middleware.process_response(accepting, streamed, None)
+        # Then
+        assert gzip.decompress(streamed.stream.read()) == body
+
+    def test_board_events(self, api, board1, person1):
+        # Given
+        response = Response()
+        api.sse_keepalive = 0.01
+        synchronous = Request(create_environ())
+        asynchronous = Request(create_environ())
+        asynchronous.env['nikoniko.asgi'] = True
+        # When
+        result = api.board_events(board1.board_id, synchronous, response)
+        # Then
+        assert response.status == HTTP_501
+        # When
+        result = api.board_events(-1, asynchronous, response)
+        # Then
+        assert response.status == HTTP_404
+        assert result is None
+        # When
+        response = Response()
+        events = api.board_events(board1.board_id, asynchronous, response)
+        # Then
+        assert response.content_type == 'text/event-stream'
+        with pytest.raises(RuntimeError):
+            events.read(8192)
+
+        async def read_events():
+            chunks = events.__aiter__()
+            received = [await chunks.__anext__(), await chunks.__anext__()]
+            api.create_reported_feeling(
+                board1.board_id, person1.person_id, 'good', '2017-12-01')
+            received.append(await chunks.__anext__())
+            await chunks.aclose()
+            return received
+        # When
+        received = asyncio.run(read_events())
+        # Then
+        assert received[:2] == [b'retry: 10\n\n', b': keepalive\n\n']
+        event, data = received[2].decode().split('\n', 1)
+        assert event == 'event: reportedfeeling'
+        assert json.loads(data[len('data: '):]) == {
+            'person_id': 1, 'board_id': 1, 'date': '2017-12-01',
+            'feeling': 'good'}
+        assert not api.broker.subscribers
+
+    def test_asgi_board_events(self, board1):
+        # Given
+        application = ASGIAdapter(TESTAPI.http.server(), InlineExecutor())
+        NIKONIKOAPI.sse_keepalive = 60
+        sent = []
+        received = [{'type': 'http.request', 'body': b''}]
+
+        async def receive():
+            if received:
+                return received.pop(0)
+            while len(sent) < 2:
+                await asyncio.sleep(0.01)
+            return {'type': 'http.disconnect'}
+
+        async def send(message):
+            sent.append(message)
+        # When
+        asyncio.run(application(
+            {
+                'type': 'http',
+                'method': 'GET',
+                'path': '/boards/{}/events'.format(board1.board_id),
+                'query_string': 'token={}'.format(TOKEN).encode()
+            },
+            receive,
+            send))
+        # Then
+        assert sent[0]['status'] == 200
+        assert sent[1]['body'] == b'retry: 60000\n\n'
+        assert not NIKONIKOAPI.broker.subscribers
+
+    def test_ratelimit_keeps_login_body(self, user1):
+        # When
+        json_login = hug.test.post(  # pylint: disable=no-member
+            TESTAPI,
+            '/login',
+            body={'email': user1.email, 'password': 'onepassword'})
+        form_login = hug.test.post(  # pylint: disable=no-member
+            TESTAPI,
+            '/login',
+            body='email={}&password=onepassword'.format(user1.email),
+            headers={'content-type': 'application/x-www-form-urlencoded'})
+        # Then
+        assert json_login.status == '200 OK'
+        assert json_login.data['user'] == user1.user_id
+        assert form_login.status == '200 OK'
+        assert form_login.data['user'] == user1.user_id
+
+    def test_tenancy(self, tmp_path):
+        # Given
+        router = TenantRouter(
+            'sqlite:///{}/{{tenant}}.db'.format(tmp_path),
+            tenants=['acme', 'globex'],
+            max_tenants=1)
+        router.provision()
+        middleware = TenantMiddleware(router, SECRET_KEY, 'example.com')
+        tenant_api = NikonikoAPI(
+            TESTAPI, router.session, dict(TESTCONFIG, tenants=router))
+        tenant = TENANT.set('acme')
+        router.session.add(Person(person_id=1, label='Wile E. Coyote'))
+        router.session.add(User(
+            user_id=1,
+            name='Wile E. Coyote',
+            email='wile@example.com',
+            person_id=1,
+            password_hash=bcrypt.hashpw(b'acme', bcrypt.gensalt())))
+        router.session.commit()
+        TENANT.reset(tenant)
+
+        def serve(host, endpoint, token=None, **kwargs):
+            request = Request(create_environ(
+                host=host,
+                headers={'Authorization': token} if token else {}))
+            response = Response()
+            middleware.process_request(request, response)
+            try:
+                return endpoint(response=response, **kwargs)
+            finally:
+                middleware.process_response(request, response, None)
+        # When
+        login = serve(
+            'acme.example.com', tenant_api.login,
+            email='wile@example.com', password='acme')
+        token = login['token'].decode()
+        people = serve(
+            'acme.example.com',
+            lambda response: tenant_api.people(),
+            token=token)
+        # Then
+        assert jwt.decode(token, SECRET_KEY, algorithm='HS256')[
+            'tenant'] == 'acme'
+        assert people == [{'person_id': 1, 'label': 'Wile E. Coyote'}]
+        assert current_tenant() is None
+        with pytest.raises(HTTPForbidden):
+            serve('globex.example.com', tenant_api.people, token=token)
+        with pytest.raises(HTTPNotFound):
+            serve('initech.example.com', tenant_api.people)
+        assert serve(
+            'globex.example.com',
+            lambda response: tenant_api.people()) == []
+        assert list(router.engines) == ['globex']
+        # only provisioning creates DBs, of allowed tenants
+        assert sorted(path.name for path in tmp_path.iterdir()) == [
+            'acme.db', 'globex.db']
+        TenantRouter(
+            'sqlite:///{}/{{tenant}}.db'.format(tmp_path),
+            tenants=['initech']).engine('initech')
+        assert not (tmp_path / 'initech.db').exists()
+        with pytest.raises(ValueError):
+            TenantRouter('sqlite:///{}/{{tenant}}.db'.format(tmp_path))
+
+    def test_create_app(self, tmp_path):
+        # Given
+        connstring = 'sqlite:///{}/nikoniko.db'.format(tmp_path)
+        # When
+        with patch('nikoniko.app.db_connstring_from_environment',
+                   return_value=connstring), \
+                patch('nikoniko.app.after_fork') as after_fork:
+            nikonikoapi, nikonikodb = create_app('create_app_test')
+        with patch.object(nikonikodb.engine, 'dispose') as dispose:
+            after_fork.call_args[0][0]()
+        # Then
+        assert nikonikoapi.api is hug.API('create_app_test')
+        assert '/login' in nikonikoapi.api.http.routes['']
+        assert dispose.called
+
+    def test_board_cache(self, board1, person1):
+        # Given
+        board_id, person_id = board1.board_id, person1.person_id
+        server = socketserver.ThreadingTCPServer(
+            ('127.0.0.1', 0), MemcachedStandIn)
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        for backend in (
+                MemoryCache(max_items=10),
+                MemcachedCache(server.server_address)):
+            TESTSESSION.expunge_all()
+            TESTENGINE.execute(ReportedFeeling.__table__.delete())
+            cached_api = NikonikoAPI(
+                TESTAPI,
+                TESTSESSION,
+                dict(TESTCONFIG, cache=ResponseCache(backend)))
+            response = StartResponseMock()
+            december = dict(
+                from_date=datetime.date(2017, 12, 1),
+                to_date=datetime.date(2017, 12, 31))
+            # When
+            before = cached_api.board(board_id, response, **december)
+            TESTENGINE.execute(
+                ReportedFeeling.__table__.insert(),
+                board_id=board_id,
+                person_id=person_id,
+                date=datetime.date(2017, 12, 1),
+                feeling='bad')
+            behind_its_back = cached_api.board(
+                board_id, response, **december)
+            cached_api.create_reported_feeling(
+                board_id, person_id, 'good', '2017-12-02')
+            after = cached_api.board(board_id, response, **december)
+            november = cached_api.board(
+                board_id, response,
+                from_date=datetime.date(2017, 11, 1),
+                to_date=datetime.date(2017, 11, 30))
+            # Then
+            assert before['people'][0]['reportedfeelings'] == []
+            assert behind_its_back == before
+            assert [feeling['feeling'] for feeling in after['people'][0][
+                'reportedfeelings']] == ['bad', 'good']
+            assert november['people'][0]['reportedfeelings'] == []
+        server.shutdown()
+        server.server_close()
+
+    def test_single_flight(self, board1):
+        # Given
+        board_id = board1.board_id
+        flying_api = NikonikoAPI(
+            TESTAPI, TESTSESSION, dict(TESTCONFIG, flights=SingleFlight()))
+        release = threading.Event()
+        computed = []
+        results = []
+
+        def slow_payload(board_id, from_date, to_date, fields):
+            # pylint: disable=unused-argument
+            computed.append(board_id)
+            payload = {'board_id': board_id, 'computed': len(computed)}
+            release.wait(10)
+            return payload
+
+        def read():
+            results.append(flying_api.board(
+                board_id, Response(),
+                from_date=datetime.date(2017, 12, 1)))
+        readers = [threading.Thread(target=read) for _ in range(4)]
+        # When
+        with patch.object(flying_api, 'board_payload', slow_payload):
+            for reader in readers:
+                reader.start()
+            time.sleep(0.2)
+            # a write: later reads don't join the flight started before it
+            flying_api.invalidate_board(board_id)
+            after_write = threading.Thread(target=read)
+            after_write.start()
+            time.sleep(0.2)
+            release.set()
+            for reader in readers + [after_write]:
+                reader.join()
+        flight_error = RuntimeError('failed')
+        failures = []
+
+        def fail():
+            time.sleep(0.2)
+            raise flight_error
+
+        def join_failure():
+            try:
+                flying_api.flights.run(('failing',), fail)
+            except RuntimeError as error:
+                failures.append(error)
+        failing = [threading.Thread(target=join_failure) for _ in range(2)]
+        for thread in failing:
+            thread.start()
+        for thread in failing:
+            thread.join()
+        # Then
+        assert computed == [board_id] * 2
+        assert sorted(result['computed'] for result in results) == [
+            1, 1, 1, 1, 2]
+        assert failures == [flight_error] * 2
+        assert not flying_api.flights.flights
+
+    def test_sparse_fieldsets(self, api, board1, person1, reportedfeeling1):
+        # Given
+        statements = []
+
+        def record(conn, cursor, statement, *args):
+            # pylint: disable=unused-argument
+            statements.append(statement)
+        event.listen(TESTENGINE, 'before_cursor_execute', record)
+        response = StartResponseMock()
+        # When
+        board = api.board(
+            board1.board_id, response,
+            fields=fieldset('label,people.label'))
+        board_statements, statements[:] = statements[:], []
+        person = api.get_person(
+            person1.person_id, response, fields=fieldset('person_id'))
+        person_statements = statements[:]
+        event.remove(TESTENGINE, 'before_cursor_execute', record)
+        over_http = hug.test.get(  # pylint: disable=no-member
+            TESTAPI,
+            '/boards/{}'.format(board1.board_id),
+            headers={'Authorization': TOKEN},
+            fields='people.reportedfeelings.feeling')
+        invalid = hug.test.get(  # pylint: disable=no-member
+            TESTAPI,
+            '/people',
+            headers={'Authorization': TOKEN},
+            fields='label,password_hash')
+        # Then
+        assert board == {'label': 'Daganzo', 'people': [{'label': 'Julio'}]}
+        assert not any('reportedfeelings' in statement
+                       for statement in board_statements)
+        assert person == {'person_id': 1}
+        assert 'label' not in person_statements[0]
+        assert over_http.data == {
+            'people': [{'reportedfeelings': [{'feeling': 'a-feeling'}]}]}
+        assert invalid.status == HTTP_400
+
+    def test_batch_reads(self, api, person1, person2, reportedfeeling1):
+        # Given
+        response = StartResponseMock()
+        api.create_reported_feeling(
+            reportedfeeling1.board_id, person1.person_id, 'good',
+            '2017-11-28')
+        # When
+        people = hug.test.get(  # pylint: disable=no-member
+            TESTAPI,
+            '/people/batch',
+            headers={'Authorization': TOKEN},
+            ids='{},{},99'.format(person2.person_id, person1.person_id))
+        feelings = api.get_reported_feelings(
+            reportedfeeling1.board_id,
+            datetime.date(2017, 11, 1),
+            datetime.date(2017, 11, 30),
+            response,
+            person_ids=[person1.person_id])
+        too_long = api.get_reported_feelings(
+            reportedfeeling1.board_id,
+            datetime.date(2016, 12, 31),
+            datetime.date(2018, 1, 1),
+            response)
+        # Then
+        assert people.data == {
+            'people': [
+                {'person_id': person1.person_id, 'label': person1.label},
+                {'person_id': person2.person_id, 'label': person2.label}],
+            'missing': [99]}
+        assert [(feeling['date'], feeling['feeling'])
+                for feeling in feelings] == [
+                    ('2017-11-27', 'a-feeling'), ('2017-11-28', 'good')]
+        assert response.status == HTTP_400
+        assert too_long.startswith('from_date')
+
+    def test_board_analytics(self, api, person1, person2, reportedfeeling1):
+        # Given
+        response = StartResponseMock()
+        board_id = reportedfeeling1.board_id
+        for person, feeling, day in (
+                (person1, 'bad', '2017-11-01'),
+                (person1, 'bad', '2017-11-02'),
+                (person1, 'good', '2017-11-03'),
+                (person1, 'bad', '2017-11-06'),
+                (person1, 'bad', '2017-11-08'),
+                (person2, 'good', '2017-11-01'),
+                (person2, 'good', '2017-11-02'),
+                (person2, 'good', '2017-11-03'),
+                (person2, 'neutral', '2017-11-06'),
+                (person2, 'bad', '2017-11-08')):
+            api.create_reported_feeling(
+                board_id, person.person_id, feeling, day)
+        # When
+        analytics = api.board_analytics(
+            board_id, response,
+            from_date=datetime.date(2017, 11, 1),
+            to_date=datetime.date(2017, 11, 8),
+            window=2)
+        too_long = api.board_analytics(
+            board_id, response,
+            from_date=datetime.date(2014, 1, 1),
+            to_date=datetime.date(2017, 11, 8))
+        # Then
+        assert analytics['mood'] == [
+            0.0, 0.0, 1.0, None, None, -0.5, None, -1.0]
+        assert analytics['rolling_mood'] == [
+            0.0, 0.0, 0.5, 1.0, None, -0.5, -0.5, -1.0]
+        assert {
+            streak['person_id']: (
+                streak['longest_bad_streak'], streak['current_bad_streak'])
+            for streak in analytics['streaks']} == {
+                person1.person_id: (2, 2), person2.person_id: (1, 1)}
+        assert analytics['baseline']['mood'] == -0.1
+        assert analytics['baseline']['recent_mood'] == -1.0
+        assert analytics['outliers'] == []
+        assert response.status == HTTP_400
+        assert too_long.startswith('from_date')
+
+    def test_baked_lookups(self, api, person1, person2, reportedfeeling1):
+        # Given
+        response = StartResponseMock()
+        compiled = []
+
+        def remember(conn, cursor, statement, parameters, context,
+                     executemany):
+            # pylint: disable=unused-argument,too-many-arguments
+            compiled.append(context.compiled)
+        event.listen(TESTENGINE, 'before_cursor_execute', remember)
+        # When
+        people = [
+            api.get_person(person.person_id, response)
+            for person in (person1, person2, person1, person2)]
+        feelings = [
+            api.get_reported_feeling(
+                reportedfeeling1.board_id, reportedfeeling1.person_id,
+                date, response)
+            for date in ('2017-11-27', '2017-11-28')]
+        event.remove(TESTENGINE, 'before_cursor_execute', remember)
+        # Then
+        assert [person['label'] for person in people] == [
+            person1.label, person2.label] * 2
+        assert feelings[0]['feeling'] == reportedfeeling1.feeling
+        assert feelings[1] is None
+        # once warm, lookups are only bound to their parameters
+        people_lookups = [
+            statement for statement in compiled
+            if 'FROM people' in statement.string]
+        feeling_lookups = [
+            statement for statement in compiled
+            if 'WHERE reportedfeelings.board_id = ?' in statement.string]
+        assert len({id(statement) for statement in people_lookups[-3:]}) == 1
+        assert len(feeling_lookups) == 2
+        assert feeling_lookups[0] is feeling_lookups[1]
+
+    def test_soak(self, tmp_path):
+        # Given
+        database = DB(
+            'sqlite:///{}'.format(tmp_path / 'soak.db'),
+            # as PostgreSQL does, so that cleanup must respect them
+            sqlite_pragmas=SQLITE_PRAGMAS + (('foreign_keys', 'ON'),))
+        database.create_all()
+        # When
+        report = soak(database, threads=4, seconds=60, requests=25)
+        # Then
+        assert report['requests'] == 100
+        assert not report['errors'], report['samples']
+        assert report['ssl'] is None
+        assert not database.engine.execute(
+            'SELECT count(*) FROM people').scalar()
+
+    def test_benchmark(self, tmp_path):
+        # Given
+        database = DB('sqlite:///{}'.format(tmp_path / 'benchmark.db'))
+        database.create_all()
+        # When
+        report = benchmark(database, people=300, boards=5, members=10,
+                           repeat=2)
+        # Then
+        assert set(report['measures']) == {'people', 'boards', 'person'}
+        people = report['measures']['people']
+        assert people['projection']['peak'] < people['entities']['peak']
+        assert not database.engine.execute(
+            'SELECT count(*) FROM people').scalar()
+
+    def test_sqlite_embedded(self, tmp_path, monkeypatch):
+        # Given
+        monkeypatch.setenv('DB_DRIVER', 'sqlite')
+        monkeypatch.setenv('DB_DBNAME', str(tmp_path / 'embedded.db'))
+        # When
+        connstring = db_connstring_from_environment()
+        database = DB(connstring)
+        pragmas = {
+            name: database.engine.execute('PRAGMA {}'.format(name)).scalar()
+            for name in ('journal_mode', 'synchronous', 'busy_timeout')}
+        in_memory = DB('sqlite://')
+        report = sqlite_benchmark(str(tmp_path), processes=2, seconds=0.5)
+        # Then
+        assert connstring == 'sqlite:///{}'.format(tmp_path / 'embedded.db')
+        assert pragmas == {
+            'journal_mode': 'wal', 'synchronous': 1, 'busy_timeout': 5000}
+        assert in_memory.engine.execute(
+            'PRAGMA journal_mode').scalar() == 'memory'
+        assert set(report) == {'embedded', 'default'}
+        assert report['embedded']['writes'] > 0
+        assert not report['embedded']['errors']
+
+    def test_profile_middleware(self, tmp_path):
+        # Given
+        middleware = ProfileMiddleware(
+            str(tmp_path), secret='profiling', keep=2)
+
+        def request(token, path):
+            request = Request(create_environ(
+                path=path, headers={'X-Nikoniko-Profile': token}))
+            response = Response()
+            middleware.process_request(request, response)
+            TESTENGINE.execute('SELECT 1')
+            middleware.process_response(request, response, None)
+        # When
+        for path in ('/first', '/second', '/third'):
+            request(profile_token('profiling'), path)
+        request(profile_token('profiling', ttl=-1), '/expired')
+        request(profile_token('guessed'), '/forged')
+        # Then
+        profiles = sorted(path.name for path in tmp_path.iterdir())
+        assert [profile.split('-', 1)[1] for profile in profiles] == [
+            'GET-second.prof', 'GET-second.sql.json',
+            'GET-third.prof', 'GET-third.sql.json']
+        with open(str(tmp_path / profiles[-1])) as sql:
+            queries = json.load(sql)['queries']
+        assert [query['statement'] for query in queries] == ['SELECT 1']
+        assert pstats.Stats(str(tmp_path / profiles[-2])).total_calls
+
+    def test_request_logging(self):
+        # Given
+        output = io.StringIO()
+        queue_logging = QueueLogging(json_format=True)
+        queue_logging.listener.handlers[0].setStream(output)
+        queue_logging.listener.start()
+        logger = logging.getLogger('test_request_logging')
+        logger.propagate = False
+        logger.setLevel(logging.DEBUG)
+        logger.addHandler(queue_logging.queue_handler)
+        middleware = RequestLogMiddleware(debug_sample_rate=0)
+        request = Request(create_environ(
+            path='/boards/1', headers={'X-Request-ID': 'abc-123'}))
+        response = Response()
+        # When
+        middleware.process_request(request, response)
+        logger.debug('Not sampled')
+        logger.info('Board %s', 1)
+        middleware.process_response(request, response, None)
+        logger.debug('Outside requests')
+        queue_logging.stop()
+        # Then
+        records = [json.loads(line) for line in output.getvalue().splitlines()]
+        assert [(record['request_id'], record['message'])
+                for record in records] == [
+                    ('abc-123', 'Board 1'), ('-', 'Outside requests')]
+        assert response.get_header('X-Request-ID') == 'abc-123'
+
+    def test_reported_feeling_changes(self, api, board1, person1):
+        # Given
+        response = StartResponseMock()
+        for date in ('2017-11-27', '2017-11-28', '2017-11-29'):
+            api.create_reported_feeling(
+                board1.board_id, person1.person_id, 'good', date)
+        # When
+        first = api.reported_feeling_changes(
+            board1.board_id, response, limit=2)
+        rest = api.reported_feeling_changes(
+            board1.board_id, response, change_cursor(first['cursor']))
+        api.create_reported_feeling(
+            board1.board_id, person1.person_id, 'bad', '2017-11-27')
+        import_feelings(TESTENGINE, [io.StringIO(
+            'board_id,person_id,date,feeling\n'
+            '1,1,2017-11-30,neutral\n')])
+        updated = api.reported_feeling_changes(
+            board1.board_id, response, change_cursor(rest['cursor']))
+        unchanged = api.reported_feeling_changes(
+            board1.board_id, response, change_cursor(updated['cursor']))
+        invalid = hug.test.get(  # pylint: disable=no-member
+            TESTAPI,
+            '/reportedfeelings/boards/{}/changes'.format(board1.board_id),
+            headers={'Authorization': TOKEN},
+            cursor='nonsense')
+        missing = api.reported_feeling_changes(-1, response)
+        # Then
+        assert [change['date'] for change in first['changes']] == [
+            '2017-11-27', '2017-11-28']
+        assert first['more']
+        assert [change['date'] for change in rest['changes']] == [
+            '2017-11-29']
+        assert not rest['more']
+        assert [(change['date'], change['feeling'])
+                for change in updated['changes']] == [
+                    ('2017-11-27', 'bad'), ('2017-11-30', 'neutral')]
+        assert unchanged == {
+            'changes': [], 'cursor': updated['cursor'], 'more': False}
+        assert invalid.status == HTTP_400
+        assert missing is None
+        assert response.status == HTTP_404
+
+    def test_first_change_race(self, api, board1, person1):
+        # Given
+        board_id = board1.board_id
+        sequences = ChangeSequence.__table__
+        raced = []
+
+        def concurrent_first_write(conn, cursor, statement, *args):
+            # pylint: disable=unused-argument
+            if not raced and statement.startswith('UPDATE changesequences'):
+                # as if committed by another writer before ours inserts
+                raced.append(statement)
+                conn.connection.cursor().execute(
+                    'INSERT INTO changesequences VALUES (?, 1)', (board_id,))
+        event.listen(
+            TESTENGINE, 'after_cursor_execute', concurrent_first_write)
+        # When
+        try:
+            api.create_reported_feeling(
+                board_id, person1.person_id, 'good', '2017-11-27')
+        finally:
+            event.remove(
+                TESTENGINE, 'after_cursor_execute', concurrent_first_write)
+        # Then
+        assert raced
+        assert TESTSESSION.query(ReportedFeeling.change_seq).scalar() == 2
+        assert TESTENGINE.execute(
+            sequences.select()).fetchall() == [(board_id, 2)]
+
+    def test_snapshot_rebuild_lock(self, api, board1, person1):
+        # Given
+        board_id = board1.board_id
+        window_start, _ = snapshot_window()
+        statements = []
+
+        def remember(conn, cursor, statement, *args):
+            # pylint: disable=unused-argument
+            statements.append(statement.split('(')[0].strip())
+        event.listen(TESTENGINE, 'before_cursor_execute', remember)
+        # When
+        rebuilt = api.board(board_id, Response(), from_date=window_start)
+        response = Response()
+        missing = api.board(-1, response, from_date=window_start)
+        event.remove(TESTENGINE, 'before_cursor_execute', remember)
+        # Then
+        writes = [
+            statement for statement in statements
+            if statement.startswith(('UPDATE', 'INSERT'))]
+        # the read's rebuild waits for writes of the board's feelings
+        assert writes[0].startswith('UPDATE changesequences')
+        assert 'INSERT INTO boardsnapshots' in writes
+        assert json.loads(rebuilt.read())['board_id'] == board_id
+        assert missing is None
+        assert response.status == HTTP_404
+        assert TESTENGINE.execute(
+            ChangeSequence.__table__.select()).fetchall() == [(board_id, 0)]
+
+    def test_retention(self, api, board1, person1, reportedfeeling1):
+        # Given
+        response = StartResponseMock()
+        today = datetime.date.today()
+        api.create_reported_feeling(
+            board1.board_id, person1.person_id, 'good', today.isoformat())
+        # When
+        report = archive_feelings(TESTENGINE, horizon(100))
+        hot = TESTENGINE.execute(
+            ReportedFeeling.__table__.select()).fetchall()
+        board = api.board(board1.board_id, response)
+        feeling = api.get_reported_feeling(
+            board1.board_id, person1.person_id, '2017-11-27', response)
+        feelings = api.get_reported_feelings(
+            board1.board_id, datetime.date(2017, 11, 1),
+            datetime.date(2017, 11, 30), response)
+        export = api.export_board(board1.board_id, response).read()
+        changes = api.reported_feeling_changes(board1.board_id, response)
+        after_archive = api.reaches_archive(
+            board1.board_id, datetime.date(2017, 11, 28))
+        api.create_reported_feeling(
+            board1.board_id, person1.person_id, 'bad', '2017-11-27')
+        rewritten = TESTENGINE.execute(
+            ArchivedFeeling.__table__.select()).fetchall()
+        archive_feelings(TESTENGINE, horizon(100))
+        archived = TESTENGINE.execute(
+            ArchivedFeeling.__table__.select()).fetchall()
+        # Then
+        assert report['moved'] == 1
+        assert [row.date for row in hot] == [today]
+        assert [feeling['date'] for feeling in board['people'][0][
+            'reportedfeelings']] == ['2017-11-27', today.isoformat()]
+        assert feeling['feeling'] == 'a-feeling'
+        assert [feeling['feeling'] for feeling in feelings] == ['a-feeling']
+        assert len(export.splitlines()) == 2
+        # archived history, then what changed since
+        assert [change['date'] for change in changes['changes']] == [
+            '2017-11-27', today.isoformat()]
+        assert not after_archive
+        assert not rewritten
+        assert [(row.date, row.feeling) for row in archived] == [
+            (datetime.date(2017, 11, 27), 'bad')]
+        with pytest.raises(SystemExit):
+            archive_main(['--days', '7'])
+
+    def test_export_archive_merge(self, api, board1, person1):
+        # Given
+        response = StartResponseMock()
+        board_id, person_id = board1.board_id, person1.person_id
+        today = datetime.date.today().isoformat()
+        for day in ('2017-11-26', '2017-11-27', '2017-11-28', today):
+            api.create_reported_feeling(board_id, person_id, 'good', day)
+        hot_only = api.export_board(board_id, response)
+        hot_only.close()
+        archive_feelings(TESTENGINE, horizon(100))
+        api.create_reported_feeling(board_id, person_id, 'bad', '2017-11-26')
+        # When
+        export = api.export_board(board_id, response)
+        lines = export.read().splitlines()
+        export.close()
+        # Then
+        assert len(hot_only.results) == 1
+        assert all(result.closed for result in hot_only.results)
+        assert len(export.results) == 2
+        assert all(result.closed for result in export.results)
+        assert [
+            (json.loads(line)['date'], json.loads(line)['feeling'])
+            for line in lines] == [
+                ('2017-11-26', 'bad'), ('2017-11-27', 'good'),
+                ('2017-11-28', 'good'), (today, 'good')]
+
+    def test_boards_overview(self, api, board1, board2, person1, person2):
+        # Given
+        api.add_board_members(
+            board1.board_id, [person2.person_id], Response())
+        for board, person, feeling, date in (
+                (board1, person1, 'good', '2017-11-28'),
+                (board1, person2, 'bad', '2017-11-28'),
+                (board2, person2, 'bad', '2017-11-28'),
+                (board1, person1, 'bad', '2017-11-27'),
+                (board1, person2, 'bad', '2017-11-27')):
+            api.create_reported_feeling(
+                board.board_id, person.person_id, feeling, date)
+        queries = []
+
+        def remember(conn, cursor, statement, *args):
+            # pylint: disable=unused-argument
+            queries.append(statement)
+        event.listen(TESTENGINE, 'before_cursor_execute', remember)
+        # When
+        overview = hug.test.get(  # pylint: disable=no-member
+            TESTAPI,
+            '/boards/overview',
+            headers={'Authorization': TOKEN},
+            date='2017-11-28')
+        event.remove(TESTENGINE, 'before_cursor_execute', remember)
+        # Then
+        assert overview.data == {
+            'date': '2017-11-28',
+            'boards': [
+                {'board_id': board1.board_id, 'label': board1.label,
+                 'members': 2, 'reports': 2, 'dominant_feeling': 'bad'},
+                {'board_id': board2.board_id, 'label': board2.label,
+                 'members': 0, 'reports': 1, 'dominant_feeling': 'bad'}]}
+        assert len([
+            query for query in queries if 'FROM boards' in query]) == 1
+
+    def test_board_members(self, api, board1, person1, person2):
+        # Given
+        window_start, _ = snapshot_window()
+        api.board(board1.board_id, Response(), from_date=window_start)
+        api.cache = Mock()
+        # When
+        added = hug.test.post(  # pylint: disable=no-member
+            TESTAPI,
+            '/boards/{}/people'.format(board1.board_id),
+            headers={'Authorization': TOKEN},
+            ids='{},{},99'.format(person1.person_id, person2.person_id))
+        members = TESTSESSION.execute(
+            MEMBERSHIP.select().where(
+                MEMBERSHIP.c.board_id == board1.board_id)).fetchall()
+        TESTSESSION.expire_all()
+        snapshot = json.loads(TESTSESSION.query(BoardSnapshot).get(
+            board1.board_id).document)
+        removed = api.remove_board_members(
+            board1.board_id, [person1.person_id, person2.person_id],
+            Response())
+        missing = api.add_board_members(-1, [person1.person_id], Response())
+        # Then
+        assert added.data == {'added': 1, 'missing': [99]}
+        assert sorted(member.person_id for member in members) == [
+            person1.person_id, person2.person_id]
+        assert [person['label'] for person in snapshot['people']] == [
+            person1.label, person2.label]
+        assert removed == {'removed': 2}
+        assert not TESTSESSION.execute(MEMBERSHIP.select()).fetchall()
+        api.cache.invalidate.assert_called_once_with(board1.board_id)
+        assert missing is None
+
+    def test_board_snapshot(self, api, board1, person1):
+        # Given
+        window_start, today = snapshot_window()
+        api.create_reported_feeling(
+            board1.board_id, person1.person_id, 'good',
+            today.isoformat())
+        api.create_reported_feeling(
+            board1.board_id, person1.person_id, 'bad',
+            (window_start - datetime.timedelta(days=1)).isoformat())
+        # When
+        snapshot = TESTSESSION.query(BoardSnapshot).get(board1.board_id)
+        over_http = hug.test.get(  # pylint: disable=no-member
+            TESTAPI,
+            '/boards/{}'.format(board1.board_id),
+            headers={'Authorization': TOKEN},
+            from_date=window_start.isoformat())
+        missing = api.board(-1, Response(), from_date=window_start)
+        # Then
+        assert snapshot.window_start == window_start
+        assert over_http.data == {
+            'board_id': board1.board_id,
+            'label': board1.label,
+            'people': [{
+                'person_id': person1.person_id,
+                'label': person1.label,
+                'reportedfeelings': [{
+                    'board_id': board1.board_id,
+                    'person_id': person1.person_id,
+                    'date': today.isoformat(),
+                    'feeling': 'good'}]}]}
+        assert json.loads(snapshot.document) == over_http.data
+        assert missing is None
+
+    def test_label_search(self, api, person1, person2, board1, board2):
+        # Given
+        TESTSESSION.add(Person(person_id=3, label='julia'))
+        TESTSESSION.commit()
+        # When
+        people = hug.test.get(  # pylint: disable=no-member
+            TESTAPI,
+            '/people/search',
+            headers={'Authorization': TOKEN},
+            q=' JUL')
+        first = api.search_people('jul', limit=1, fields=fieldset('label'))
+        boards = hug.test.get(  # pylint: disable=no-member
+            TESTAPI,
+            '/boards/search',
+            headers={'Authorization': TOKEN},
+            q='sa')
+        nothing = api.search_boards('%a')
+        queries = []
+
+        def remember(conn, cursor, statement, *args):
+            # pylint: disable=unused-argument
+            queries.append(statement)
+        event.listen(TESTENGINE, 'before_cursor_execute', remember)
+        with_members = api.search_boards('d')
+        event.remove(TESTENGINE, 'before_cursor_execute', remember)
+        last_code_points = [
+            api.search_people('j' + chr(code_point))
+            for code_point in (0x10FFFF, 0xD7FF)]
+        too_many = hug.test.get(  # pylint: disable=no-member
+            TESTAPI,
+            '/people/search',
+            headers={'Authorization': TOKEN},
+            q='j', limit=51)
+        plan = TESTSESSION.execute(
+            'EXPLAIN QUERY PLAN ' + str(
+                api.search(Person, ('label',), 'jul').statement.compile(
+                    compile_kwargs={'literal_binds': True}))).fetchall()
+        # Then
+        assert people.data == [
+            {'person_id': 3, 'label': 'julia'},
+            {'person_id': person1.person_id, 'label': person1.label}]
+        assert first == [{'label': 'julia'}]
+        assert boards.data == [
+            {'board_id': board2.board_id, 'label': board2.label}]
+        assert nothing == []
+        assert last_code_points == [[], []]
+        assert with_members == [
+            {'board_id': board1.board_id, 'label': board1.label}]
+        assert len(queries) == 1
+        assert too_many.status == HTTP_400
+        assert any('ix_people_label_lower' in row[-1] for row in plan)
+        assert person2.label not in [row['label'] for row in people.data]
+        assert board1.label not in [row['label'] for row in boards.data]